@@ -0,0 +1,212 @@
+from argparse import ArgumentParser
+from contextlib import contextmanager
+import asyncio
+import functools
+import logging
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, Generator, List
+
+from openai import AsyncOpenAI, OpenAI
+
+from api_mining.cli.create_batches import BatchCreator
+from api_mining.cli.mock_server import MockOpenAI, MockServer
+from api_mining.cli.poll_batches import BatchPoller
+from api_mining.cli.process_chat import AsyncChatProcessor, ChatProcessor
+from api_mining.database.db import DatabaseHandler, DeathsDatabaseHandler, TropesDatabaseHandler, create_database_handler
+
+# the handler methods writing to the database during processing
+WRITE_METHODS = [
+    "add_character_data",
+    "add_characters_bulk",
+    "record_usage",
+    "update_movie",
+    "claim_chat_movies",
+    "release_chat_movies",
+    "submit_batch",
+    "update_batch",
+    "ingest_batch_results",
+]
+
+@contextmanager
+def record_write_latency() -> Generator[Dict[str, List[float]], None, None]:
+    """Record the latency in ms of each call of the handler write methods, not counting the calls made by other write methods."""
+    latencies = defaultdict(list)
+    local = threading.local()
+
+    def timed(name, method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            outermost = not getattr(local, "active", False)
+            local.active = True
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                if outermost:
+                    local.active = False
+                    latencies[name].append((time.perf_counter() - start) * 1000)
+        return wrapper
+
+    originals = [
+        (cls, name, cls.__dict__[name])
+        for cls in (DatabaseHandler, DeathsDatabaseHandler, TropesDatabaseHandler)
+        for name in WRITE_METHODS
+        if name in cls.__dict__
+    ]
+    for cls, name, method in originals:
+        setattr(cls, name, timed(name, method))
+    try:
+        yield latencies
+    finally:
+        for cls, name, method in originals:
+            setattr(cls, name, method)
+
+def count_completed(db: DatabaseHandler) -> int:
+    with sqlite3.connect(db.engine.url.database) as connection:
+        return connection.execute(
+            f"SELECT COUNT(*) FROM {db.Movie.__tablename__} WHERE processed_status = 'COMPLETED'"
+        ).fetchone()[0]
+
+def run_batches(
+    db_path: Path, input_dir: Path, batch_dir: Path, num_batches: int, batch_token_target: int, pack_size: int, poll_interval: float
+) -> None:
+    """Create batches of the pending movies and submit, poll and retrieve them until all are processed."""
+    BatchCreator(db_path, input_dir, batch_dir, num_batches, batch_token_target, pack_size=pack_size).create_batches()
+    BatchPoller(
+        OpenAI(), db_path, batch_dir, enqueued_token_limit=num_batches * batch_token_target, poll_interval=poll_interval
+    ).run()
+
+def run_chat(db_path: Path, input_dir: Path, concurrency: int, max_retries: int, pack_size: int) -> None:
+    """Process the pending chat movies, concurrently if concurrency is above 1."""
+    if concurrency > 1:
+        processor = AsyncChatProcessor(
+            AsyncOpenAI(max_retries=0), db_path, input_dir, concurrency=concurrency, rpm=1_000_000, tpm=1_000_000_000,
+            max_retries=max_retries, pack_size=pack_size
+        )
+        asyncio.run(processor.process_pending_movies())
+    else:
+        ChatProcessor(OpenAI(max_retries=max_retries), db_path, input_dir, pack_size=pack_size).process_pending_movies()
+
+def print_write_latency(latencies: Dict[str, List[float]]) -> None:
+    for name, values in sorted(latencies.items()):
+        values = sorted(values)
+        p95 = values[min(int(0.95 * len(values)), len(values) - 1)]
+        print(
+            f"  {name}: {len(values)} calls, median {statistics.median(values):.2f} ms, "
+            f"p95 {p95:.2f} ms, max {values[-1]:.2f} ms, total {sum(values) / 1000:.2f} s"
+        )
+
+def benchmark_pipeline(
+    db_path: Path,
+    input_dir: Path,
+    state: MockOpenAI,
+    num_batches: int,
+    batch_token_target: int,
+    concurrency: int,
+    max_retries: int,
+    pack_size: int
+) -> None:
+    """Run the batch and chat pipelines on a copy of the database against the mock server and print their throughput."""
+    server = MockServer(state).start()
+    os.environ["OPENAI_BASE_URL"] = server.base_url
+    os.environ["OPENAI_API_KEY"] = "mock"
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            copy_path = Path(tmp_dir) / db_path.name
+            with sqlite3.connect(db_path) as source, sqlite3.connect(copy_path) as target:
+                source.backup(target)
+            db = create_database_handler(copy_path)
+            batch_dir = Path(tmp_dir) / "batches"
+            batch_dir.mkdir()
+
+            stages = []
+            if num_batches:
+                stages.append(("batch", lambda: run_batches(
+                    copy_path, input_dir, batch_dir, num_batches, batch_token_target, pack_size, state.batch_latency / 4
+                )))
+            stages.append(("chat", lambda: run_chat(copy_path, input_dir, concurrency, max_retries, pack_size)))
+
+            for name, run in stages:
+                completed = count_completed(db)
+                stats = dict(state.stats)
+                with record_write_latency() as latencies:
+                    start = time.perf_counter()
+                    run()
+                    elapsed = time.perf_counter() - start
+
+                movies = count_completed(db) - completed
+                requests = {key: value - stats[key] for key, value in state.stats.items()}
+                print(f"{name}: {movies} movies in {elapsed:.2f} s, {movies / elapsed:.1f} movies/s")
+                if name == "batch":
+                    print(f"  {requests['batches']} batches, {requests['batch_requests']} requests")
+                else:
+                    attempts = requests["chat_requests"] + requests["rate_limited"]
+                    print(
+                        f"  {requests['chat_requests']} requests, {requests['rate_limited']} rate limited "
+                        f"({requests['rate_limited'] / attempts if attempts else 0:.1%} of {attempts} attempts)"
+                    )
+                print_write_latency(latencies)
+
+            pending = db.get_pending_chat_movies()
+            if pending:
+                print(f"{len(pending)} chat movies left pending, given up after {max_retries} retries")
+            db.engine.dispose()
+    finally:
+        server.stop()
+
+def main():
+    parser = ArgumentParser(description="Benchmark the batch and chat pipelines end to end against a local mock of the OpenAI API")
+    parser.add_argument("--db-path", type=Path, required=True,
+                        help="Path to the database, copied before processing")
+    parser.add_argument("--input-dir", type=Path, default=Path("./data/interim"),
+                        help="Path to the input directory (default: ./data/interim)")
+    parser.add_argument("--num-batches", type=int, default=0,
+                        help="Number of batches to create, submit and retrieve before the chat movies (default: 0)")
+    parser.add_argument("--batch-token-target", type=int, default=1_900_000,
+                        help="Target token count for each batch (default: 1_900_000)")
+    parser.add_argument("--concurrency", type=int, default=16,
+                        help="Number of concurrent chat requests, 1 for the sync client (default: 16)")
+    parser.add_argument("--max-retries", type=int, default=8,
+                        help="Retries of a chat request on rate limit errors (default: 8)")
+    parser.add_argument("--pack-size", type=int, default=1,
+                        help="Maximum number of movies per request (default: 1)")
+    parser.add_argument("--latency", type=float, default=0.2,
+                        help="Mean latency of a chat completion in seconds (default: 0.2)")
+    parser.add_argument("--jitter", type=float, default=0.1,
+                        help="Standard deviation of the latency in seconds (default: 0.1)")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.05,
+                        help="Share of chat completions answered with a 429 rate limit error (default: 0.05)")
+    parser.add_argument("--retry-after", type=float, default=0.5,
+                        help="Seconds in the retry-after header of the rate limit errors (default: 0.5)")
+    parser.add_argument("--batch-latency", type=float, default=1.0,
+                        help="Seconds until a submitted batch completes (default: 1)")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Random seed of the mock server")
+    args = parser.parse_args()
+
+    # only the results of the benchmark and the errors
+    logging.getLogger().setLevel(logging.ERROR)
+    random.seed(args.seed)
+    state = MockOpenAI(args.latency, args.jitter, args.rate_limit_rate, args.retry_after, args.batch_latency)
+    benchmark_pipeline(
+        args.db_path,
+        args.input_dir,
+        state,
+        args.num_batches,
+        args.batch_token_target,
+        args.concurrency,
+        args.max_retries,
+        args.pack_size
+    )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+from argparse import ArgumentParser
+import sqlite3
+import statistics
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable, List, Tuple
+
+from sqlalchemy import event
+
+from api_mining.database.db import DatabaseHandler, create_database_handler
+from api_mining.models.core import ProcessingStatus
+
+BENCHMARK_WORKER_ID = "query-benchmark"
+
+def get_handler_queries(db: DatabaseHandler) -> List[Tuple[str, Callable[[], Any]]]:
+    """Name and call each handler query the processing commands run repeatedly."""
+    batch_index = max(db.get_batch_count(), 1)
+    return [
+        ("get_pending_chat_movies", lambda: db.get_pending_chat_movies(limit=100)),
+        ("get_next_chat_movie", db.get_next_chat_movie),
+        ("claim_chat_movies", lambda: db.claim_chat_movies(BENCHMARK_WORKER_ID, 16)),
+        ("release_chat_movies", lambda: db.release_chat_movies(BENCHMARK_WORKER_ID)),
+        ("update_batch_movies_status", lambda: db.update_batch_movies_status(
+            batch_index, "benchmark", ProcessingStatus.PROCESSING
+        )),
+        ("get_batch_count", db.get_batch_count),
+        ("get_batch_ingestion", lambda: db.get_batch_ingestion("benchmark")),
+    ]
+
+def explain(connection: sqlite3.Connection, statement: str, parameters: Any) -> List[str]:
+    """Get the query plan of a statement, indented by depth."""
+    depths = {0: -1}
+    lines = []
+    for node_id, parent_id, _, detail in connection.execute(f"EXPLAIN QUERY PLAN {statement}", parameters):
+        depths[node_id] = depths.get(parent_id, -1) + 1
+        lines.append("    " + "  " * depths[node_id] + detail)
+    return lines
+
+def benchmark_queries(db_path: Path, repeat: int) -> None:
+    """Print the SQL, query plan and latency of each handler query, run on a copy of the database."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # the claim and update queries write to the database
+        copy_path = Path(tmp_dir) / db_path.name
+        with sqlite3.connect(db_path) as source, sqlite3.connect(copy_path) as target:
+            source.backup(target)
+
+        db = create_database_handler(copy_path)
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            statements.append((statement, parameters, executemany))
+
+        plan_connection = sqlite3.connect(copy_path)
+        for name, query in get_handler_queries(db):
+            event.listen(db.engine, "before_cursor_execute", capture)
+            query()
+            event.remove(db.engine, "before_cursor_execute", capture)
+
+            latencies = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                query()
+                latencies.append((time.perf_counter() - start) * 1000)
+
+            print(f"{name}: median {statistics.median(latencies):.2f} ms, max {max(latencies):.2f} ms over {repeat} runs")
+            for statement, parameters, executemany in statements:
+                print("  " + " ".join(statement.split()))
+                if executemany:
+                    # the plan of each row is the plan of the first
+                    parameters = parameters[0]
+                for line in explain(plan_connection, statement, parameters):
+                    print(line)
+            statements.clear()
+
+        plan_connection.close()
+        db.engine.dispose()
+
+def main():
+    parser = ArgumentParser(description="Print the query plan and latency of the database handler queries")
+    parser.add_argument("--db-path", type=Path, required=True,
+                        help="Path to the database, which is copied and left unchanged")
+    parser.add_argument("--repeat", type=int, default=20,
+                        help="Runs of each query to time (default: 20)")
+    args = parser.parse_args()
+
+    benchmark_queries(args.db_path, args.repeat)
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,4 @@
 from argparse import ArgumentParser
-import json
 import logging
 from pathlib import Path
 from typing import Type, Dict, Any, List
@@ -7,14 +6,13 @@ from pydantic import BaseModel
 
 from api_mining.utils.common import (
     read_system_prompt,
-    construct_user_prompt,
-    get_plot_summary,
-    get_character_names,
-    get_batch_ids,
-    save_batch_ids
+    construct_request_prompt
 )
-from api_mining.models.core import ProcessingMethod
 from api_mining.database.db import create_database_handler
+from api_mining.utils.batch_planner import PlanStrategy, plan_batches, format_plan_report
+from api_mining.utils.batch_writer import BATCH_FILE_BYTE_LIMIT, BatchFileWriter, BatchRequestEncoder
+from api_mining.utils.request_packer import PackedRequest, pack_requests, split_custom_id
+from api_mining.utils.token_usage import summarize_usage
 
 logging.basicConfig(
     level=logging.INFO,
@@ -60,6 +58,25 @@ def create_response_format(characters_model: Type[BaseModel], name: str) -> Dict
 
     return response_format
 
+def create_packed_response_format(characters_model: Type[BaseModel], name: str) -> Dict[str, Any]:
+    """Generate a response format JSON schema with the characters of each movie of a packed request."""
+    response_format = create_response_format(characters_model, name)
+    schema = response_format["json_schema"]["schema"]
+
+    movie_schema = {
+        "type": "object",
+        "properties": {
+            "movie_id": {"type": "string"},
+            "characters": schema["properties"]["characters"]
+        },
+        "required": ["movie_id", "characters"],
+        "additionalProperties": False,
+    }
+    schema["properties"] = {"movies": {"type": "array", "items": movie_schema}}
+    schema["required"] = ["movies"]
+
+    return response_format
+
 class BatchCreator:
     """Manages the creation of movie processing batches for the OpenAI batch API."""
     def __init__(
@@ -68,19 +85,71 @@ class BatchCreator:
         input_dir: Path,
         batch_dir: Path,
         num_batches: int,
-        batch_token_target: int
+        batch_token_target: int,
+        strategy: PlanStrategy = PlanStrategy.FFD,
+        dry_run: bool = False,
+        batch_byte_limit: int = BATCH_FILE_BYTE_LIMIT,
+        calibrate: bool = False,
+        pack_size: int = 1,
+        pack_token_limit: int = 4000
     ):
         self.db = create_database_handler(db_path)
         self.input_dir = input_dir
         self.batch_dir = batch_dir
         self.num_batches = num_batches
         self.batch_token_target = batch_token_target
+        self.strategy = strategy
+        self.dry_run = dry_run
+        self.batch_byte_limit = batch_byte_limit
+        self.calibrate = calibrate
+        self.pack_size = pack_size
+        self.pack_token_limit = pack_token_limit
         self.batch_count = self.db.get_batch_count()
         self.system_prompt = read_system_prompt(self.db.data_type)
         self.response_format = create_response_format(
             characters_model=self.db.Character, 
             name=f"character_{self.db.data_type.value}"
         )
+        self.encoder = BatchRequestEncoder(self.system_prompt, self.response_format)
+        if pack_size > 1:
+            self.packed_encoder = BatchRequestEncoder(
+                read_system_prompt(self.db.data_type, packed=True),
+                create_packed_response_format(
+                    characters_model=self.db.Character,
+                    name=f"movie_characters_{self.db.data_type.value}"
+                )
+            )
+
+    def get_encoder(self, movie_ids: List[str]) -> BatchRequestEncoder:
+        """Get the encoder of a request for one or several movies."""
+        return self.packed_encoder if len(movie_ids) > 1 else self.encoder
+
+    def pack_requests(self, token_counts: Dict[str, int]) -> List[PackedRequest]:
+        """Pack the shortest movies into requests of up to pack_size movies, one movie per request if not packing."""
+        requests = pack_requests(list(token_counts.items()), self.db.data_type, self.pack_size, self.pack_token_limit)
+        if self.pack_size > 1:
+            logging.info(
+                f"Packed {len(token_counts)} movies into {len(requests)} requests, "
+                f"saving an estimated {sum(token_counts.values()) - sum(request.token_count for request in requests)} tokens"
+            )
+        return requests
+
+    def get_token_ratio(self) -> float:
+        """
+        Get the reported prompt tokens per estimated token of the movies processed alone in their request, 1 if not
+        calibrating or none were processed.
+        """
+        if not self.calibrate:
+            return 1.0
+
+        # the usage of a packed request is shared by its movies, whose estimates each include the system prompt
+        summary = summarize_usage(self.db.get_token_usage(packed=False))["all"]
+        if summary.prompt_ratio is None:
+            logging.warning("No movies processed alone in their request to calibrate the estimated token counts")
+            return 1.0
+
+        logging.info(f"Scaling the estimated token counts by {summary.prompt_ratio:.3f}, measured on {summary.movies} movies")
+        return summary.prompt_ratio
 
     def create_batches(self) -> None:
         """Create batches of movies for processing based on token count limits."""
@@ -94,72 +163,83 @@ class BatchCreator:
 
             for movie in movies:
                 session.add(movie)
-            # Sort by token count to process the shortest summaries first (least tokens per request)
-            movies.sort(key=lambda x: x.token_count)
-            
-            current_batch = 1
-            current_tokens = 0
-            batch_movies = []
-            batch_ids = get_batch_ids(self.batch_dir)
 
-            for movie in movies:
-                if current_batch > self.num_batches:
+            token_ratio = self.get_token_ratio()
+            requests = self.pack_requests({movie.id: round(movie.token_count * token_ratio) for movie in movies})
+
+            logging.info(f"Each request repeats a {len(self.encoder.prefix)} byte prefix (system prompt and response format)")
+            if self.pack_size > 1:
+                logging.info(f"Each request of several movies repeats a {len(self.packed_encoder.prefix)} byte prefix")
+
+            # Only the planned requests are read and encoded, for sizing and writing. The size of the requests not read
+            # yet is estimated from the bytes per token of those read so far, so the batches are planned again until
+            # they only contain requests of known size.
+            token_counts = {request.custom_id: request.token_count for request in requests}
+            user_contents: Dict[str, bytes] = {}
+            byte_counts: Dict[str, int] = {}
+            read_tokens = 0
+            while True:
+                bytes_per_token = sum(byte_counts.values()) / read_tokens if read_tokens else 0
+                batches = plan_batches(
+                    [(request.custom_id, request.token_count) for request in requests],
+                    self.num_batches,
+                    self.batch_token_target,
+                    self.strategy,
+                    byte_counts={
+                        request.custom_id: byte_counts.get(request.custom_id, round(request.token_count * bytes_per_token))
+                        for request in requests
+                    },
+                    byte_limit=self.batch_byte_limit
+                )
+                unread = [custom_id for batch in batches for custom_id in batch.movie_ids if custom_id not in byte_counts]
+                if not unread:
                     break
-                    
-                if current_tokens + movie.token_count > self.batch_token_target:
-                    self.create_batch_file(current_batch, batch_movies, current_tokens)
-                    current_batch += 1
-                    batch_movies = [movie.id]
-                    current_tokens = movie.token_count
-                    batch_ids.append(None)
-                else:
-                    batch_movies.append(movie.id)
-                    current_tokens += movie.token_count
-            
-            if batch_movies and current_batch <= self.num_batches:
-                self.create_batch_file(current_batch, batch_movies, current_tokens)
-                batch_ids.append(None)
-            
-            save_batch_ids(self.batch_dir, batch_ids)
+                for custom_id in unread:
+                    encoder = self.get_encoder(split_custom_id(custom_id))
+                    user_contents[custom_id] = encoder.encode_user_prompt(
+                        construct_request_prompt(self.input_dir, split_custom_id(custom_id))
+                    )
+                    byte_counts[custom_id] = encoder.request_size(custom_id, user_contents[custom_id])
+                read_tokens += sum(token_counts[custom_id] for custom_id in unread)
+            movie_counts = {request.custom_id: len(request.movie_ids) for request in requests} if self.pack_size > 1 else None
+            for line in format_plan_report(batches, self.batch_token_target, len(movies), self.batch_byte_limit, movie_counts):
+                logging.info(line)
+
+            if self.dry_run:
+                return
+
+            for batch_num, batch in enumerate(batches, start=1):
+                # the user contents are encoded once, for sizing and writing
+                batch_contents = {custom_id: user_contents.pop(custom_id) for custom_id in batch.movie_ids}
+                self.create_batch_file(batch_num, batch_contents, batch.token_count)
     
-    def create_batch_file(self, batch_num: int, movie_ids: List[str], token_count: int) -> None:
-        """Create a batch input file for the specified movies and update their database records."""
+    def create_batch_file(self, batch_num: int, user_contents: Dict[str, bytes], token_count: int) -> None:
+        """Create a batch input file from the encoded user contents of its requests and record it and the batch of its movies in the database."""
+        movie_ids = [movie_id for custom_id in user_contents for movie_id in split_custom_id(custom_id)]
         batch_index = self.batch_count + batch_num
 
         batch_file = self.batch_dir / f"batch_{batch_index}.jsonl"
+        tmp_file = self.batch_dir / f"batch_{batch_index}.jsonl.tmp"
         
-        with batch_file.open('w') as f:
-            for movie_id in movie_ids:
-                plot_summary = get_plot_summary(self.input_dir, movie_id)
-                character_names = get_character_names(self.input_dir, movie_id)
-                user_prompt = construct_user_prompt(
-                    plot_summary=plot_summary,
-                    character_names=character_names
-                )
-                
-                request = {
-                    "custom_id": movie_id,
-                    "method": "POST",
-                    "url": "/v1/chat/completions",
-                    "body": {
-                        "model": "gpt-4o-mini",
-                        "messages": [
-                            {"role": "system", "content": self.system_prompt},
-                            {"role": "user", "content": user_prompt}
-                        ],
-                        "response_format": self.response_format
-                    }
-                }
-                f.write(json.dumps(request) + '\n')
-                
-                self.db.update_movie(
-                    movie_id=movie_id,
-                    method=ProcessingMethod.BATCH,
-                    batch_index=batch_index,
-                    token_count=token_count
-                )
+        # The batch file only appears if the movies were assigned to the batch, and vice versa
+        try:
+            with BatchFileWriter(tmp_file, self.encoder, self.batch_byte_limit) as writer:
+                for custom_id, user_content in user_contents.items():
+                    writer.write(custom_id, user_content, self.get_encoder(split_custom_id(custom_id)))
+
+            with self.db.get_session() as session:
+                self.db.assign_batch(movie_ids, batch_index, session=session)
+                self.db.add_batch(batch_index, len(movie_ids), token_count, session=session)
+                tmp_file.replace(batch_file)
+        except Exception:
+            tmp_file.unlink(missing_ok=True)
+            batch_file.unlink(missing_ok=True)
+            raise
         
-        logging.info(f"Created batch {batch_index} with {len(movie_ids)} movies and estimated {token_count} tokens")
+        logging.info(
+            f"Created batch {batch_index} with {len(movie_ids)} movies and estimated {token_count} tokens, "
+            f"{writer.byte_count / 1e6:.1f} MB ({writer.byte_count // writer.request_count} bytes/request)"
+        )
 
 def main():
     parser = ArgumentParser(description="Create new batches from pending movies")
@@ -172,11 +252,36 @@ def main():
                         help="Number of batches to create (default: 4)")
     parser.add_argument("--batch-token-target", type=int, default=1_900_000, 
                         help="Target token count for each batch (default: 1_900_000)")
+    parser.add_argument("--strategy", type=PlanStrategy, choices=[s.value for s in PlanStrategy], default=PlanStrategy.FFD,
+                        help="How to pack movies into batches: fill batches one after the other (sequential), "
+                             "first-fit decreasing (ffd) or evenly filled batches (balanced) (default: ffd)")
+    parser.add_argument("--batch-byte-limit", type=int, default=BATCH_FILE_BYTE_LIMIT,
+                        help=f"Maximum size of each batch file in bytes (default: {BATCH_FILE_BYTE_LIMIT}, the upload limit)")
+    parser.add_argument("--calibrate", action="store_true",
+                        help="Scale the estimated token counts by the ratio of reported to estimated prompt tokens of the processed movies")
+    parser.add_argument("--pack-size", type=int, default=1,
+                        help="Maximum number of movies per request, sharing one system prompt (default: 1, no packing)")
+    parser.add_argument("--pack-token-limit", type=int, default=4000,
+                        help="Maximum estimated tokens of a request packing several movies (default: 4000)")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Only report the planned batches and their utilization")
     args = parser.parse_args()
 
     args.batch_dir.mkdir(parents=True, exist_ok=True)
 
-    creator = BatchCreator(args.db_path, args.input_dir, args.batch_dir, args.num_batches, args.batch_token_target)
+    creator = BatchCreator(
+        args.db_path,
+        args.input_dir,
+        args.batch_dir,
+        args.num_batches,
+        args.batch_token_target,
+        args.strategy,
+        args.dry_run,
+        args.batch_byte_limit,
+        args.calibrate,
+        args.pack_size,
+        args.pack_token_limit
+    )
     creator.create_batches()
     logging.info("Batch creation complete.")
 
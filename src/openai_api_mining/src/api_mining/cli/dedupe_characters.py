@@ -0,0 +1,37 @@
+from argparse import ArgumentParser
+import logging
+from pathlib import Path
+
+from api_mining.database.db import create_database_handler, get_unique_character_index
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s %(levelname)s: %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+
+def dedupe_characters(db_path: Path) -> None:
+    """Remove duplicate characters, add the unique (movie_id, name) index and compact the database."""
+    size_before = db_path.stat().st_size
+    db = create_database_handler(db_path, create_unique_index=False)
+
+    removed = db.dedupe_characters()
+    logging.info(f"Removed {removed} duplicate characters")
+
+    get_unique_character_index(db.CharacterDB.__table__).create(db.engine, checkfirst=True)
+
+    with db.engine.connect() as connection:
+        connection.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+        connection.exec_driver_sql("VACUUM")
+    logging.info(f"Database size: {size_before / 1e6:.1f} MB -> {db_path.stat().st_size / 1e6:.1f} MB")
+
+def main():
+    parser = ArgumentParser(description="Remove duplicate characters from a database and compact it")
+    parser.add_argument("--db-path", type=Path, required=True,
+                        help="Path to the database")
+    args = parser.parse_args()
+
+    dedupe_characters(args.db_path)
+
+if __name__ == "__main__":
+    main()
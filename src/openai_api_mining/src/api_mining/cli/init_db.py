@@ -1,6 +1,11 @@
 from argparse import ArgumentParser
 import logging
+import multiprocessing as mp
+from multiprocessing.util import Finalize
+import os
+import time
 from pathlib import Path
+from typing import Any, Dict, Iterator, Optional
 
 import pandas as pd
 from tqdm import tqdm
@@ -15,9 +20,10 @@ from api_mining.models.core import (
 from api_mining.database.db import DeathsDatabaseHandler, TropesDatabaseHandler
 from api_mining.utils.common import (
     get_plot_summary,
+    get_plot_summary_ids,
     get_character_names,
 )
-from api_mining.utils.token_counter import TokenCounter
+from api_mining.utils.token_counter import TOKEN_CACHE_FILE, TokenCounter
 
 logging.basicConfig(
     level=logging.INFO,
@@ -25,24 +31,14 @@ logging.basicConfig(
     datefmt='%Y-%m-%d %H:%M:%S'
 )
 
-class DBInitializer:
-    """Initializes and processes a database with movie and character data."""
-    def __init__(self, db_path: Path, data_type: DataType, input_dir: Path):
-        handlers = {
-            DataType.DEATHS: DeathsDatabaseHandler,
-            DataType.TROPES: TropesDatabaseHandler
-        }
-        handler_class = handlers.get(data_type)
-        if not handler_class:
-            raise ValueError(f"Unknown data type: {data_type}")
-        
-        self.db = handler_class(db_path)
-        with self.db.get_session() as session:
-            metadata = DatabaseMetadata(data_type=data_type)
-            session.add(metadata)
-
+class MovieReader:
+    """Reads the plot summary and character metadata of a movie and estimates its request tokens."""
+    def __init__(self, data_type: DataType, input_dir: Path, token_cache: Optional[Path] = None):
         self.input_dir = input_dir
-        self.token_counter = TokenCounter(data_type)
+        self.token_counter = TokenCounter(data_type, cache_path=token_cache)
+
+    def close(self) -> None:
+        self.token_counter.close()
 
     def check_character_metadata(self, movie_id: str) -> MetadataStatus:
         """Check the availability and completeness of character metadata for a movie."""
@@ -62,37 +58,107 @@ class DBInitializer:
         except Exception as e:
             logging.error(f"Error reading character metadata for {movie_id}: {e}")
             return MetadataStatus.MISSING_METADATA
+
+    def read_movie(self, movie_id: str) -> Optional[Dict[str, Any]]:
+        """Get the Movie fields of a movie, or None if it has no plot summary."""
+        plot_summary = get_plot_summary(self.input_dir, movie_id)
+        
+        if not plot_summary:
+            return None
+
+        metadata_status = self.check_character_metadata(movie_id)
+        character_names = (
+            get_character_names(self.input_dir, movie_id) 
+            if metadata_status == MetadataStatus.COMPLETE 
+            else None
+        )
+        
+        token_count = self.token_counter.estimate_request_tokens(
+            plot_summary=plot_summary,
+            character_names=character_names
+        )
+
+        return dict(
+            id=movie_id,
+            metadata_status=metadata_status,
+            processed_status=ProcessingStatus.PENDING,
+            processing_method=ProcessingMethod.CHAT,
+            token_count=token_count
+        )
+
+# Set once in each worker process by init_worker, each worker has its own tiktoken encoding
+worker_reader: Optional[MovieReader] = None
+
+def init_worker(data_type: DataType, input_dir: Path, token_cache: Optional[Path]) -> None:
+    """Create the MovieReader of a worker process."""
+    global worker_reader
+    worker_reader = MovieReader(data_type, input_dir, token_cache)
+    # run when the worker exits after pool.close() and pool.join()
+    Finalize(worker_reader, worker_reader.close, exitpriority=10)
+
+def read_movie_in_worker(movie_id: str) -> Optional[Dict[str, Any]]:
+    """Read a movie with the MovieReader of the worker process."""
+    return worker_reader.read_movie(movie_id)
+
+class DBInitializer:
+    """Initializes and processes a database with movie and character data."""
+    def __init__(
+        self,
+        db_path: Path,
+        data_type: DataType,
+        input_dir: Path,
+        num_workers: int = 1,
+        token_cache: Optional[Path] = None
+    ):
+        handlers = {
+            DataType.DEATHS: DeathsDatabaseHandler,
+            DataType.TROPES: TropesDatabaseHandler
+        }
+        handler_class = handlers.get(data_type)
+        if not handler_class:
+            raise ValueError(f"Unknown data type: {data_type}")
+        
+        self.db = handler_class(db_path)
+        with self.db.get_session() as session:
+            metadata = DatabaseMetadata(data_type=data_type)
+            session.add(metadata)
+
+        self.data_type = data_type
+        self.input_dir = input_dir
+        self.num_workers = num_workers
+        self.token_cache = token_cache
     
     def process_all_movies(self):
         """Process all movies by reading plot summaries and character metadata."""
-        plot_files = list(self.input_dir.glob('plot_summaries_*.txt'))
-        
-        for plot_file in tqdm(plot_files, desc="Processing movies"):
-            movie_id = plot_file.stem.split('_')[2]
-            plot_summary = get_plot_summary(self.input_dir, movie_id)
-            
-            if not plot_summary:
-                continue
-
-            metadata_status = self.check_character_metadata(movie_id)
-            character_names = (
-                get_character_names(self.input_dir, movie_id) 
-                if metadata_status == MetadataStatus.COMPLETE 
-                else None
-            )
-            
-            token_count = self.token_counter.estimate_request_tokens(
-                plot_summary=plot_summary,
-                character_names=character_names
-            )
+        start = time.perf_counter()
+        count = self.db.add_movies_bulk(self.iter_movies())
+        elapsed = time.perf_counter() - start
+        logging.info(f"Added {count} movies in {elapsed:.1f}s ({count / max(elapsed, 1e-9):.0f} rows/s)")
+
+    def iter_movies(self) -> Iterator[Dict[str, Any]]:
+        """Yield the Movie fields of each movie with a plot summary, read by a process pool if num_workers > 1."""
+        movie_ids = get_plot_summary_ids(self.input_dir)
 
-            self.db.add_movie(
-                movie_id=movie_id,
-                metadata_status=metadata_status,
-                status=ProcessingStatus.PENDING,
-                method=ProcessingMethod.CHAT,
-                token_count=token_count
-            )
+        if self.num_workers > 1:
+            # the main process is the only DB writer, the workers only read and tokenize
+            with mp.Pool(self.num_workers, initializer=init_worker, initargs=(self.data_type, self.input_dir, self.token_cache)) as pool:
+                movies = pool.imap_unordered(read_movie_in_worker, movie_ids, chunksize=64)
+                for movie in tqdm(movies, total=len(movie_ids), desc="Processing movies"):
+                    if movie is not None:
+                        yield movie
+                # let the workers exit and close their token caches instead of being terminated
+                pool.close()
+                pool.join()
+            return
+
+        reader = MovieReader(self.data_type, self.input_dir, self.token_cache)
+        try:
+            for movie_id in tqdm(movie_ids, desc="Processing movies"):
+                movie = reader.read_movie(movie_id)
+                if movie is not None:
+                    yield movie
+        finally:
+            reader.close()
 
 
 def main():
@@ -103,6 +169,10 @@ def main():
                        required=True, help="Type of data to store")
     parser.add_argument("--input-dir", type=Path, default=Path("./data/interim"), 
                         help="Path to the input directory (default: ./data/interim)")
+    parser.add_argument("--num-workers", type=int, default=os.cpu_count(),
+                        help="Number of processes reading and tokenizing the movies, 1 to process them in the main process (default: number of CPUs)")
+    parser.add_argument("--token-cache", type=Path, default=None,
+                        help=f"Path to the persistent cache of prompt token counts (default: {TOKEN_CACHE_FILE} in the input directory)")
     args = parser.parse_args()
 
     args.db_path.parent.mkdir(parents=True, exist_ok=True)
@@ -110,7 +180,13 @@ def main():
         logging.warning(f"Database file already exists at {args.db_path}. Exiting.")
         return
 
-    initializer = DBInitializer(args.db_path, args.data_type, args.input_dir)
+    initializer = DBInitializer(
+        args.db_path,
+        args.data_type,
+        args.input_dir,
+        args.num_workers,
+        args.token_cache or args.input_dir / TOKEN_CACHE_FILE
+    )
     initializer.process_all_movies()
     logging.info("Database initialization complete.")
 
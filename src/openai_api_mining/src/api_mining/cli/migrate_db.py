@@ -0,0 +1,46 @@
+from argparse import ArgumentParser
+import logging
+from pathlib import Path
+from typing import Optional
+
+from api_mining.database.db import add_missing_indexes, create_database_handler
+from api_mining.utils.common import get_batch_ids
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s %(levelname)s: %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+
+def migrate_db(db_path: Path, batch_dir: Optional[Path] = None) -> None:
+    """
+    Bring a database created by an earlier version up to the current schema, record its batches with the IDs of
+    the batch ID log of batch_dir if given, and refresh the planner statistics.
+    """
+    # opening the database adds the missing columns and the unique character index
+    db = create_database_handler(db_path)
+
+    with db.engine.connect() as connection:
+        for table in (db.Movie.__table__, db.CharacterDB.__table__):
+            for name in add_missing_indexes(connection, table):
+                logging.info(f"Created index {name}")
+        # statistics for the query planner to choose between the indexes
+        connection.exec_driver_sql("ANALYZE")
+        connection.commit()
+    batch_count = db.add_missing_batches(get_batch_ids(batch_dir) if batch_dir else None)
+    if batch_count:
+        logging.info(f"Recorded {batch_count} batches created by an earlier version")
+    logging.info(f"Database {db_path} is up to date")
+
+def main():
+    parser = ArgumentParser(description="Add the missing columns and indexes to a database created by an earlier version")
+    parser.add_argument("--db-path", type=Path, required=True,
+                        help="Path to the database")
+    parser.add_argument("--batch-dir", type=Path, default=None,
+                        help="Batch directory with the batch_ids.json of batches submitted by an earlier version")
+    args = parser.parse_args()
+
+    migrate_db(args.db_path, args.batch_dir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,348 @@
+from argparse import ArgumentParser
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import random
+import re
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s %(levelname)s: %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+
+# the provider caches prompt prefixes of at least 1024 tokens, in steps of 128
+CACHE_MIN_TOKENS = 1024
+CACHE_STEP_TOKENS = 128
+
+Movie = Tuple[Optional[str], List[str]]
+
+def parse_movies(user_prompt: str) -> List[Movie]:
+    """Get the (movie_id or None, character names) of the movies of a user prompt."""
+    packed = re.findall(r'<movie id="([^"]*)">(.*?)</movie>', user_prompt, re.S)
+    movies = packed or [(None, user_prompt)]
+    return [
+        (movie_id, [name for name in names.group(1).split(", ") if name] if (names := re.search(r"<names>(.*?)</names>", text, re.S)) else [])
+        for movie_id, text in movies
+    ]
+
+class ResponseSynthesizer:
+    """Builds a response matching a JSON schema, with one character per name and one entry per movie of the prompt"""
+    def __init__(self, schema: Dict[str, Any], movies: List[Movie]):
+        self.schema = schema
+        self.defs = schema.get("$defs", {})
+        self.movies = movies
+
+    def resolve(self, schema: Dict[str, Any]) -> Dict[str, Any]:
+        while "$ref" in schema:
+            schema = self.defs[schema["$ref"].split("/")[-1]]
+        return schema
+
+    def value(self, schema: Dict[str, Any], key: Optional[str], movie: Movie, name: Optional[str]) -> Any:
+        schema = self.resolve(schema)
+        if "enum" in schema:
+            return random.choice(schema["enum"])
+        if "anyOf" in schema:
+            return self.value(schema["anyOf"][0], key, movie, name)
+
+        kind = schema.get("type")
+        if kind == "object":
+            return {
+                property_key: self.value(property_schema, property_key, movie, name)
+                for property_key, property_schema in schema.get("properties", {}).items()
+            }
+        if kind == "array":
+            if key == "movies":
+                return [self.value(schema["items"], None, item, None) for item in self.movies]
+            if key == "characters":
+                return [self.value(schema["items"], None, movie, item) for item in movie[1]]
+            return [self.value(schema["items"], None, movie, name)]
+        if kind == "string":
+            if key == "name" and name is not None:
+                return name
+            if key == "movie_id" and movie[0] is not None:
+                return movie[0]
+            return "mock"
+        if kind == "boolean":
+            return random.random() < 0.5
+        if kind in ("integer", "number"):
+            return 0
+        return None
+
+    def build(self) -> Dict[str, Any]:
+        return self.value(self.schema, None, self.movies[0], None)
+
+class MockOpenAI:
+    """State of the mock server: files, batches, and request statistics"""
+    def __init__(
+        self,
+        latency: float = 0.2,
+        jitter: float = 0.1,
+        rate_limit_rate: float = 0.0,
+        retry_after: float = 1.0,
+        batch_latency: float = 5.0,
+        enqueued_token_limit: Optional[int] = None
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.batch_latency = batch_latency
+        self.enqueued_token_limit = enqueued_token_limit
+        # rough prompt tokens of the batches in progress
+        self.enqueued_tokens: Dict[str, int] = {}
+        self.files: Dict[str, Dict[str, Any]] = {}
+        self.file_contents: Dict[str, bytes] = {}
+        self.batches: Dict[str, Dict[str, Any]] = {}
+        self.cached_prefixes = set()
+        self.stats = {"chat_requests": 0, "rate_limited": 0, "files": 0, "batches": 0, "batch_requests": 0}
+        self.lock = threading.Lock()
+
+    def count(self, stat: str, amount: int = 1) -> None:
+        with self.lock:
+            self.stats[stat] += amount
+
+    def complete(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        """Answer a chat completion request with synthetic structured output."""
+        messages = body["messages"]
+        system_prompt = next((message["content"] for message in messages if message["role"] == "system"), "")
+        user_prompt = messages[-1]["content"]
+
+        response_format = body.get("response_format") or {}
+        schema = response_format.get("json_schema", {}).get("schema")
+        if schema:
+            content = json.dumps(ResponseSynthesizer(schema, parse_movies(user_prompt)).build())
+        else:
+            content = "mock"
+
+        # rough token counts, with the system prompt read from the cache after its first request
+        prompt_tokens = sum(len(message["content"]) for message in messages) // 4
+        system_tokens = len(system_prompt) // 4
+        cached_tokens = 0
+        if system_tokens >= CACHE_MIN_TOKENS:
+            with self.lock:
+                if system_prompt in self.cached_prefixes:
+                    cached_tokens = system_tokens // CACHE_STEP_TOKENS * CACHE_STEP_TOKENS
+                self.cached_prefixes.add(system_prompt)
+
+        return {
+            "id": f"chatcmpl-mock-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "gpt-4o-mini"),
+            "choices": [{
+                "index": 0,
+                "finish_reason": "stop",
+                "logprobs": None,
+                "message": {"role": "assistant", "content": content, "refusal": None}
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": len(content) // 4,
+                "total_tokens": prompt_tokens + len(content) // 4,
+                "prompt_tokens_details": {"cached_tokens": cached_tokens}
+            }
+        }
+
+    def add_file(self, filename: str, purpose: str, content: bytes) -> Dict[str, Any]:
+        file_id = f"file-mock-{uuid.uuid4().hex}"
+        self.files[file_id] = {
+            "id": file_id,
+            "object": "file",
+            "bytes": len(content),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+            "status": "processed"
+        }
+        self.file_contents[file_id] = content
+        self.count("files")
+        return self.files[file_id]
+
+    def create_batch(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        batch_id = f"batch_mock_{uuid.uuid4().hex}"
+        batch = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": body["endpoint"],
+            "input_file_id": body["input_file_id"],
+            "completion_window": body["completion_window"],
+            "status": "in_progress",
+            "created_at": int(time.time()),
+            "output_file_id": None,
+            "error_file_id": None
+        }
+        self.batches[batch_id] = batch
+        self.count("batches")
+
+        tokens = len(self.file_contents[body["input_file_id"]]) // 4
+        with self.lock:
+            if self.enqueued_token_limit is not None and sum(self.enqueued_tokens.values()) + tokens > self.enqueued_token_limit:
+                # rejected after validation, like the provider does
+                batch["status"] = "failed"
+                batch["errors"] = {"object": "list", "data": [{
+                    "code": "token_limit_exceeded",
+                    "message": f"Enqueued token limit reached (mock): {self.enqueued_token_limit}"
+                }]}
+                return batch
+            self.enqueued_tokens[batch_id] = tokens
+
+        threading.Timer(self.batch_latency, self.run_batch, args=(batch_id,)).start()
+        return batch
+
+    def run_batch(self, batch_id: str) -> None:
+        """Answer all the requests of a batch and complete it."""
+        batch = self.batches[batch_id]
+        lines = []
+        for line in self.file_contents[batch["input_file_id"]].splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            lines.append(json.dumps({
+                "id": f"batch_req_{uuid.uuid4().hex}",
+                "custom_id": request["custom_id"],
+                "response": {"status_code": 200, "request_id": uuid.uuid4().hex, "body": self.complete(request["body"])},
+                "error": None
+            }))
+        self.count("batch_requests", len(lines))
+
+        output = self.add_file(f"{batch_id}_output.jsonl", "batch_output", ("\n".join(lines) + "\n").encode())
+        batch["output_file_id"] = output["id"]
+        batch["request_counts"] = {"total": len(lines), "completed": len(lines), "failed": 0}
+        batch["status"] = "completed"
+        batch["completed_at"] = int(time.time())
+        with self.lock:
+            self.enqueued_tokens.pop(batch_id, None)
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+    """Routes the endpoints of the OpenAI API used by the api_mining commands"""
+    protocol_version = "HTTP/1.1"
+    server: "MockServer"
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def send_json(self, status: int, data: Any, headers: Optional[Dict[str, str]] = None) -> None:
+        self.send_bytes(status, json.dumps(data).encode(), "application/json", headers)
+
+    def send_bytes(self, status: int, body: bytes, content_type: str, headers: Optional[Dict[str, str]] = None) -> None:
+        self.send_response(status)
+        self.send_header("content-type", content_type)
+        self.send_header("content-length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("content-length", 0)))
+
+    def do_POST(self) -> None:
+        state = self.server.state
+        body = self.read_body()
+
+        if self.path == "/v1/chat/completions":
+            time.sleep(max(0.0, random.gauss(state.latency, state.jitter)))
+            if random.random() < state.rate_limit_rate:
+                state.count("rate_limited")
+                error = {"error": {"message": "Rate limit reached (mock)", "type": "requests", "code": "rate_limit_exceeded"}}
+                return self.send_json(429, error, {"retry-after": str(state.retry_after)})
+            state.count("chat_requests")
+            return self.send_json(200, state.complete(json.loads(body)))
+
+        if self.path == "/v1/files":
+            # multipart/form-data with the purpose and the file
+            message = BytesParser().parsebytes(
+                f"content-type: {self.headers['content-type']}\r\n\r\n".encode() + body
+            )
+            fields = {part.get_param("name", header="content-disposition"): part for part in message.get_payload()}
+            file_part = fields["file"]
+            return self.send_json(200, state.add_file(
+                file_part.get_filename() or "upload.jsonl",
+                fields["purpose"].get_payload(decode=True).decode(),
+                file_part.get_payload(decode=True)
+            ))
+
+        if self.path == "/v1/batches":
+            return self.send_json(200, state.create_batch(json.loads(body)))
+
+        self.send_json(404, {"error": {"message": f"Unknown endpoint {self.path}"}})
+
+    def do_GET(self) -> None:
+        state = self.server.state
+
+        if match := re.fullmatch(r"/v1/files/([^/]+)/content", self.path):
+            if match.group(1) in state.file_contents:
+                return self.send_bytes(200, state.file_contents[match.group(1)], "application/octet-stream")
+        elif match := re.fullmatch(r"/v1/files/([^/]+)", self.path):
+            if match.group(1) in state.files:
+                return self.send_json(200, state.files[match.group(1)])
+        elif match := re.fullmatch(r"/v1/batches/([^/]+)", self.path):
+            if match.group(1) in state.batches:
+                return self.send_json(200, state.batches[match.group(1)])
+
+        self.send_json(404, {"error": {"message": f"Not found: {self.path}"}})
+
+class MockServer(ThreadingHTTPServer):
+    """Local stand-in for the OpenAI API, serving in a background thread once started"""
+    daemon_threads = True
+
+    def __init__(self, state: MockOpenAI, host: str = "127.0.0.1", port: int = 0):
+        super().__init__((host, port), MockRequestHandler)
+        self.state = state
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "MockServer":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+def main():
+    parser = ArgumentParser(description="Serve a local stand-in for the OpenAI chat, files and batches endpoints")
+    parser.add_argument("--host", type=str, default="127.0.0.1",
+                        help="Host to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8000,
+                        help="Port to listen on (default: 8000)")
+    parser.add_argument("--latency", type=float, default=0.2,
+                        help="Mean latency of a chat completion in seconds (default: 0.2)")
+    parser.add_argument("--jitter", type=float, default=0.1,
+                        help="Standard deviation of the latency in seconds (default: 0.1)")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0,
+                        help="Share of chat completions answered with a 429 rate limit error (default: 0)")
+    parser.add_argument("--retry-after", type=float, default=1.0,
+                        help="Seconds in the retry-after header of the rate limit errors (default: 1)")
+    parser.add_argument("--batch-latency", type=float, default=5.0,
+                        help="Seconds until a submitted batch completes (default: 5)")
+    parser.add_argument("--enqueued-token-limit", type=int, default=None,
+                        help="Fail submitted batches with token_limit_exceeded above this many tokens in progress, counted as 4 bytes per token (default: no limit)")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Random seed of the latencies, rate limit errors and outputs")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    state = MockOpenAI(
+        args.latency, args.jitter, args.rate_limit_rate, args.retry_after, args.batch_latency, args.enqueued_token_limit
+    )
+    server = MockServer(state, args.host, args.port)
+    logging.info(f"Serving the mock OpenAI API at {server.base_url}, use OPENAI_BASE_URL={server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info(f"Stopped: {state.stats}")
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+from argparse import ArgumentParser
+from concurrent.futures import Future, ThreadPoolExecutor
+import logging
+import time
+from pathlib import Path
+from typing import Dict, Optional
+
+from openai import OpenAI
+from dotenv import load_dotenv
+load_dotenv()
+
+from api_mining.cli.retrieve_batch import retrieve_batch_results
+from api_mining.cli.submit_batch import submit_batch
+from api_mining.database.db import create_database_handler
+from api_mining.models.core import BatchStatus
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s %(levelname)s: %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+
+# provider statuses of batches that ended without results
+FAILED_PROVIDER_STATUSES = {"failed", "expired", "cancelled"}
+
+class BatchPoller:
+    """
+    Submits the created batches while their estimated tokens fit within the enqueued token limit, polls the submitted
+    batches with backoff, and retrieves the completed batches concurrently until all batches are done.
+    """
+    def __init__(
+        self,
+        client: OpenAI,
+        db_path: Path,
+        batch_dir: Path,
+        enqueued_token_limit: int = 2_000_000,
+        poll_interval: float = 30.0,
+        max_poll_interval: float = 600.0,
+        retrievers: int = 2,
+        chunk_size: int = 500,
+        max_resubmissions: int = 3,
+        max_retrievals: int = 3
+    ):
+        self.client = client
+        self.db = create_database_handler(db_path)
+        self.db_path = db_path
+        self.batch_dir = batch_dir
+        self.enqueued_token_limit = enqueued_token_limit
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.chunk_size = chunk_size
+        self.max_resubmissions = max_resubmissions
+        self.max_retrievals = max_retrievals
+        self.executor = ThreadPoolExecutor(max_workers=retrievers)
+        # when to poll each submitted batch next and the interval since its last poll
+        self.next_polls: Dict[int, float] = {}
+        self.intervals: Dict[int, float] = {}
+        self.retrievals: Dict[int, Future] = {}
+        # batches in flight when the provider last rejected a batch for the enqueued token limit
+        self.rejected_in_flight: Optional[int] = None
+        # times each batch was submitted again after a rejection for the enqueued token limit
+        self.resubmissions: Dict[int, int] = {}
+        # failed retrievals of each completed batch
+        self.failed_retrievals: Dict[int, int] = {}
+
+    def submit_batches(self) -> None:
+        """Submit the created batches in order while the tokens of the batches in flight stay within the limit."""
+        in_flight = self.db.get_batches([BatchStatus.SUBMITTED])
+        if self.rejected_in_flight is not None:
+            # wait for a batch to finish after a rejection
+            if len(in_flight) >= self.rejected_in_flight:
+                return
+            self.rejected_in_flight = None
+
+        enqueued_tokens = sum(batch.token_count for batch in in_flight)
+        for batch in self.db.get_batches([BatchStatus.CREATED]):
+            # a batch above the limit is submitted alone
+            if enqueued_tokens and enqueued_tokens + batch.token_count > self.enqueued_token_limit:
+                return
+            try:
+                submit_batch(batch.batch_index, self.db_path, self.batch_dir, force=True, client=self.client, db=self.db)
+            except Exception:
+                # retried at the next poll
+                return
+            enqueued_tokens += batch.token_count
+            self.next_polls[batch.batch_index] = time.monotonic() + self.poll_interval
+            self.intervals[batch.batch_index] = self.poll_interval
+
+    def poll_batch(self, batch_index: int, batch_id: str, provider_status: Optional[str]) -> None:
+        """Poll a submitted batch, retrieve it if completed and back off while its status is unchanged."""
+        try:
+            status = self.client.batches.retrieve(batch_id)
+        except Exception as e:
+            logging.error(f"Error polling batch {batch_index} ({batch_id}): {e}")
+            status = None
+
+        interval = self.intervals.get(batch_index, self.poll_interval)
+        if status is None or status.status == provider_status:
+            interval = min(interval * 2, self.max_poll_interval)
+        else:
+            interval = self.poll_interval
+            logging.info(f"Batch {batch_index} ({batch_id}) is {status.status}")
+
+        if status is not None and status.status == "completed":
+            self.retrievals[batch_index] = self.executor.submit(
+                retrieve_batch_results, batch_id, self.db_path, self.client, self.batch_dir, self.chunk_size
+            )
+        elif status is not None and status.status in FAILED_PROVIDER_STATUSES:
+            errors = [error.code for error in status.errors.data or []] if status.errors else []
+            in_flight = len(self.db.get_batches([BatchStatus.SUBMITTED])) - 1
+            resubmissions = self.resubmissions.get(batch_index, 0)
+            if "token_limit_exceeded" in errors and in_flight and resubmissions < self.max_resubmissions:
+                # the provider counted more enqueued tokens than estimated, submit the batch again after another finishes
+                logging.warning(
+                    f"Batch {batch_index} exceeded the enqueued token limit, it will be submitted again "
+                    f"({resubmissions + 1}/{self.max_resubmissions})"
+                )
+                self.db.update_batch(batch_index, BatchStatus.CREATED, status.status)
+                self.resubmissions[batch_index] = resubmissions + 1
+                self.rejected_in_flight = in_flight
+            elif "token_limit_exceeded" in errors:
+                reason = f"after {resubmissions} resubmissions" if in_flight else "alone in flight"
+                logging.error(
+                    f"Batch {batch_index} ({batch_id}) exceeded the enqueued token limit {reason}, marking it as failed"
+                )
+                self.db.update_batch(batch_index, BatchStatus.FAILED, status.status)
+            else:
+                logging.error(
+                    f"Batch {batch_index} ({batch_id}) {status.status}: {', '.join(errors) or 'no errors reported'}, "
+                    f"submit it again with api-mining-submit-batch --force"
+                )
+                self.db.update_batch(batch_index, BatchStatus.FAILED, status.status)
+        elif status is not None and status.status != provider_status:
+            self.db.update_batch(batch_index, BatchStatus.SUBMITTED, status.status)
+
+        self.intervals[batch_index] = interval
+        self.next_polls[batch_index] = time.monotonic() + interval
+
+    def check_retrieval(self, batch_index: int) -> None:
+        """Count a finished retrieval that left its batch submitted, and mark the batch failed after the last one."""
+        batch = self.db.get_batch(batch_index)
+        if batch.status != BatchStatus.SUBMITTED:
+            return
+        failed_retrievals = self.failed_retrievals.get(batch_index, 0) + 1
+        self.failed_retrievals[batch_index] = failed_retrievals
+        if failed_retrievals < self.max_retrievals:
+            # polled and retrieved again
+            logging.warning(f"Retrieval of batch {batch_index} failed, it will be retried ({failed_retrievals}/{self.max_retrievals})")
+            return
+        logging.error(
+            f"Retrieval of batch {batch_index} ({batch.batch_id}) failed {failed_retrievals} times, marking it as failed, "
+            f"retrieve it again with api-mining-retrieve-batch"
+        )
+        # only completed batches are retrieved
+        self.db.update_batch(batch_index, BatchStatus.FAILED, "completed")
+
+    def poll(self) -> bool:
+        """Submit, poll and retrieve the batches that are due; return whether any batch is left to process."""
+        for batch_index, retrieval in list(self.retrievals.items()):
+            if retrieval.done():
+                del self.retrievals[batch_index]
+                self.check_retrieval(batch_index)
+
+        self.submit_batches()
+
+        submitted = self.db.get_batches([BatchStatus.SUBMITTED])
+        submitted_indexes = {batch.batch_index for batch in submitted}
+        self.next_polls = {batch_index: next_poll for batch_index, next_poll in self.next_polls.items() if batch_index in submitted_indexes}
+        now = time.monotonic()
+        for batch in submitted:
+            if batch.batch_index not in self.retrievals and self.next_polls.get(batch.batch_index, now) <= now:
+                self.poll_batch(batch.batch_index, batch.batch_id, batch.provider_status)
+
+        return bool(submitted or self.retrievals or self.db.get_batches([BatchStatus.CREATED]))
+
+    def run(self) -> None:
+        """Poll until all batches are completed or failed."""
+        try:
+            while self.poll():
+                due = [next_poll for batch_index, next_poll in self.next_polls.items() if batch_index not in self.retrievals]
+                wait = min(due, default=time.monotonic() + self.poll_interval) - time.monotonic()
+                if self.retrievals:
+                    # check the retrievals at least once per second
+                    wait = min(wait, 1.0)
+                time.sleep(max(wait, 0.1))
+        finally:
+            self.executor.shutdown(wait=True)
+        logging.info("No batches left to submit or retrieve")
+
+def main():
+    parser = ArgumentParser(description="Submit, poll and retrieve the created batches until all are processed")
+    parser.add_argument("--db-path", type=Path, required=True,
+                        help="Path to the database")
+    parser.add_argument("--batch-dir", type=Path, required=True,
+                        help="Path to the batch directory")
+    parser.add_argument("--enqueued-token-limit", type=int, default=2_000_000,
+                        help="Maximum estimated tokens of the batches in flight, the enqueued token limit of the model (default: 2000000)")
+    parser.add_argument("--poll-interval", type=float, default=30.0,
+                        help="Seconds between polls of a batch after its status changes (default: 30)")
+    parser.add_argument("--max-poll-interval", type=float, default=600.0,
+                        help="Maximum seconds between polls of a batch, doubled from --poll-interval while its status is unchanged (default: 600)")
+    parser.add_argument("--retrievers", type=int, default=2,
+                        help="Number of completed batches retrieved concurrently (default: 2)")
+    parser.add_argument("--chunk-size", type=int, default=500,
+                        help="Number of movies stored per transaction (default: 500)")
+    parser.add_argument("--max-resubmissions", type=int, default=3,
+                        help="Times a batch rejected for the enqueued token limit is submitted again before it is marked as failed (default: 3)")
+    parser.add_argument("--max-retrievals", type=int, default=3,
+                        help="Times the results of a completed batch are retrieved before it is marked as failed (default: 3)")
+    args = parser.parse_args()
+
+    poller = BatchPoller(
+        OpenAI(),
+        args.db_path,
+        args.batch_dir,
+        args.enqueued_token_limit,
+        args.poll_interval,
+        args.max_poll_interval,
+        args.retrievers,
+        args.chunk_size,
+        args.max_resubmissions,
+        args.max_retrievals
+    )
+    poller.run()
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,30 @@
 from argparse import ArgumentParser
+import asyncio
+from contextlib import contextmanager
 import logging
+import os
+import random
+import socket
+import threading
+import uuid
 from pathlib import Path
+from typing import Dict, Generator, List, Optional, Tuple, Type
 
-from openai import OpenAI, RateLimitError
+from openai import APIConnectionError, AsyncOpenAI, InternalServerError, OpenAI, RateLimitError
+from pydantic import BaseModel
 from tqdm import tqdm
 from dotenv import load_dotenv
 load_dotenv()
 
 from api_mining.database.db import create_database_handler
-from api_mining.models.core import ProcessingStatus, MovieBase
+from api_mining.models.core import Character, ProcessingStatus, RequestUsage
 from api_mining.utils.common import (
     read_system_prompt,
-    construct_user_prompt,
-    get_plot_summary,
-    get_character_names
+    construct_request_prompt,
+    build_messages
 )
+from api_mining.utils.rate_limiter import RateLimiter
+from api_mining.utils.request_packer import PackedRequest, fan_out, pack_requests
 
 logging.basicConfig(
     level=logging.WARNING,
@@ -22,34 +32,90 @@ logging.basicConfig(
     datefmt='%Y-%m-%d %H:%M:%S'
 )
 
+# errors retried with backoff by AsyncChatProcessor: rate limits, connection errors and timeouts, and 5xx responses
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, InternalServerError)
+
+# renewals of the leases of the claimed movies per lease period
+LEASE_RENEWALS = 3
+
 class ChatProcessor:
     """Processes movies using the OpenAI chat API and updates the database."""
-    def __init__(self, client: OpenAI, db_path: Path, input_dir: Path):
+    def __init__(
+        self,
+        client: OpenAI,
+        db_path: Path,
+        input_dir: Path,
+        worker_id: Optional[str] = None,
+        lease_seconds: int = 600,
+        pack_size: int = 1,
+        pack_token_limit: int = 4000
+    ):
         self.client = client
         self.db = create_database_handler(db_path)
         self.input_dir = input_dir
         self.system_prompt = read_system_prompt(self.db.data_type)
+        self.packed_system_prompt = read_system_prompt(self.db.data_type, packed=True)
+        # identifies the movies claimed by this process among the processes sharing the database
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.lease_seconds = lease_seconds
+        self.pack_size = pack_size
+        self.pack_token_limit = pack_token_limit
+
+    def get_messages(self, movie_ids: List[str]) -> List[Dict[str, str]]:
+        """Build the chat messages of a request for one or several movies."""
+        system_prompt = self.packed_system_prompt if len(movie_ids) > 1 else self.system_prompt
+        return build_messages(system_prompt, construct_request_prompt(self.input_dir, movie_ids))
+
+    def get_response_format(self, movie_ids: List[str]) -> Type[BaseModel]:
+        """Get the response model of a request for one or several movies."""
+        return self.db.PackedCharacters if len(movie_ids) > 1 else self.db.Characters
+
+    def pack(self, claimed: List[Tuple[str, int]]) -> List[PackedRequest]:
+        """Pack claimed (movie_id, token_count) pairs into requests."""
+        return pack_requests(claimed, self.db.data_type, self.pack_size, self.pack_token_limit)
+
+    @contextmanager
+    def renewing_leases(self) -> Generator[None, None, None]:
+        """
+        Renew the leases of the claimed movies from a background thread, so that other workers don't reclaim
+        a movie while its request is still running or backing off.
+        """
+        stopped = threading.Event()
 
-    def process_movie(self, movie: MovieBase) -> bool:
-        """Process a single movie and update its character data in the database."""
+        def renew() -> None:
+            while not stopped.wait(self.lease_seconds / LEASE_RENEWALS):
+                try:
+                    self.db.renew_chat_leases(self.worker_id, self.lease_seconds)
+                except Exception as e:
+                    logging.error(f"Error renewing the leases of worker {self.worker_id}: {e}")
+
+        thread = threading.Thread(target=renew, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            thread.join()
+
+    def process_movies(self, movie_ids: List[str]) -> bool:
+        """Process the movies of a request and update their character data in the database."""
         try:
-            character_names = get_character_names(self.input_dir, movie.id)
-            plot_summary = get_plot_summary(self.input_dir, movie.id)
-            
             completion = self.client.beta.chat.completions.parse(
                 model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": self.system_prompt},
-                    {"role": "user", "content": construct_user_prompt(
-                        plot_summary=plot_summary,
-                        character_names=character_names
-                    )}
-                ],
-                response_format=self.db.Characters
+                messages=self.get_messages(movie_ids),
+                response_format=self.get_response_format(movie_ids)
             )
             
-            result = completion.choices[0].message.parsed
-            self.db.add_character_data(movie.id, result.characters)
+            results = fan_out(movie_ids, completion.choices[0].message.parsed)
+            usage = RequestUsage.from_usage(completion.usage.model_dump()).share(len(movie_ids)) if completion.usage else None
+            for movie_id, characters in results.items():
+                if characters is None:
+                    logging.error(f"Movie {movie_id} missing from the response")
+                    self.db.update_movie(movie_id=movie_id, status=ProcessingStatus.FAILED)
+                    continue
+                self.db.add_character_data(movie_id, characters)
+                if usage:
+                    self.db.record_usage({movie_id: usage})
             return True
 
         except RateLimitError:
@@ -57,32 +123,174 @@ class ChatProcessor:
             return False
         except KeyboardInterrupt:
             logging.error("Keyboard interrupt - stopping processing")
-            self.db.update_movie(
-                movie_id=movie.id,
-                status=ProcessingStatus.PENDING
-            )
+            for movie_id in movie_ids:
+                self.db.update_movie(
+                    movie_id=movie_id,
+                    status=ProcessingStatus.PENDING
+                )
             return False
         except Exception as e:
-            logging.error(f"Error processing movie {movie.id}: {e}")
-            self.db.update_movie(
-                movie_id=movie.id,
-                status=ProcessingStatus.FAILED
-            )
+            logging.error(f"Error processing movies {', '.join(movie_ids)}: {e}")
+            for movie_id in movie_ids:
+                self.db.update_movie(
+                    movie_id=movie_id,
+                    status=ProcessingStatus.FAILED
+                )
             return True
 
     def process_pending_movies(self) -> None:
-        """Process all movies with a pending status in the database."""
-        with self.db.get_session() as session:
-            pending_movies = self.db.get_pending_chat_movies()
-        
-            if not pending_movies:
-                logging.info("No pending movies to process")
+        """Claim and process pending movies until none are left."""
+        try:
+            with self.renewing_leases(), tqdm(desc="Processing movies", unit="movie") as progress:
+                stopped = False
+                while not stopped and (claimed := self.db.claim_chat_movies(self.worker_id, self.pack_size, self.lease_seconds)):
+                    for request in self.pack(claimed):
+                        if not self.process_movies(request.movie_ids):
+                            stopped = True
+                            break
+                        progress.update(len(request.movie_ids))
+        finally:
+            # the movies claimed but not processed are available to other workers again
+            self.db.release_chat_movies(self.worker_id)
+
+class AsyncChatProcessor(ChatProcessor):
+    """Processes movies concurrently with the async OpenAI client within RPM and TPM limits."""
+    def __init__(
+        self,
+        client: AsyncOpenAI,
+        db_path: Path,
+        input_dir: Path,
+        concurrency: int = 16,
+        rpm: int = 500,
+        tpm: int = 200_000,
+        max_retries: int = 8,
+        max_backoff: float = 60.0,
+        worker_id: Optional[str] = None,
+        lease_seconds: int = 600,
+        pack_size: int = 1,
+        pack_token_limit: int = 4000
+    ):
+        super().__init__(client, db_path, input_dir, worker_id, lease_seconds, pack_size, pack_token_limit)
+        self.concurrency = concurrency
+        self.rate_limiter = RateLimiter(rpm, tpm)
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+
+    async def request_characters(
+        self, request: PackedRequest
+    ) -> Tuple[Dict[str, Optional[List[Character]]], Optional[RequestUsage]]:
+        """
+        Request the characters of the movies of a request and the usage share of each movie,
+        backing off exponentially on rate limit, connection and server errors.
+        """
+        messages = self.get_messages(request.movie_ids)
+        for attempt in range(self.max_retries + 1):
+            await self.rate_limiter.acquire(request.token_count)
+            try:
+                completion = await self.client.beta.chat.completions.parse(
+                    model="gpt-4o-mini",
+                    messages=messages,
+                    response_format=self.get_response_format(request.movie_ids)
+                )
+                usage = RequestUsage.from_usage(completion.usage.model_dump()) if completion.usage else None
+                return (
+                    fan_out(request.movie_ids, completion.choices[0].message.parsed),
+                    usage.share(len(request.movie_ids)) if usage else None
+                )
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                # connection errors and timeouts have no response
+                response = getattr(e, "response", None)
+                retry_after = response.headers.get("retry-after") if response is not None else None
+                backoff = float(retry_after) if retry_after else min(self.max_backoff, 2 ** attempt)
+                delay = backoff * (1 + random.random())
+                logging.warning(f"{type(e).__name__} for request {request.custom_id}, retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    async def worker(self, requests: asyncio.Queue, results: asyncio.Queue) -> None:
+        """Process the requests from the queue and send the results of their movies to the writer."""
+        while True:
+            request = await requests.get()
+            try:
+                characters, usage = await self.request_characters(request)
+                for movie_id, movie_characters in characters.items():
+                    if movie_characters is None:
+                        logging.error(f"Movie {movie_id} missing from the response")
+                    await results.put((movie_id, movie_characters, usage))
+            except RETRYABLE_ERRORS as e:
+                # leave the movies pending for the next run
+                logging.error(f"{type(e).__name__} still raised for request {request.custom_id} after {self.max_retries} retries")
+            except Exception as e:
+                logging.error(f"Error processing movies {', '.join(request.movie_ids)}: {e}")
+                for movie_id in request.movie_ids:
+                    await results.put((movie_id, None, None))
+            finally:
+                requests.task_done()
+
+    async def writer(self, results: asyncio.Queue, progress: tqdm) -> None:
+        """Write the results to the database, the only task writing to it."""
+        while True:
+            # write all the results available in one transaction
+            pending = [await results.get()]
+            while not results.empty():
+                pending.append(results.get_nowait())
+
+            completed = [result for result in pending if result is not None and result[1] is not None]
+            failed = [result[0] for result in pending if result is not None and result[1] is None]
+            if completed:
+                await asyncio.to_thread(
+                    self.db.add_characters_bulk,
+                    [(movie_id, characters) for movie_id, characters, _ in completed],
+                    {movie_id: usage for movie_id, _, usage in completed if usage is not None}
+                )
+            for movie_id in failed:
+                await asyncio.to_thread(self.db.update_movie, movie_id=movie_id, status=ProcessingStatus.FAILED)
+            progress.update(len(completed) + len(failed))
+
+            if None in pending:
                 return
-                
-            for movie in tqdm(pending_movies, desc="Processing movies"):
-                session.add(movie)
-                if not self.process_movie(movie):
-                    break
+
+    async def claim_movies(self, requests: asyncio.Queue, writer: asyncio.Task) -> None:
+        """Keep the queue filled with requests of claimed movies until none are left to claim."""
+        while not writer.done():
+            if requests.qsize() < self.concurrency:
+                claimed = await asyncio.to_thread(
+                    self.db.claim_chat_movies, self.worker_id, self.concurrency * 2 * self.pack_size, self.lease_seconds
+                )
+                if not claimed:
+                    return
+                for request in self.pack(claimed):
+                    requests.put_nowait(request)
+            await asyncio.sleep(0.1)
+
+    async def process_pending_movies(self) -> None:
+        """Claim and process pending movies until none are left."""
+        requests = asyncio.Queue()
+        # bounded, so that the workers wait for the writer if it falls behind
+        results = asyncio.Queue(maxsize=self.concurrency * 4)
+
+        with self.renewing_leases(), tqdm(desc="Processing movies", unit="movie") as progress:
+            writer = asyncio.create_task(self.writer(results, progress))
+            workers = [asyncio.create_task(self.worker(requests, results)) for _ in range(self.concurrency)]
+            try:
+                await self.claim_movies(requests, writer)
+                # stop early if the writer fails
+                done = asyncio.create_task(requests.join())
+                await asyncio.wait([done, writer], return_when=asyncio.FIRST_COMPLETED)
+                done.cancel()
+            finally:
+                for worker in workers:
+                    worker.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+                # write the results received so far, also when interrupted
+                if not writer.done():
+                    await results.put(None)
+                try:
+                    await writer
+                finally:
+                    # the movies claimed but not processed are available to other workers again
+                    await asyncio.to_thread(self.db.release_chat_movies, self.worker_id)
 
 def main():
     parser = ArgumentParser(description="Process movies using chat (real-time) API")
@@ -90,10 +298,47 @@ def main():
                         help="Path to the database")
     parser.add_argument("--input-dir", type=Path, default=Path("./data/interim"), 
                         help="Path to the input directory (default: ./data/interim)")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="Number of concurrent requests, more than 1 uses the async client (default: 1)")
+    parser.add_argument("--rpm", type=int, default=500,
+                        help="Requests per minute limit of the async client (default: 500)")
+    parser.add_argument("--tpm", type=int, default=200_000,
+                        help="Tokens per minute limit of the async client, counted from the estimated token counts (default: 200000)")
+    parser.add_argument("--max-retries", type=int, default=8,
+                        help="Retries of a request on rate limit, connection and server errors with exponential backoff in async mode (default: 8)")
+    parser.add_argument("--worker-id", type=str, default=None,
+                        help="ID of this process in the database when several processes share it (default: host, PID and a random suffix)")
+    parser.add_argument("--lease-seconds", type=int, default=600,
+                        help="Seconds after which the movies claimed by a stopped process can be claimed by others (default: 600)")
+    parser.add_argument("--pack-size", type=int, default=1,
+                        help="Maximum number of movies per request, sharing one system prompt (default: 1, no packing)")
+    parser.add_argument("--pack-token-limit", type=int, default=4000,
+                        help="Maximum estimated tokens of a request packing several movies (default: 4000)")
     args = parser.parse_args()
 
+    if args.concurrency > 1:
+        # rate limit, connection and server errors are retried by AsyncChatProcessor
+        client = AsyncOpenAI(max_retries=0)
+        processor = AsyncChatProcessor(
+            client,
+            args.db_path,
+            args.input_dir,
+            concurrency=args.concurrency,
+            rpm=args.rpm,
+            tpm=args.tpm,
+            max_retries=args.max_retries,
+            worker_id=args.worker_id,
+            lease_seconds=args.lease_seconds,
+            pack_size=args.pack_size,
+            pack_token_limit=args.pack_token_limit
+        )
+        asyncio.run(processor.process_pending_movies())
+        return
+
     client = OpenAI()
-    processor = ChatProcessor(client, args.db_path, args.input_dir)
+    processor = ChatProcessor(
+        client, args.db_path, args.input_dir, args.worker_id, args.lease_seconds, args.pack_size, args.pack_token_limit
+    )
     processor.process_pending_movies()
 
 if __name__ == "__main__":
@@ -1,15 +1,19 @@
 from argparse import ArgumentParser
 import logging
 import json
+import re
 from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple, Type
 
 from openai import OpenAI
+from pydantic import BaseModel
+from tqdm import tqdm
 from dotenv import load_dotenv
 load_dotenv()
 
-from api_mining.models.core import ProcessingStatus
+from api_mining.models.core import Character, RequestUsage
 from api_mining.database.db import create_database_handler
-from api_mining.utils.common import get_batch_ids
+from api_mining.utils.request_packer import fan_out, split_custom_id
 
 logging.basicConfig(
     level=logging.INFO,
@@ -17,40 +21,131 @@ logging.basicConfig(
     datefmt='%Y-%m-%d %H:%M:%S'
 )
 
-def retrieve_batch_results(batch_id: str, db_path: Path, client: OpenAI) -> None:
+def download_output_file(client: OpenAI, file_id: str, output_path: Path) -> None:
+    """Stream a batch output file to disk, unless it was downloaded before."""
+    if output_path.exists():
+        return
+
+    tmp_path = output_path.with_suffix(".tmp")
+    with client.files.with_streaming_response.content(file_id) as response, tmp_path.open("wb") as f:
+        for chunk in response.iter_bytes():
+            f.write(chunk)
+    tmp_path.replace(output_path)
+
+def find_custom_id(line: bytes) -> Optional[str]:
+    """Find the custom_id of a result line that is not valid JSON, if it can be read."""
+    match = re.search(rb'"custom_id"\s*:\s*"([^"]+)"', line)
+    return match.group(1).decode() if match else None
+
+def read_error_movie_ids(error_path: Path) -> List[str]:
+    """Get the IDs of the movies of the requests listed in a batch error file."""
+    movie_ids = []
+    with error_path.open("rb") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                custom_id = json.loads(line)['custom_id']
+            except (ValueError, KeyError):
+                custom_id = find_custom_id(line)
+            if custom_id is None:
+                logging.error(f"Skipping malformed error line: {line[:200]!r}")
+                continue
+            movie_ids.extend(split_custom_id(custom_id))
+    return movie_ids
+
+def iter_result_chunks(
+    output_path: Path,
+    characters_model: Type[BaseModel],
+    packed_model: Type[BaseModel],
+    offset: int,
+    chunk_size: int
+) -> Iterator[Tuple[List[Tuple[str, Optional[List[Character]]]], Dict[str, RequestUsage], int]]:
+    """
+    Read the results from offset on, yield chunks of (movie_id, characters or None if invalid),
+    the token usage of the movies of the chunk and the offset after each chunk.
+    The results of requests packing several movies are fanned out to their movies.
+    """
+    chunk = []
+    usages = {}
+    with output_path.open("rb") as f:
+        f.seek(offset)
+        for line in f:
+            offset += len(line)
+            if not line.strip():
+                continue
+
+            try:
+                data = json.loads(line)
+            except ValueError as e:
+                custom_id = find_custom_id(line)
+                if custom_id is None:
+                    logging.error(f"Skipping malformed result line at byte {offset - len(line)}: {e}")
+                    continue
+                logging.error(f"Malformed result for movies {', '.join(split_custom_id(custom_id))}: {e}")
+                chunk.extend(dict.fromkeys(split_custom_id(custom_id)).items())
+                continue
+
+            movie_ids = split_custom_id(data['custom_id'])
+            try:
+                body = data['response']['body']
+                model = packed_model if len(movie_ids) > 1 else characters_model
+                results = fan_out(movie_ids, model.model_validate_json(body['choices'][0]['message']['content']))
+            except Exception as e:
+                logging.error(f"Error processing result for movies {', '.join(movie_ids)}: {e}")
+                results = dict.fromkeys(movie_ids)
+            else:
+                missing = [movie_id for movie_id, characters in results.items() if characters is None]
+                if missing:
+                    logging.error(f"Movies {', '.join(missing)} missing from the result of their request")
+                if body.get('usage'):
+                    usage = RequestUsage.from_usage(body['usage']).share(len(movie_ids))
+                    usages.update(dict.fromkeys(movie_ids, usage))
+
+            chunk.extend(results.items())
+            if len(chunk) >= chunk_size:
+                yield chunk, usages, offset
+                chunk = []
+                usages = {}
+
+    yield chunk, usages, offset
+
+def retrieve_batch_results(batch_id: str, db_path: Path, client: OpenAI, batch_dir: Path, chunk_size: int = 500) -> None:
     """Retrieve and process results for a completed batch from the OpenAI API."""
     db = create_database_handler(db_path)
 
     try:
+        offset, movie_count, completed = db.get_batch_ingestion(batch_id)
+        if completed:
+            logging.info(f"Results of batch {batch_id} already processed ({movie_count} movies)")
+            return
+
         status = client.batches.retrieve(batch_id)
         if status.status != "completed":
             logging.info(f"Batch {batch_id} not completed (status: {status.status})")
             return
-        
-        output_file = client.files.content(status.output_file_id)
-        content = output_file.text
-        
-        for line in content.splitlines():
-            try:
-                data = json.loads(line)
-                movie_id = data['custom_id']
-                response = json.loads(
-                    data['response']['body']['choices'][0]['message']['content']
-                )
-                
-                characters = db.Characters(**response)
-                db.add_character_data(movie_id, characters.characters)
-                db.update_movie(
-                    movie_id=movie_id,
-                    status=ProcessingStatus.COMPLETED
-                )
-                
-            except Exception as e:
-                logging.error(f"Error processing result for movie {movie_id}: {e}")
-                db.update_movie(
-                    movie_id=movie_id,
-                    status=ProcessingStatus.FAILED
-                )
+
+        # a batch of only failed requests has no output file
+        if status.output_file_id:
+            output_path = batch_dir / f"{batch_id}_output.jsonl"
+            download_output_file(client, status.output_file_id, output_path)
+
+            if offset:
+                logging.info(f"Resuming batch {batch_id} after {movie_count} movies")
+
+            # each chunk and the cursor after it are committed together, so a rerun continues after the last chunk
+            chunks = iter_result_chunks(output_path, db.Characters, db.PackedCharacters, offset, chunk_size)
+            for results, usages, offset in tqdm(chunks, desc="Processing result chunks"):
+                db.ingest_batch_results(batch_id, results, offset, usages=usages)
+
+        # the requests that failed at the provider are only listed in the error file
+        failed = []
+        if status.error_file_id:
+            error_path = batch_dir / f"{batch_id}_errors.jsonl"
+            download_output_file(client, status.error_file_id, error_path)
+            failed = [(movie_id, None) for movie_id in read_error_movie_ids(error_path)]
+            logging.error(f"{len(failed)} movies of batch {batch_id} failed, see {error_path}")
+        db.ingest_batch_results(batch_id, failed, offset, completed=True)
         
         logging.info(f"Processed results for batch {batch_id}")
         
@@ -65,18 +160,18 @@ def main():
                         help="Batch number to retrieve (indexed from 1)")
     parser.add_argument("--batch-dir", type=Path, required=True, 
                         help="Path to the batch directory")
+    parser.add_argument("--chunk-size", type=int, default=500,
+                        help="Number of movies stored per transaction (default: 500)")
     args = parser.parse_args()
     
-    batch_ids = get_batch_ids(args.batch_dir)
-    if args.batch_num > len(batch_ids) or not batch_ids[args.batch_num - 1]:
+    batch = create_database_handler(args.db_path).get_batch(args.batch_num)
+    if batch is None or not batch.batch_id:
         logging.error(f"No batch ID found for batch {args.batch_num}")
         return
-    
-    batch_id = batch_ids[args.batch_num - 1]
 
     client = OpenAI()
     
-    retrieve_batch_results(batch_id, args.db_path, client)
+    retrieve_batch_results(batch.batch_id, args.db_path, client, args.batch_dir, args.chunk_size)
 
 if __name__ == "__main__":
     main()
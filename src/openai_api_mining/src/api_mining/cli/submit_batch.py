@@ -1,14 +1,13 @@
 from argparse import ArgumentParser
 import logging
 from pathlib import Path
+from typing import Optional
 
 from openai import OpenAI
 from dotenv import load_dotenv
 load_dotenv()
 
-from api_mining.models.core import ProcessingStatus
-from api_mining.database.db import create_database_handler
-from api_mining.utils.common import get_batch_ids, save_batch_ids
+from api_mining.database.db import DatabaseHandler, create_database_handler
 
 logging.basicConfig(
     level=logging.INFO,
@@ -17,25 +16,29 @@ logging.basicConfig(
 )
 
 def submit_batch(
-    batch_file: Path, 
-    batch_num: int, 
+    batch_num: int,
     db_path: Path,
-    batch_dir: Path, 
-    force: bool = False
-) -> None:
-    """Submit a batch file for processing and update its status in the database."""
-    db = create_database_handler(db_path)
-    batch_ids = get_batch_ids(batch_dir)
-    
-    while len(batch_ids) < batch_num:
-        batch_ids.append(None)
+    batch_dir: Path,
+    force: bool = False,
+    client: Optional[OpenAI] = None,
+    db: Optional[DatabaseHandler] = None
+) -> Optional[str]:
+    """Submit a batch file for processing, record its ID and mark its movies as processing; return the batch ID."""
+    db = db or create_database_handler(db_path)
+    batch = db.get_batch(batch_num)
+    if batch is None:
+        raise ValueError(f"Batch {batch_num} not found in {db_path}, run api-mining-migrate-db for batches created by an earlier version")
 
-    if batch_ids[batch_num - 1] is not None and not force:
+    if batch.batch_id is not None and not force:
         logging.info(f"Batch {batch_num} already submitted")
-        return
+        return batch.batch_id
+
+    batch_file = batch_dir / f"batch_{batch_num}.jsonl"
+    if not batch_file.exists():
+        raise FileNotFoundError(f"Batch file not found: {batch_file}")
 
     try:
-        client = OpenAI()
+        client = client or OpenAI()
         
         with batch_file.open("rb") as f:
             batch_input_file = client.files.create(
@@ -43,18 +46,16 @@ def submit_batch(
                 purpose="batch"
             )
 
-        batch = client.batches.create(
+        submitted = client.batches.create(
             input_file_id=batch_input_file.id,
             endpoint="/v1/chat/completions",
             completion_window="24h"
         )
 
-        batch_ids[batch_num - 1] = batch.id
-        save_batch_ids(batch_dir, batch_ids)
+        db.submit_batch(batch_num, submitted.id)
         
-        db.update_batch_movies_status(batch_num, batch.id, ProcessingStatus.PROCESSING)
-        
-        logging.info(f"Submitted batch {batch_num} with ID: {batch.id}")
+        logging.info(f"Submitted batch {batch_num} with ID: {submitted.id}")
+        return submitted.id
 
     except Exception as e:
         logging.error(f"Failed to submit batch {batch_num}: {e}")
@@ -71,12 +72,8 @@ def main():
     parser.add_argument("-f", "--force", action="store_true", 
                         help="Force submission even if the batch is already submitted")
     args = parser.parse_args()
-    
-    batch_file = args.batch_dir / f"batch_{args.batch_num}.jsonl"
-    if not batch_file.exists():
-        raise FileNotFoundError(f"Batch file not found: {batch_file}")
 
-    submit_batch(batch_file, args.batch_num, args.db_path, args.batch_dir, args.force)
+    submit_batch(args.batch_num, args.db_path, args.batch_dir, args.force)
 
 if __name__ == "__main__":
     main()
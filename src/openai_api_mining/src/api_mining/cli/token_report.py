@@ -0,0 +1,36 @@
+from argparse import ArgumentParser
+from pathlib import Path
+
+from api_mining.database.db import create_database_handler
+from api_mining.utils.token_usage import estimate_errors, summarize_usage
+
+def token_report(db_path: Path) -> None:
+    """Print the reported against estimated tokens and the prompt cache hits of the processed movies."""
+    db = create_database_handler(db_path)
+    rows = db.get_token_usage()
+    if not rows:
+        print("No movies with recorded usage")
+        return
+
+    for method, summary in summarize_usage(rows).items():
+        print(
+            f"{method}: {summary.movies} movies, {summary.estimated_tokens} estimated tokens, "
+            f"{summary.prompt_tokens} prompt tokens ({summary.prompt_ratio:.3f} per estimated token), "
+            f"{summary.cached_tokens} cached ({summary.cache_hit_rate:.1%} cache hits), "
+            f"{summary.completion_tokens} completion tokens"
+        )
+
+    errors = estimate_errors(rows)
+    percentiles = {name: errors[min(int(q * len(errors)), len(errors) - 1)] for name, q in [("p10", 0.1), ("p50", 0.5), ("p90", 0.9)]}
+    print("Estimate error per movie: " + ", ".join(f"{name} {error:+.1%}" for name, error in percentiles.items()))
+
+def main():
+    parser = ArgumentParser(description="Compare the tokens reported by the API with the estimated token counts")
+    parser.add_argument("--db-path", type=Path, required=True,
+                        help="Path to the database")
+    args = parser.parse_args()
+
+    token_report(args.db_path)
+
+if __name__ == "__main__":
+    main()
@@ -1,51 +1,122 @@
 from abc import ABC, abstractmethod
 from enum import Enum
 from contextlib import contextmanager
-from datetime import datetime
+from datetime import datetime, timedelta
 from pathlib import Path
-from typing import List, Optional, Generator, Type, TypeVar, Generic
+from itertools import islice
+from typing import Any, Dict, Iterable, List, Optional, Generator, Tuple, Type, TypeVar, Generic
 
 from pydantic import BaseModel
+from sqlalchemy import Connection, Index, Table, case, delete, event, inspect, insert, or_, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateColumn
 from sqlmodel import Session, select, create_engine, SQLModel, func
 
 from api_mining.models.core import (
+    Batch,
+    BatchIngestion,
+    BatchStatus,
     DatabaseMetadata,
     DataType,
     ProcessingMethod,
     ProcessingStatus,
     MetadataStatus,
     MovieBase,
-    Character
+    Character,
+    RequestUsage
 )
 
 from api_mining.models.char_deaths import (
     DeathCharacter,
     DeathCharacters,
     DeathCharacterDB,
-    DeathMovie
+    DeathMovie,
+    PackedDeathCharacters
 )
 
 from api_mining.models.tropes import (
     TropeCharacter,
     TropeCharacters,
     TropeCharacterDB,
-    TropeMovie
+    TropeMovie,
+    PackedTropeCharacters
 )
 
 M = TypeVar('M', bound=MovieBase)
 C = TypeVar('C', bound=Character)
 CDB = TypeVar('CDB', bound=SQLModel)
 
+# Below SQLite's default limit of 32766 bound parameters per statement
+MAX_IN_PARAMS = 10000
+
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",       # readers don't block the writer
+    "synchronous": "NORMAL",     # safe with WAL, fsync only at checkpoints
+    "cache_size": -64000,        # 64 MB page cache
+    "temp_store": "MEMORY",
+}
+
+def set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    """Apply SQLITE_PRAGMAS to each new connection."""
+    cursor = dbapi_connection.cursor()
+    for pragma, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {pragma}={value}")
+    cursor.close()
+
+def add_missing_columns(connection: Connection, table: Table) -> None:
+    """Add the nullable columns of the model that are missing from an existing table."""
+    existing_columns = {column["name"] for column in inspect(connection).get_columns(table.name)}
+    for column in table.columns:
+        if column.name not in existing_columns and column.nullable:
+            column_definition = CreateColumn(column).compile(dialect=connection.dialect)
+            connection.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {column_definition}")
+
+def add_missing_indexes(connection: Connection, table: Table) -> List[str]:
+    """Create the indexes of a table missing from the database, return their names."""
+    existing = {index["name"] for index in inspect(connection).get_indexes(table.name)}
+    created = []
+    for index in sorted(table.indexes, key=lambda index: index.name):
+        if index.name not in existing:
+            index.create(connection)
+            created.append(index.name)
+    return created
+
+def get_unique_character_index(table: Table) -> Index:
+    """Get the unique (movie_id, name) index of a character table."""
+    return next(index for index in table.indexes if index.unique)
+
 class DatabaseHandler(ABC, Generic[M, C, CDB]):
     """Abstract base class for managing database operations for movies and characters."""
-    def __init__(self, db_path: Path):
+    def __init__(self, db_path: Path, create_unique_index: bool = True):
         """Initialize the database handler with the given database path."""
         self.engine = create_engine(f"sqlite:///{db_path}")
-
-        SQLModel.metadata.create_all(
-            self.engine, 
-            tables=[DatabaseMetadata.__table__, self.Movie.__table__, self.CharacterDB.__table__]
-        )
+        event.listen(self.engine, "connect", set_sqlite_pragmas)
+
+        # processes opening the same database set up the schema one at a time
+        with self.engine.connect() as connection:
+            connection.exec_driver_sql("BEGIN IMMEDIATE")
+            SQLModel.metadata.create_all(
+                connection, 
+                tables=[
+                    DatabaseMetadata.__table__,
+                    Batch.__table__,
+                    BatchIngestion.__table__,
+                    self.Movie.__table__,
+                    self.CharacterDB.__table__
+                ]
+            )
+            add_missing_columns(connection, self.Movie.__table__)
+
+            if create_unique_index:
+                # databases created before the index was added may contain duplicate characters
+                try:
+                    get_unique_character_index(self.CharacterDB.__table__).create(connection, checkfirst=True)
+                except IntegrityError as e:
+                    raise ValueError(
+                        f"Duplicate characters in {db_path}, run api-mining-dedupe-characters on the database first"
+                    ) from e
+            connection.commit()
 
     @contextmanager
     def get_session(self) -> Generator[Session, None, None]:
@@ -65,6 +136,74 @@ class DatabaseHandler(ABC, Generic[M, C, CDB]):
         """Add character data to the database."""
         pass
 
+    def character_rows(self, movie_id: str, characters: List[C]) -> List[Dict[str, Any]]:
+        """Convert characters to rows of the character table."""
+        return [{"movie_id": movie_id, **character.model_dump()} for character in characters]
+
+    def upsert_characters(self, session: Session, rows: List[Dict[str, Any]]) -> None:
+        """Insert character rows with one executemany, updating the characters already stored for a movie."""
+        if not rows:
+            return
+        statement = sqlite_insert(self.CharacterDB)
+        statement = statement.on_conflict_do_update(
+            index_elements=["movie_id", "name"],
+            set_={
+                column.name: statement.excluded[column.name]
+                for column in self.CharacterDB.__table__.columns
+                if column.name not in ("id", "movie_id", "name")
+            }
+        )
+        session.execute(statement, rows)
+
+    def add_characters_bulk(self, results: List[Tuple[str, List[C]]], usages: Optional[Dict[str, RequestUsage]] = None) -> None:
+        """Add the characters of several movies and their token usage in one transaction and mark the movies as completed."""
+        with self.get_session() as session:
+            self.record_usage(usages or {}, session)
+            self.upsert_characters(session, [
+                row for movie_id, characters in results for row in self.character_rows(movie_id, characters)
+            ])
+            movie_ids = [movie_id for movie_id, _ in results]
+            for start in range(0, len(movie_ids), MAX_IN_PARAMS):
+                session.execute(update(self.Movie).where(
+                    self.Movie.id.in_(movie_ids[start:start + MAX_IN_PARAMS])
+                ).values(processed_status=ProcessingStatus.COMPLETED, last_updated=datetime.utcnow()))
+
+    def record_usage(self, usages: Dict[str, RequestUsage], session: Optional[Session] = None) -> None:
+        """Store the token usage reported for the requests of movies, in the given session's transaction if any."""
+        if session is None:
+            with self.get_session() as session:
+                return self.record_usage(usages, session)
+
+        if usages:
+            # bulk UPDATE by primary key with one executemany
+            session.execute(update(self.Movie), [
+                {"id": movie_id, **usage.model_dump()} for movie_id, usage in usages.items()
+            ])
+
+    def get_token_usage(self, packed: bool = True) -> List[Tuple[Optional[ProcessingMethod], int, int, int, int]]:
+        """
+        Get (processing_method, estimated tokens, prompt_tokens, cached_tokens, completion_tokens) of the movies with
+        recorded usage, without the movies that shared their request with others if not packed.
+        """
+        statement = select(
+            self.Movie.processing_method,
+            self.Movie.token_count,
+            self.Movie.prompt_tokens,
+            self.Movie.cached_tokens,
+            self.Movie.completion_tokens
+        ).where(self.Movie.prompt_tokens.is_not(None))
+        if not packed:
+            statement = statement.where(or_(self.Movie.pack_size.is_(None), self.Movie.pack_size == 1))
+        with self.get_session() as session:
+            return [tuple(row) for row in session.exec(statement)]
+
+    def dedupe_characters(self) -> int:
+        """Keep only the latest row of each (movie_id, name) character, return the number of rows removed."""
+        table = self.CharacterDB.__table__
+        latest_ids = select(func.max(table.c.id)).group_by(table.c.movie_id, table.c.name)
+        with self.get_session() as session:
+            return session.execute(delete(table).where(table.c.id.not_in(latest_ids))).rowcount
+
     @property
     @abstractmethod
     def Movie(self) -> Type[M]:
@@ -83,6 +222,12 @@ class DatabaseHandler(ABC, Generic[M, C, CDB]):
         """Characters container model for this handler"""
         pass
 
+    @property
+    @abstractmethod
+    def PackedCharacters(self) -> Type[BaseModel]:
+        """Characters of each movie of a packed request for this handler"""
+        pass
+
     @property
     @abstractmethod
     def CharacterDB(self) -> Type[CDB]:
@@ -115,6 +260,18 @@ class DatabaseHandler(ABC, Generic[M, C, CDB]):
             )
             session.add(movie)
 
+    def add_movies_bulk(self, movies: Iterable[Dict[str, Any]], chunk_size: int = 10000) -> int:
+        """Insert movies given as dicts of Movie fields with one executemany and one transaction per chunk, return the number of rows."""
+        movies = iter(movies)
+        count = 0
+        while chunk := list(islice(movies, chunk_size)):
+            now = datetime.utcnow()
+            rows = [{"last_updated": now, **movie} for movie in chunk]
+            with self.get_session() as session:
+                session.execute(insert(self.Movie), rows)
+            count += len(rows)
+        return count
+
     def get_pending_chat_movies(self, limit: Optional[int] = None) -> List[M]:
         """Retrieve pending movies for chat processing."""
         with self.get_session() as session:
@@ -135,6 +292,54 @@ class DatabaseHandler(ABC, Generic[M, C, CDB]):
             ).order_by(self.Movie.last_updated).limit(1)
             return session.exec(statement).first()
 
+    def claim_chat_movies(self, worker_id: str, limit: int, lease_seconds: int = 600) -> List[Tuple[str, int]]:
+        """Atomically claim up to limit pending chat movies or movies whose lease expired, return their (id, token_count)."""
+        now = datetime.utcnow()
+        claimable = select(self.Movie.id).where(
+            self.Movie.processing_method == ProcessingMethod.CHAT,
+            or_(
+                self.Movie.processed_status == ProcessingStatus.PENDING,
+                # recover the movies of workers that stopped without releasing them
+                (self.Movie.processed_status == ProcessingStatus.PROCESSING) & (self.Movie.lease_expires < now)
+            )
+        ).order_by(self.Movie.last_updated).limit(limit).with_for_update(skip_locked=True)
+
+        statement = update(self.Movie).where(
+            self.Movie.id.in_(claimable.scalar_subquery())
+        ).values(
+            processed_status=ProcessingStatus.PROCESSING,
+            worker_id=worker_id,
+            lease_expires=now + timedelta(seconds=lease_seconds),
+            last_updated=now
+        ).returning(self.Movie.id, self.Movie.token_count)
+
+        with self.get_session() as session:
+            return [tuple(row) for row in session.execute(statement)]
+
+    def renew_chat_leases(self, worker_id: str, lease_seconds: int = 600) -> int:
+        """Extend the lease of the movies still claimed by a worker, return the number of movies."""
+        statement = update(self.Movie).where(
+            self.Movie.worker_id == worker_id,
+            self.Movie.processed_status == ProcessingStatus.PROCESSING
+        ).values(
+            lease_expires=datetime.utcnow() + timedelta(seconds=lease_seconds)
+        )
+        with self.get_session() as session:
+            return session.execute(statement).rowcount
+
+    def release_chat_movies(self, worker_id: str) -> int:
+        """Return the movies still claimed by a worker to pending, return the number of movies."""
+        statement = update(self.Movie).where(
+            self.Movie.worker_id == worker_id,
+            self.Movie.processed_status == ProcessingStatus.PROCESSING
+        ).values(
+            processed_status=ProcessingStatus.PENDING,
+            lease_expires=None,
+            last_updated=datetime.utcnow()
+        )
+        with self.get_session() as session:
+            return session.execute(statement).rowcount
+
     def update_movie(
         self, 
         movie_id: str,
@@ -165,22 +370,192 @@ class DatabaseHandler(ABC, Generic[M, C, CDB]):
 
             movie.last_updated = datetime.utcnow()
 
+    def assign_batch(self, movie_ids: List[str], batch_index: int, session: Optional[Session] = None) -> int:
+        """Assign movies to a batch with set-based UPDATEs in one transaction, or in the given session's transaction; return the number of rows."""
+        if session is None:
+            with self.get_session() as session:
+                return self.assign_batch(movie_ids, batch_index, session)
+
+        count = 0
+        now = datetime.utcnow()
+        for start in range(0, len(movie_ids), MAX_IN_PARAMS):
+            statement = update(self.Movie).where(
+                self.Movie.id.in_(movie_ids[start:start + MAX_IN_PARAMS])
+            ).values(
+                processing_method=ProcessingMethod.BATCH,
+                batch_index=batch_index,
+                last_updated=now
+            )
+            count += session.execute(statement).rowcount
+        return count
+
     def update_batch_movies_status(
         self,
         batch_num: int,
         batch_id: str,
-        status: ProcessingStatus
+        status: ProcessingStatus,
+        session: Optional[Session] = None
     ) -> None:
-        """Update the processing status of all movies in a batch."""
+        """Update the processing status of all movies in a batch, in the given session's transaction if any."""
+        if session is None:
+            with self.get_session() as session:
+                return self.update_batch_movies_status(batch_num, batch_id, status, session)
+
+        statement = select(self.Movie).where(
+            self.Movie.batch_index == batch_num
+        )
+        movies = session.exec(statement)
+        for movie in movies:
+            movie.batch_id = batch_id
+            movie.processed_status = status
+            movie.last_updated = datetime.utcnow()
+
+    def add_batch(self, batch_index: int, movie_count: int, token_count: int, session: Optional[Session] = None) -> None:
+        """Add the record of a created batch, in the given session's transaction if any."""
+        if session is None:
+            with self.get_session() as session:
+                return self.add_batch(batch_index, movie_count, token_count, session)
+
+        session.add(Batch(batch_index=batch_index, movie_count=movie_count, token_count=token_count))
+
+    def get_batch(self, batch_index: int) -> Optional[Batch]:
+        """Get the record of a batch by its number."""
         with self.get_session() as session:
-            statement = select(self.Movie).where(
-                self.Movie.batch_index == batch_num
-            )
-            movies = session.exec(statement)
-            for movie in movies:
-                movie.batch_id = batch_id
-                movie.processed_status = status
-                movie.last_updated = datetime.utcnow()
+            batch = session.get(Batch, batch_index)
+            if batch is not None:
+                # detached before the commit expires it
+                session.expunge(batch)
+            return batch
+
+    def get_batches(self, statuses: Optional[List[BatchStatus]] = None) -> List[Batch]:
+        """Get the records of the batches with the given statuses (all if None), in batch order."""
+        with self.get_session() as session:
+            statement = select(Batch).order_by(Batch.batch_index)
+            if statuses is not None:
+                statement = statement.where(Batch.status.in_(statuses))
+            batches = list(session.exec(statement))
+            session.expunge_all()
+            return batches
+
+    def submit_batch(self, batch_index: int, batch_id: str) -> None:
+        """Record the submission of a batch and mark its movies as processing in one transaction."""
+        with self.get_session() as session:
+            batch = session.get(Batch, batch_index)
+            now = datetime.utcnow()
+            batch.batch_id = batch_id
+            batch.status = BatchStatus.SUBMITTED
+            batch.provider_status = None
+            batch.submitted_at = now
+            batch.last_updated = now
+            self.update_batch_movies_status(batch_index, batch_id, ProcessingStatus.PROCESSING, session)
+
+    def update_batch(self, batch_index: int, status: BatchStatus, provider_status: Optional[str] = None) -> None:
+        """Update the status of a batch and the last status reported by the provider."""
+        with self.get_session() as session:
+            batch = session.get(Batch, batch_index)
+            batch.status = status
+            batch.provider_status = provider_status
+            batch.last_updated = datetime.utcnow()
+
+    def add_missing_batches(self, batch_ids: Optional[List[Optional[str]]] = None) -> int:
+        """
+        Add the records of the batches created by an earlier version from the batches of their movies, with the IDs of
+        the batch ID log (batch_ids.json) if given. Return the number of batches added.
+        """
+        unfinished = self.Movie.processed_status.in_([ProcessingStatus.PENDING, ProcessingStatus.PROCESSING])
+        with self.get_session() as session:
+            existing = set(session.exec(select(Batch.batch_index)))
+            # earlier versions stored the estimated tokens of the whole batch as the token count of each of its movies
+            statement = select(
+                self.Movie.batch_index,
+                func.count(),
+                func.max(self.Movie.token_count),
+                func.max(self.Movie.batch_id),
+                func.sum(case((unfinished, 1), else_=0))
+            ).where(self.Movie.batch_index.is_not(None)).group_by(self.Movie.batch_index)
+
+            added = 0
+            for batch_index, movie_count, token_count, movie_batch_id, unfinished_count in session.exec(statement):
+                if batch_index in existing:
+                    continue
+                logged_id = batch_ids[batch_index - 1] if batch_ids and batch_index <= len(batch_ids) else None
+                batch_id = logged_id or movie_batch_id
+                # earlier versions did not record the ingestion of the retrieved batches
+                ingestion = session.get(BatchIngestion, batch_id) if batch_id else None
+                if not unfinished_count or (ingestion is not None and ingestion.completed):
+                    status = BatchStatus.COMPLETED
+                else:
+                    status = BatchStatus.SUBMITTED if batch_id else BatchStatus.CREATED
+                session.add(Batch(
+                    batch_index=batch_index,
+                    batch_id=batch_id,
+                    status=status,
+                    movie_count=movie_count,
+                    token_count=token_count
+                ))
+                added += 1
+            return added
+
+    def get_batch_ingestion(self, batch_id: str) -> Tuple[int, int, bool]:
+        """Get the (offset, movie count, completed) cursor of a batch output file ingestion."""
+        with self.get_session() as session:
+            ingestion = session.get(BatchIngestion, batch_id)
+            if ingestion is None:
+                return 0, 0, False
+            return ingestion.offset, ingestion.movie_count, ingestion.completed
+
+    def ingest_batch_results(
+        self,
+        batch_id: str,
+        results: List[Tuple[str, Optional[List[C]]]],
+        offset: int,
+        completed: bool = False,
+        usages: Optional[Dict[str, RequestUsage]] = None
+    ) -> None:
+        """
+        Store the characters of a chunk of batch results (None for failed movies) and their token usage, and advance
+        the batch cursor to offset, all in one transaction. Existing characters of the movies are replaced, so a chunk can be ingested again.
+        Completing the batch fails its movies still processing.
+        """
+        now = datetime.utcnow()
+        movie_ids = [movie_id for movie_id, _ in results]
+        completed_ids = [movie_id for movie_id, characters in results if characters is not None]
+        failed_ids = [movie_id for movie_id, characters in results if characters is None]
+        character_rows = [
+            row for movie_id, characters in results if characters is not None
+            for row in self.character_rows(movie_id, characters)
+        ]
+
+        with self.get_session() as session:
+            for start in range(0, len(movie_ids), MAX_IN_PARAMS):
+                session.execute(delete(self.CharacterDB).where(
+                    self.CharacterDB.movie_id.in_(movie_ids[start:start + MAX_IN_PARAMS])
+                ))
+            self.upsert_characters(session, character_rows)
+
+            for ids, status in [(completed_ids, ProcessingStatus.COMPLETED), (failed_ids, ProcessingStatus.FAILED)]:
+                for start in range(0, len(ids), MAX_IN_PARAMS):
+                    session.execute(update(self.Movie).where(
+                        self.Movie.id.in_(ids[start:start + MAX_IN_PARAMS])
+                    ).values(processed_status=status, last_updated=now))
+            self.record_usage(usages or {}, session)
+
+            ingestion = session.get(BatchIngestion, batch_id) or BatchIngestion(batch_id=batch_id)
+            ingestion.offset = offset
+            ingestion.movie_count += len(results)
+            ingestion.completed = completed
+            ingestion.last_updated = now
+            session.add(ingestion)
+
+            if completed:
+                # movies without a readable result or error line are failed rather than left processing
+                session.execute(update(self.Movie).where(
+                    self.Movie.batch_id == batch_id,
+                    self.Movie.processed_status == ProcessingStatus.PROCESSING
+                ).values(processed_status=ProcessingStatus.FAILED, last_updated=now))
+                session.execute(update(Batch).where(Batch.batch_id == batch_id).values(
+                    status=BatchStatus.COMPLETED, provider_status="completed", last_updated=now
+                ))
 
     def get_batch_count(self) -> int:
         """Get the total number of batches in the database."""
@@ -203,6 +578,10 @@ class DeathsDatabaseHandler(DatabaseHandler[DeathMovie, DeathCharacter, DeathCha
     def Characters(self) -> Type[DeathCharacters]:
         return DeathCharacters
 
+    @property
+    def PackedCharacters(self) -> Type[PackedDeathCharacters]:
+        return PackedDeathCharacters
+
     @property
     def CharacterDB(self) -> Type[DeathCharacterDB]:
         return DeathCharacterDB
@@ -218,13 +597,7 @@ class DeathsDatabaseHandler(DatabaseHandler[DeathMovie, DeathCharacter, DeathCha
             if not movie:
                 raise ValueError(f"Movie {movie_id} not found")
             
-            for char in characters:
-                character_db = DeathCharacterDB(
-                    movie_id=movie_id,
-                    name=char.name,
-                    dies=char.dies
-                )
-                session.add(character_db)
+            self.upsert_characters(session, self.character_rows(movie_id, characters))
             
             movie.processed_status = ProcessingStatus.COMPLETED
             movie.last_updated = datetime.utcnow()
@@ -243,6 +616,10 @@ class TropesDatabaseHandler(DatabaseHandler[TropeMovie, TropeCharacter, TropeCha
     def Characters(self) -> Type[TropeCharacters]:
         return TropeCharacters
 
+    @property
+    def PackedCharacters(self) -> Type[PackedTropeCharacters]:
+        return PackedTropeCharacters
+
     @property
     def CharacterDB(self) -> Type[TropeCharacterDB]:
         return TropeCharacterDB
@@ -258,18 +635,12 @@ class TropesDatabaseHandler(DatabaseHandler[TropeMovie, TropeCharacter, TropeCha
             if not movie:
                 raise ValueError(f"Movie {movie_id} not found")
             
-            for char in characters:
-                character_db = TropeCharacterDB(
-                    movie_id=movie_id,
-                    name=char.name,
-                    trope=char.trope
-                )
-                session.add(character_db)
+            self.upsert_characters(session, self.character_rows(movie_id, characters))
             
             movie.processed_status = ProcessingStatus.COMPLETED
             movie.last_updated = datetime.utcnow()
 
-def create_database_handler(db_path: Path) -> DatabaseHandler:
+def create_database_handler(db_path: Path, create_unique_index: bool = True) -> DatabaseHandler:
     """Create appropriate database handler based on database metadata"""
     engine = create_engine(f"sqlite:///{db_path}")
     
@@ -286,4 +657,4 @@ def create_database_handler(db_path: Path) -> DatabaseHandler:
         if not handler_class:
             raise ValueError(f"Unknown data type in database: {metadata.data_type}")
         
-        return handler_class(db_path)
+        return handler_class(db_path, create_unique_index)
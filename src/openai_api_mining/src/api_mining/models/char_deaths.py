@@ -1,6 +1,7 @@
 from typing import List, Optional
 
 from pydantic import BaseModel
+from sqlalchemy import Index
 from sqlmodel import Relationship, SQLModel, Field
 
 from api_mining.models.core import MovieBase, Character
@@ -13,6 +14,15 @@ class DeathCharacters(BaseModel):
     """Contains a list of characters and their death statuses."""
     characters: List[DeathCharacter]
 
+class MovieDeathCharacters(BaseModel):
+    """Contains the characters of one movie of a packed request, keyed by the movie ID."""
+    movie_id: str
+    characters: List[DeathCharacter]
+
+class PackedDeathCharacters(BaseModel):
+    """Contains the characters of each movie of a request packing several movies."""
+    movies: List[MovieDeathCharacters]
+
 class DeathMovie(MovieBase, table=True):
     """Represents a movie with associated characters and their death statuses."""
     characters: Optional[List["DeathCharacterDB"]] = Relationship(
@@ -23,6 +33,8 @@ class DeathMovie(MovieBase, table=True):
 class DeathCharacterDB(SQLModel, table=True):
     """Database model for character death information."""
     __tablename__ = "character_deaths"
+    # one row per character of a movie, re-adding a character updates it
+    __table_args__ = (Index("ux_character_deaths_movie_id_name", "movie_id", "name", unique=True),)
     id: Optional[int] = Field(default=None, primary_key=True)
     movie_id: str = Field(foreign_key="deathmovie.id", index=True)
     name: str
@@ -1,8 +1,10 @@
 from datetime import datetime
 from enum import Enum
-from typing import Optional
+from typing import Any, Dict, Optional
 
 from pydantic import BaseModel
+from sqlalchemy import Index
+from sqlalchemy.orm import declared_attr
 from sqlmodel import Field, SQLModel
 
 class DataType(str, Enum):
@@ -21,6 +23,13 @@ class ProcessingMethod(str, Enum):
     BATCH = "batch"
     CHAT = "chat"
 
+class BatchStatus(str, Enum):
+    """Lifecycle status of a batch"""
+    CREATED = "created"
+    SUBMITTED = "submitted"
+    COMPLETED = "completed"
+    FAILED = "failed"
+
 class MetadataStatus(str, Enum):
     """Status of movie character metadata"""
     COMPLETE = "complete"
@@ -41,9 +50,76 @@ class MovieBase(SQLModel):
     batch_index: Optional[int] = None
     token_count: int = Field(default=0)
     last_updated: datetime = Field(default_factory=datetime.utcnow)
+    worker_id: Optional[str] = None
+    lease_expires: Optional[datetime] = None
+    # usage reported by the API for the request of the movie
+    prompt_tokens: Optional[int] = None
+    cached_tokens: Optional[int] = None
+    completion_tokens: Optional[int] = None
+    # movies sharing that request and its usage
+    pack_size: Optional[int] = None
+
+    @declared_attr
+    def __table_args__(cls):
+        """Indexes of the status queries, named after the table of each data type"""
+        return (
+            # pending and claimable chat movies in last_updated order
+            Index(f"ix_{cls.__tablename__}_method_status_updated", "processing_method", "processed_status", "last_updated"),
+            # movies of a batch and the batch count
+            Index(f"ix_{cls.__tablename__}_batch_index", "batch_index"),
+            # movies claimed by a worker
+            Index(f"ix_{cls.__tablename__}_worker_status", "worker_id", "processed_status"),
+        )
+
+class RequestUsage(BaseModel):
+    """Tokens reported by the API for the request of a movie"""
+    prompt_tokens: int
+    cached_tokens: int = 0
+    completion_tokens: int
+    pack_size: int = 1
+
+    @classmethod
+    def from_usage(cls, usage: Dict[str, Any]) -> "RequestUsage":
+        """Read the usage object of a chat completion"""
+        details = usage.get("prompt_tokens_details") or {}
+        return cls(
+            prompt_tokens=usage["prompt_tokens"],
+            cached_tokens=details.get("cached_tokens") or 0,
+            completion_tokens=usage["completion_tokens"]
+        )
+
+    def share(self, movie_count: int) -> "RequestUsage":
+        """Even share of each movie of a request packing several movies"""
+        return RequestUsage(
+            prompt_tokens=self.prompt_tokens // movie_count,
+            cached_tokens=self.cached_tokens // movie_count,
+            completion_tokens=self.completion_tokens // movie_count,
+            pack_size=movie_count
+        )
 
 class DatabaseMetadata(SQLModel, table=True):
     """Metadata for database type and creation time"""
     id: str = Field(default="metadata", primary_key=True)
     data_type: DataType
     created_at: datetime = Field(default_factory=datetime.utcnow)
+
+class BatchIngestion(SQLModel, table=True):
+    """Resume cursor of the ingestion of a batch output file"""
+    batch_id: str = Field(primary_key=True)
+    offset: int = Field(default=0)
+    movie_count: int = Field(default=0)
+    completed: bool = Field(default=False)
+    last_updated: datetime = Field(default_factory=datetime.utcnow)
+
+class Batch(SQLModel, table=True):
+    """Batch file, its ID at the provider and its lifecycle status"""
+    batch_index: int = Field(primary_key=True)
+    batch_id: Optional[str] = Field(default=None, index=True)
+    status: BatchStatus = Field(default=BatchStatus.CREATED)
+    # last status reported by the provider
+    provider_status: Optional[str] = None
+    movie_count: int = Field(default=0)
+    token_count: int = Field(default=0)
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    submitted_at: Optional[datetime] = None
+    last_updated: datetime = Field(default_factory=datetime.utcnow)
@@ -2,6 +2,7 @@ from enum import Enum
 from typing import List, Optional
 
 from pydantic import BaseModel
+from sqlalchemy import Index
 from sqlmodel import Relationship, SQLModel, Field
 
 from api_mining.models.core import MovieBase, Character
@@ -116,6 +117,15 @@ class TropeCharacters(BaseModel):
     """Contains a list of characters and their associated tropes."""
     characters: List[TropeCharacter]
 
+class MovieTropeCharacters(BaseModel):
+    """Contains the characters of one movie of a packed request, keyed by the movie ID."""
+    movie_id: str
+    characters: List[TropeCharacter]
+
+class PackedTropeCharacters(BaseModel):
+    """Contains the characters of each movie of a request packing several movies."""
+    movies: List[MovieTropeCharacters]
+
 class TropeMovie(MovieBase, table=True):
     """Represents a movie with associated characters and their tropes."""
     characters: Optional[List["TropeCharacterDB"]] = Relationship(
@@ -126,6 +136,8 @@ class TropeMovie(MovieBase, table=True):
 class TropeCharacterDB(SQLModel, table=True):
     """Database model for character trope information."""
     __tablename__ = "character_tropes"
+    # one row per character of a movie, re-adding a character updates it
+    __table_args__ = (Index("ux_character_tropes_movie_id_name", "movie_id", "name", unique=True),)
     id: Optional[int] = Field(default=None, primary_key=True)
     movie_id: str = Field(foreign_key="tropemovie.id", index=True)
     name: str
@@ -0,0 +1,159 @@
+from enum import Enum
+from typing import List, Mapping, Optional, Sequence, Tuple
+
+from pydantic import BaseModel
+
+class PlanStrategy(str, Enum):
+    """How movies are packed into batches"""
+    SEQUENTIAL = "sequential"  # fill batches one after the other with the shortest movies
+    FFD = "ffd"                # first-fit decreasing
+    BALANCED = "balanced"      # fill all batches evenly
+
+class PlannedBatch(BaseModel):
+    """Movies planned for a batch, their estimated tokens and the size of their requests in the batch file"""
+    movie_ids: List[str] = []
+    token_count: int = 0
+    byte_count: int = 0
+
+    def add(self, movie_id: str, token_count: int, byte_count: int = 0) -> None:
+        self.movie_ids.append(movie_id)
+        self.token_count += token_count
+        self.byte_count += byte_count
+
+class BatchLimits(BaseModel):
+    """Token target and file size limit of each batch, with the request size of each movie"""
+    token_target: int
+    byte_limit: Optional[int] = None
+    byte_counts: Mapping[str, int] = {}
+
+    def fits(self, batch: PlannedBatch, movie_id: str, token_count: int) -> bool:
+        if batch.token_count + token_count > self.token_target:
+            return False
+        return self.byte_limit is None or batch.byte_count + self.byte_counts[movie_id] <= self.byte_limit
+
+    def add(self, batch: PlannedBatch, movie_id: str, token_count: int) -> None:
+        batch.add(movie_id, token_count, self.byte_counts.get(movie_id, 0))
+
+def plan_sequential(movies: Sequence[Tuple[str, int]], num_batches: int, limits: BatchLimits) -> List[PlannedBatch]:
+    """Fill the batches in order with the shortest movies, closing a batch at the first movie that doesn't fit."""
+    batches = [PlannedBatch()]
+    for movie_id, token_count in sorted(movies, key=lambda movie: movie[1]):
+        if not limits.fits(batches[-1], movie_id, token_count):
+            if len(batches) == num_batches:
+                break
+            batches.append(PlannedBatch())
+        limits.add(batches[-1], movie_id, token_count)
+    return batches
+
+def select_shortest(
+    movies: Sequence[Tuple[str, int]],
+    num_batches: int,
+    limits: BatchLimits
+) -> Tuple[List[Tuple[str, int]], List[Tuple[str, int]]]:
+    """Split the movies into the most movies that fit in the total capacity of the batches (the shortest ones) and the rest."""
+    movies = sorted(movies, key=lambda movie: movie[1])
+    total = PlannedBatch()
+    capacity = BatchLimits(
+        token_target=num_batches * limits.token_target,
+        byte_limit=limits.byte_limit and num_batches * limits.byte_limit,
+        byte_counts=limits.byte_counts
+    )
+    for i, (movie_id, token_count) in enumerate(movies):
+        if not capacity.fits(total, movie_id, token_count):
+            return movies[:i], movies[i:]
+        capacity.add(total, movie_id, token_count)
+    return movies, []
+
+def plan_packed(movies: Sequence[Tuple[str, int]], num_batches: int, limits: BatchLimits, balanced: bool) -> List[PlannedBatch]:
+    """
+    Pack the shortest movies that fit in the total capacity, largest first, into the first batch with room (FFD)
+    or into the least filled batch (balanced). The gaps are then filled with the shortest of the remaining movies.
+    """
+    batches = [PlannedBatch() for _ in range(num_batches)]
+
+    def place(movie_id: str, token_count: int) -> bool:
+        if balanced:
+            candidates = [min(batches, key=lambda batch: batch.token_count)]
+        else:
+            candidates = batches
+        for batch in candidates:
+            if limits.fits(batch, movie_id, token_count):
+                limits.add(batch, movie_id, token_count)
+                return True
+        return False
+
+    selected, rest = select_shortest(movies, num_batches, limits)
+    unplaced = [movie for movie in sorted(selected, key=lambda movie: movie[1], reverse=True) if not place(*movie)]
+
+    # the largest gap bounds the movies that can still be placed
+    for movie_id, token_count in sorted(unplaced + rest, key=lambda movie: movie[1]):
+        if token_count > limits.token_target - min(batch.token_count for batch in batches):
+            break
+        place(movie_id, token_count)
+
+    return [batch for batch in batches if batch.movie_ids]
+
+def plan_batches(
+    movies: Sequence[Tuple[str, int]],
+    num_batches: int,
+    token_target: int,
+    strategy: PlanStrategy = PlanStrategy.FFD,
+    byte_counts: Optional[Mapping[str, int]] = None,
+    byte_limit: Optional[int] = None
+) -> List[PlannedBatch]:
+    """
+    Plan up to num_batches batches of at most token_target tokens from (movie_id, token_count) pairs.
+    With the request size of each movie in byte_counts, the batch files also stay within byte_limit.
+    """
+    if byte_counts is None:
+        byte_limit = None
+    limits = BatchLimits(token_target=token_target, byte_limit=byte_limit, byte_counts=byte_counts or {})
+
+    # movies above the limits can't be batched
+    movies = [movie for movie in movies if limits.fits(PlannedBatch(), *movie)]
+    if not movies or num_batches < 1:
+        return []
+
+    if strategy == PlanStrategy.SEQUENTIAL:
+        return plan_sequential(movies, num_batches, limits)
+    return plan_packed(movies, num_batches, limits, balanced=strategy == PlanStrategy.BALANCED)
+
+def format_batch_size(batch: PlannedBatch, byte_limit: Optional[int]) -> str:
+    """Describe the file size of a planned batch and its mean request size."""
+    size = f"{batch.byte_count / 1e6:.1f} MB"
+    if byte_limit:
+        size += f" ({batch.byte_count / byte_limit:.1%} of limit)"
+    return f"{size}, {batch.byte_count // max(len(batch.movie_ids), 1)} bytes/request"
+
+def format_plan_report(
+    batches: List[PlannedBatch],
+    token_target: int,
+    num_movies: int,
+    byte_limit: Optional[int] = None,
+    movie_counts: Optional[Mapping[str, int]] = None
+) -> List[str]:
+    """
+    Describe the movies, tokens, file size and predicted utilization of each planned batch.
+    The planned IDs are requests of several movies if their movie_counts are given.
+    """
+    def count_movies(batch: PlannedBatch) -> int:
+        if movie_counts is None:
+            return len(batch.movie_ids)
+        return sum(movie_counts[request_id] for request_id in batch.movie_ids)
+
+    lines = []
+    for i, batch in enumerate(batches, start=1):
+        line = f"Batch {i}: {count_movies(batch)} movies"
+        if movie_counts is not None:
+            line += f" in {len(batch.movie_ids)} requests"
+        line += f", {batch.token_count} tokens ({batch.token_count / token_target:.1%} of {token_target})"
+        if batch.byte_count:
+            line += f", {format_batch_size(batch, byte_limit)}"
+        lines.append(line)
+    planned_movies = sum(count_movies(batch) for batch in batches)
+    planned_tokens = sum(batch.token_count for batch in batches)
+    capacity = max(len(batches), 1) * token_target
+    lines.append(
+        f"Total: {planned_movies}/{num_movies} pending movies, {planned_tokens} tokens ({planned_tokens / capacity:.1%} utilization)"
+    )
+    return lines
@@ -0,0 +1,66 @@
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, Optional
+
+import orjson
+
+from api_mining.utils.common import build_messages
+
+# upload limit of a batch input file
+BATCH_FILE_BYTE_LIMIT = 200 * 1024 * 1024
+
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+class BatchRequestEncoder:
+    """Encodes chat completion requests as batch file lines, with the constant prefix serialized once"""
+    def __init__(self, system_prompt: str, response_format: Dict[str, Any], model: str = "gpt-4o-mini"):
+        # everything up to the user content is the same for all the movies of a data type
+        body = orjson.dumps({
+            "model": model,
+            "response_format": response_format,
+            "messages": build_messages(system_prompt, "")
+        })
+        # the user content is spliced in place of the empty content of the last message
+        self.prefix = b'{"method":"POST","url":"/v1/chat/completions","body":' + body[:-len(b'""}]}')]
+        self.custom_id_prefix = b'}]},"custom_id":'
+        self.suffix = b'}\n'
+
+    def encode_user_prompt(self, user_prompt: str) -> bytes:
+        """Encode the user content of a request as a JSON string"""
+        return orjson.dumps(user_prompt)
+
+    def encode(self, custom_id: str, user_content: bytes) -> bytes:
+        """Splice the encoded user content of a request into its line of the batch file"""
+        return b"".join((self.prefix, user_content, self.custom_id_prefix, orjson.dumps(custom_id), self.suffix))
+
+    def request_size(self, custom_id: str, user_content: bytes) -> int:
+        """Size of the line of a request in bytes"""
+        return (
+            len(self.prefix) + len(user_content)
+            + len(self.custom_id_prefix) + len(orjson.dumps(custom_id)) + len(self.suffix)
+        )
+
+class BatchFileWriter:
+    """Buffered writer of a batch file that refuses requests beyond the file size limit"""
+    def __init__(self, path: Path, encoder: BatchRequestEncoder, byte_limit: int = BATCH_FILE_BYTE_LIMIT):
+        self.path = path
+        self.encoder = encoder
+        self.byte_limit = byte_limit
+        self.byte_count = 0
+        self.request_count = 0
+        self.file: BinaryIO = None
+
+    def __enter__(self) -> "BatchFileWriter":
+        self.file = self.path.open("wb", buffering=WRITE_BUFFER_SIZE)
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.file.close()
+
+    def write(self, custom_id: str, user_content: bytes, encoder: Optional[BatchRequestEncoder] = None) -> None:
+        """Write a request, with the writer's encoder unless another is given"""
+        line = (encoder or self.encoder).encode(custom_id, user_content)
+        if self.byte_count + len(line) > self.byte_limit:
+            raise ValueError(f"Request {custom_id} exceeds the {self.byte_limit} byte limit of {self.path.name}")
+        self.file.write(line)
+        self.byte_count += len(line)
+        self.request_count += 1
@@ -1,26 +1,75 @@
 import importlib.resources
-from typing import Optional, List
+from functools import lru_cache
+from typing import Dict, Optional, List
 from pathlib import Path
 import json
 import logging
+import mmap
 
 import pandas as pd
 
 from api_mining.models.core import DataType
 
-def read_system_prompt(data_type: DataType) -> str:
-    """Read system prompt from file"""
+# Appended to the system prompt of requests packing several movies
+PACKED_SYSTEM_PROMPT = (
+    "The input contains several movies, each in a <movie> element with an id attribute. "
+    "Extract the information for each movie separately and return it with the movie's id as movie_id."
+)
+
+def read_system_prompt(data_type: DataType, packed: bool = False) -> str:
+    """Read system prompt from file, with the instructions for several movies per request if packed"""
     try:
         prompt_file = data_type + '.txt'
         with importlib.resources.open_text('api_mining.prompts', prompt_file) as f:
-            return f.read().strip()
+            prompt = f.read().strip()
+        return f"{prompt}\n\n{PACKED_SYSTEM_PROMPT}" if packed else prompt
     except Exception as e:
         logging.error(f"Error reading system prompt from {data_type}.txt: {e}")
         raise
 
+PLOT_SUMMARY_INDEX_FILE = "plot_summaries.index.json"
+
+class PlotSummaryIndex:
+    """Memory-mapped plot_summaries.txt with the movie_id -> (offset, length) index written by split_plot_summaries.py --index"""
+    def __init__(self, index_file: Path):
+        index = json.loads(index_file.read_text())
+        self.offsets = index["offsets"]
+
+        summary_file = index_file.parent / index["summary_file"]
+        with summary_file.open("rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mmap)
+
+    def movie_ids(self) -> List[str]:
+        return list(self.offsets)
+
+    def get(self, movie_id: str) -> str:
+        """Decode a summary directly from the mapped file"""
+        offset, length = self.offsets[movie_id]
+        return str(self.view[offset:offset + length], "utf-8")
+
+@lru_cache(maxsize=None)
+def get_plot_summary_index(input_dir: Path) -> Optional[PlotSummaryIndex]:
+    """Get the plot summary index of the input directory, if it has one"""
+    index_file = input_dir / PLOT_SUMMARY_INDEX_FILE
+    if not index_file.exists():
+        return None
+    return PlotSummaryIndex(index_file)
+
+def get_plot_summary_ids(input_dir: Path) -> List[str]:
+    """Get the IDs of all movies with a plot summary"""
+    index = get_plot_summary_index(input_dir)
+    if index is not None:
+        return index.movie_ids()
+    return [plot_file.stem.split('_')[2] for plot_file in input_dir.glob('plot_summaries_*.txt')]
+
 def get_plot_summary(input_dir: Path, movie_id: str) -> str:
-    """Get plot summary for a movie"""
+    """Get plot summary for a movie, from the plot summary index if there is one"""
     try:
+        index = get_plot_summary_index(input_dir)
+        if index is not None:
+            return index.get(movie_id).strip()
+
         plot_file = input_dir / f'plot_summaries_{movie_id}.txt'
         return plot_file.read_text().strip()
     except Exception as e:
@@ -39,21 +88,47 @@ def get_character_names(input_dir: Path, movie_id: str) -> List[str]:
         logging.error(f"Error reading characters for {movie_id}: {e}")
         return None
 
+# Bump when construct_user_prompt changes, to invalidate the cached token counts
+USER_PROMPT_VERSION = 1
+
+def format_character_names(character_names: List[str]) -> str:
+    """Format the character names as listed in the user prompt"""
+    return ', '.join(character_names)
+
 def construct_user_prompt(plot_summary: str, character_names: Optional[List[str]]) -> str:
     """Construct prompt for OpenAI API with plot summary and optional character names"""
     if character_names:
-        names_str = ', '.join(character_names)
+        names_str = format_character_names(character_names)
         return f"<summary>{plot_summary}</summary>\n<names>{names_str}</names>"
     return f"<summary>{plot_summary}</summary>"
 
+def construct_packed_user_prompt(user_prompts: Dict[str, str]) -> str:
+    """Construct the prompt of a request packing several movies from the user prompt of each movie"""
+    return "\n".join(f'<movie id="{movie_id}">\n{user_prompt}\n</movie>' for movie_id, user_prompt in user_prompts.items())
+
+def construct_request_prompt(input_dir: Path, movie_ids: List[str]) -> str:
+    """Construct the user prompt of a request for one movie, or for several movies packed together"""
+    user_prompts = {
+        movie_id: construct_user_prompt(
+            plot_summary=get_plot_summary(input_dir, movie_id),
+            character_names=get_character_names(input_dir, movie_id)
+        )
+        for movie_id in movie_ids
+    }
+    if len(movie_ids) == 1:
+        return user_prompts[movie_ids[0]]
+    return construct_packed_user_prompt(user_prompts)
+
+def build_messages(system_prompt: str, user_prompt: str) -> List[Dict[str, str]]:
+    """Build the chat messages of a request, led by the system prompt shared by all requests so that the provider can cache it"""
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
+
 def get_batch_ids(output_dir: Path) -> List[Optional[str]]:
-    """Read batch IDs from JSON file"""
+    """Read batch IDs from the JSON file written by earlier versions"""
     batch_file = output_dir / "batch_ids.json"
     if not batch_file.exists():
         return []
     return json.loads(batch_file.read_text())
-
-def save_batch_ids(output_dir: Path, batch_ids: List[Optional[str]]) -> None:
-    """Save batch IDs to JSON file"""
-    batch_file = output_dir / "batch_ids.json"
-    batch_file.write_text(json.dumps(batch_ids))
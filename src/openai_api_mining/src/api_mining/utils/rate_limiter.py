@@ -0,0 +1,43 @@
+import asyncio
+import time
+
+class TokenBucket:
+    """Bucket refilled continuously up to its capacity per minute"""
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until the bucket holds amount"""
+        return max(0.0, (amount - self.level) / self.rate)
+
+class RateLimiter:
+    """Async limiter for requests per minute and tokens per minute"""
+    def __init__(self, rpm: int, tpm: int):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, token_count: int) -> None:
+        """Wait until a request of token_count tokens fits in both limits"""
+        # a request larger than the TPM limit waits for a full bucket
+        token_count = min(token_count, self.tokens.capacity)
+
+        # requests are admitted in arrival order
+        async with self.lock:
+            while True:
+                self.requests.refill()
+                self.tokens.refill()
+                wait = max(self.requests.wait_time(1), self.tokens.wait_time(token_count))
+                if wait == 0:
+                    self.requests.level -= 1
+                    self.tokens.level -= token_count
+                    return
+                await asyncio.sleep(wait)
@@ -0,0 +1,82 @@
+from typing import Dict, List, Mapping, Optional, Sequence, Tuple
+
+from pydantic import BaseModel
+
+from api_mining.models.core import Character, DataType
+from api_mining.utils.token_counter import count_system_tokens, count_wrapper_tokens
+
+# joins the movie IDs of a packed request in its custom_id
+PACK_SEPARATOR = "+"
+
+class PackedRequest(BaseModel):
+    """Movies sent in one request and the estimated tokens of the request"""
+    movie_ids: List[str] = []
+    token_count: int = 0
+
+    @property
+    def custom_id(self) -> str:
+        return PACK_SEPARATOR.join(self.movie_ids)
+
+def split_custom_id(custom_id: str) -> List[str]:
+    """Get the movie IDs of a request from its custom_id"""
+    return custom_id.split(PACK_SEPARATOR)
+
+def pack_movies(
+    movies: Sequence[Tuple[str, int]],
+    system_tokens: int,
+    packed_system_tokens: int,
+    wrapper_tokens: Mapping[str, int],
+    pack_size: int,
+    pack_token_limit: int
+) -> List[PackedRequest]:
+    """
+    Pack (movie_id, token_count) pairs in order into requests of at most pack_size movies, adding movies to a request
+    while its tokens stay within pack_token_limit. Each token count includes the system prompt of system_tokens, which
+    a request of several movies replaces with one packed system prompt of packed_system_tokens, wrapping each movie in
+    its wrapper_tokens. Movies above the limit are sent alone.
+    """
+    requests = []
+    request = None
+    for movie_id, token_count in movies:
+        if request is not None and len(request.movie_ids) < pack_size:
+            packed_tokens = request.token_count + token_count - system_tokens + wrapper_tokens[movie_id]
+            if len(request.movie_ids) == 1:
+                # the first movie moves from its own request to the packed prompt
+                packed_tokens += packed_system_tokens - system_tokens + wrapper_tokens[request.movie_ids[0]]
+            if packed_tokens <= pack_token_limit:
+                request.movie_ids.append(movie_id)
+                request.token_count = packed_tokens
+                continue
+        request = PackedRequest(movie_ids=[movie_id], token_count=token_count)
+        requests.append(request)
+    return requests
+
+def pack_requests(
+    movies: Sequence[Tuple[str, int]],
+    data_type: DataType,
+    pack_size: int,
+    pack_token_limit: int,
+    model: str = "gpt-4o-mini"
+) -> List[PackedRequest]:
+    """Pack the shortest of the (movie_id, token_count) pairs together, one movie per request if pack_size is 1."""
+    if pack_size == 1:
+        return [PackedRequest(movie_ids=[movie_id], token_count=token_count) for movie_id, token_count in movies]
+
+    return pack_movies(
+        sorted(movies, key=lambda movie: movie[1]),
+        count_system_tokens(data_type, model),
+        count_system_tokens(data_type, model, packed=True),
+        {movie_id: count_wrapper_tokens(movie_id, model) for movie_id, _ in movies},
+        pack_size,
+        pack_token_limit
+    )
+
+def fan_out(movie_ids: List[str], parsed: BaseModel) -> Dict[str, Optional[List[Character]]]:
+    """
+    Get the characters of each movie of a request from its parsed response, a Characters model for one movie
+    or a PackedCharacters model for several. Movies missing from a packed response get None.
+    """
+    if len(movie_ids) == 1:
+        return {movie_ids[0]: parsed.characters}
+    characters = {movie.movie_id: movie.characters for movie in parsed.movies}
+    return {movie_id: characters.get(movie_id) for movie_id in movie_ids}
@@ -1,22 +1,121 @@
-from typing import List, Optional
+from collections import OrderedDict
+from functools import lru_cache
+from typing import List, Optional, Tuple
 from pathlib import Path
+import hashlib
+import sqlite3
 
 import tiktoken
 
 from api_mining.models.core import DataType
-from api_mining.utils.common import read_system_prompt, construct_user_prompt
+from api_mining.utils.common import (
+    read_system_prompt,
+    construct_user_prompt,
+    construct_packed_user_prompt,
+    format_character_names,
+    USER_PROMPT_VERSION
+)
+
+TOKEN_CACHE_FILE = "token_counts.sqlite"
+
+CacheKey = Tuple[str, str, str, int]
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """Get the encoding of a model, loaded once per process"""
+    return tiktoken.encoding_for_model(model)
+
+@lru_cache(maxsize=None)
+def count_system_tokens(data_type: DataType, model: str, packed: bool = False) -> int:
+    """Count the tokens of the system prompt, once per process"""
+    return len(get_encoding(model).encode(read_system_prompt(data_type, packed)))
+
+def count_wrapper_tokens(movie_id: str, model: str) -> int:
+    """Count the tokens wrapping the user prompt of a movie in a packed request, with the newline after it"""
+    return len(get_encoding(model).encode(construct_packed_user_prompt({movie_id: ""}))) + 1
+
+def hash_text(text: str) -> str:
+    return hashlib.sha1(text.encode()).hexdigest()
+
+class TokenCountCache:
+    """Persistent user prompt token counts in SQLite with an in-memory LRU front"""
+    def __init__(self, cache_path: Path, maxsize: int = 100_000):
+        # autocommit, every count is written as soon as it is computed so that concurrent workers can share the cache
+        self.connection = sqlite3.connect(cache_path, isolation_level=None, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS token_counts (
+                summary_hash TEXT NOT NULL,
+                names_hash TEXT NOT NULL,
+                encoding TEXT NOT NULL,
+                prompt_version INTEGER NOT NULL,
+                token_count INTEGER NOT NULL,
+                PRIMARY KEY (summary_hash, names_hash, encoding, prompt_version)
+            ) WITHOUT ROWID
+        """)
+        self.lru: OrderedDict[CacheKey, int] = OrderedDict()
+        self.maxsize = maxsize
+
+    def get(self, key: CacheKey) -> Optional[int]:
+        if key in self.lru:
+            self.lru.move_to_end(key)
+            return self.lru[key]
+
+        row = self.connection.execute(
+            "SELECT token_count FROM token_counts WHERE summary_hash = ? AND names_hash = ? AND encoding = ? AND prompt_version = ?",
+            key
+        ).fetchone()
+        if row is None:
+            return None
+
+        self._remember(key, row[0])
+        return row[0]
+
+    def put(self, key: CacheKey, token_count: int) -> None:
+        self.connection.execute("INSERT OR REPLACE INTO token_counts VALUES (?, ?, ?, ?, ?)", (*key, token_count))
+        self._remember(key, token_count)
+
+    def _remember(self, key: CacheKey, token_count: int) -> None:
+        self.lru[key] = token_count
+        self.lru.move_to_end(key)
+        if len(self.lru) > self.maxsize:
+            self.lru.popitem(last=False)
+
+    def close(self) -> None:
+        """Close the connection, which removes the WAL files of the last connection to the cache."""
+        self.connection.close()
 
 class TokenCounter:
     """Utility class for estimating token counts for OpenAI API requests"""
-    def __init__(self, data_type: DataType, model: str = "gpt-4o-mini"):
-        self.encoding = tiktoken.encoding_for_model(model)
-        self.system_tokens = len(self.encoding.encode(read_system_prompt(data_type)))
+    def __init__(self, data_type: DataType, model: str = "gpt-4o-mini", cache_path: Optional[Path] = None):
+        self.encoding = get_encoding(model)
+        self.system_tokens = count_system_tokens(data_type, model)
+        self.cache = TokenCountCache(cache_path) if cache_path is not None else None
         
+    def close(self) -> None:
+        if self.cache is not None:
+            self.cache.close()
+
     def count_tokens(self, text: str) -> int:
         return len(self.encoding.encode(text))
+
+    def count_user_prompt_tokens(self, plot_summary: str, character_names: Optional[List[str]]) -> int:
+        """Count the tokens of the user prompt, from the cache if the summary and names were counted before"""
+        if self.cache is None:
+            return self.count_tokens(construct_user_prompt(plot_summary=plot_summary, character_names=character_names))
+
+        # the hashes of the summary and the names as they appear in the prompt
+        names_hash = hash_text(format_character_names(character_names)) if character_names else ""
+        key = (hash_text(plot_summary), names_hash, self.encoding.name, USER_PROMPT_VERSION)
+
+        prompt_tokens = self.cache.get(key)
+        if prompt_tokens is None:
+            prompt_tokens = self.count_tokens(construct_user_prompt(plot_summary=plot_summary, character_names=character_names))
+            self.cache.put(key, prompt_tokens)
+        return prompt_tokens
     
     def estimate_request_tokens(self, plot_summary: str, character_names: Optional[List[str]]) -> int:
-        prompt = construct_user_prompt(plot_summary=plot_summary, character_names=character_names)
-        prompt_tokens = self.count_tokens(prompt)
+        prompt_tokens = self.count_user_prompt_tokens(plot_summary, character_names)
         total_tokens = self.system_tokens + prompt_tokens + 50
         return total_tokens
@@ -0,0 +1,45 @@
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from pydantic import BaseModel
+
+from api_mining.models.core import ProcessingMethod
+
+UsageRow = Tuple[Optional[ProcessingMethod], int, int, int, int]
+
+class UsageSummary(BaseModel):
+    """Estimated and reported tokens of the movies with recorded usage"""
+    movies: int = 0
+    estimated_tokens: int = 0
+    prompt_tokens: int = 0
+    cached_tokens: int = 0
+    completion_tokens: int = 0
+
+    def add(self, estimated_tokens: int, prompt_tokens: int, cached_tokens: int, completion_tokens: int) -> None:
+        self.movies += 1
+        self.estimated_tokens += estimated_tokens
+        self.prompt_tokens += prompt_tokens
+        self.cached_tokens += cached_tokens or 0
+        self.completion_tokens += completion_tokens or 0
+
+    @property
+    def prompt_ratio(self) -> Optional[float]:
+        """Reported prompt tokens per estimated token"""
+        return self.prompt_tokens / self.estimated_tokens if self.estimated_tokens else None
+
+    @property
+    def cache_hit_rate(self) -> Optional[float]:
+        """Share of the prompt tokens read from the provider's prompt cache"""
+        return self.cached_tokens / self.prompt_tokens if self.prompt_tokens else None
+
+def summarize_usage(rows: Sequence[UsageRow]) -> Dict[str, UsageSummary]:
+    """Summarize the usage rows of the database per processing method and in total ("all")."""
+    summaries = {"all": UsageSummary()}
+    for method, *tokens in rows:
+        key = method.value if method else "unknown"
+        summaries.setdefault(key, UsageSummary()).add(*tokens)
+        summaries["all"].add(*tokens)
+    return summaries
+
+def estimate_errors(rows: Sequence[UsageRow]) -> List[float]:
+    """Relative error of the estimate of each movie against its reported prompt tokens, sorted."""
+    return sorted((estimated - prompt) / prompt for _, estimated, prompt, _, _ in rows if prompt)
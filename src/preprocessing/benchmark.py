@@ -0,0 +1,310 @@
+import argparse
+import multiprocessing as mp
+import random
+import resource
+import tempfile
+import time
+from functools import partial
+from pathlib import Path
+
+from collections import defaultdict
+
+from build_char_word_bags import (
+    build_character_bags_of_words,
+    generate_name_tuples,
+    get_dep_label,
+    get_max_name_length,
+    map_tokens_to_characters,
+    match_name_parts_in_tokens,
+    read_character_metadata as read_movie_character_metadata,
+    read_coreferences,
+    read_dependencies,
+    read_tokens
+)
+from parse_corenlp_xml import parse_xml_to_csv
+from split_char_metadata import (
+    read_character_metadata,
+    split_character_metadata,
+    write_indexed_character_metadata
+)
+
+
+def peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_parse_xml(file_paths, compressed, streaming, results):
+    with tempfile.TemporaryDirectory() as output_dir:
+        start = time.perf_counter()
+        for file_path in file_paths:
+            parse_xml_to_csv(file_path, Path(output_dir), compressed=compressed, streaming=streaming)
+        elapsed = time.perf_counter() - start
+
+    results.put((elapsed, peak_rss_mb()))
+
+
+def benchmark_parse_xml(args):
+    """
+    Compares the tree-based and the streaming XML parser on a single core.
+    Each mode runs in a freshly spawned process so that peak RSS is not shared between them.
+    """
+    pattern = "*.xml.gz" if args.compressed else "*.xml"
+    file_paths = sorted(args.input_dir.glob(pattern))
+    if args.num_files:
+        file_paths = file_paths[:args.num_files]
+
+    print("Plot summaries:", len(file_paths))
+
+    ctx = mp.get_context("spawn")
+    for mode, streaming in [("tree", False), ("streaming", True)]:
+        results = ctx.Queue()
+        process = ctx.Process(target=run_parse_xml, args=(file_paths, args.compressed, streaming, results))
+        process.start()
+        elapsed, peak_rss = results.get()
+        process.join()
+
+        print(f"{mode:>10}: {len(file_paths) / elapsed:8.1f} files/s, peak RSS {peak_rss:7.1f} MB")
+
+
+def reference_split_character_metadata(input_dir, output_dir):
+    """
+    The original implementation, a boolean mask scan of the whole frame for every movie.
+    """
+    characters_metadata_df = read_character_metadata(input_dir)
+
+    for movie_id in characters_metadata_df['movie_id'].unique():
+        df = characters_metadata_df[characters_metadata_df['movie_id'] == movie_id]
+
+        df = df.drop(columns=['movie_id'])
+
+        output_file = output_dir / f'character.metadata_{movie_id}.csv'
+
+        df.to_csv(output_file, index=False)
+
+
+def benchmark_split_metadata(args):
+    """
+    Times the original per-movie mask scan against the single-pass split and the indexed file,
+    and checks that the split files are identical.
+    """
+    implementations = [
+        ("mask scan", reference_split_character_metadata),
+        ("groupby", partial(split_character_metadata, num_threads=args.num_threads)),
+        ("indexed", write_indexed_character_metadata),
+    ]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output_dirs = []
+        for name, split in implementations:
+            output_dir = Path(tmp_dir) / name.replace(" ", "_")
+            output_dir.mkdir()
+            output_dirs.append(output_dir)
+
+            start = time.perf_counter()
+            split(args.input_dir, output_dir)
+            elapsed = time.perf_counter() - start
+
+            num_files = len(list(output_dir.iterdir()))
+            print(f"{name:>10}: {elapsed:8.2f} s, {num_files} files")
+
+        reference_dir, split_dir = output_dirs[0], output_dirs[1]
+        mismatches = [
+            f.name for f in reference_dir.iterdir()
+            if f.read_bytes() != (split_dir / f.name).read_bytes()
+        ]
+        print("Identical split files:", not mismatches)
+
+
+def reference_build_character_bags_of_words(token_character_map, dependencies_df, tokens_df):
+    """
+    The original row by row implementation.
+    """
+    token_lemma = {
+        (row['sentence_id'], row['token_id']): str(row['lemma']).lower()
+        for _, row in tokens_df.iterrows()
+    }
+
+    character_bags = defaultdict(set)
+
+    for _, dep in dependencies_df.iterrows():
+        sentence_id = dep['sentence_id']
+        dep_type = dep['type']
+        governor_idx = dep['governor_idx']
+        dependent_idx = dep['dependent_idx']
+
+        if (sentence_id, governor_idx) in token_character_map:
+            label = get_dep_label(dep_type, governor=True)
+            if label is not None:
+                char = token_character_map[(sentence_id, governor_idx)]
+                lemma = token_lemma.get((sentence_id, dependent_idx), '')
+                if lemma:
+                    character_bags[char].add((label, lemma))
+
+        if (sentence_id, dependent_idx) in token_character_map:
+            label = get_dep_label(dep_type, governor=False)
+            if label is not None:
+                char = token_character_map[(sentence_id, dependent_idx)]
+                lemma = token_lemma.get((sentence_id, governor_idx), '')
+                if lemma:
+                    character_bags[char].add((label, lemma))
+
+    return character_bags
+
+
+def sample_movie_ids(input_dir, num_movies, seed=0):
+    token_files = input_dir.glob('corenlp_plot_summaries/tokens_*.csv')
+    metadata_files = input_dir.glob('character.metadata_*.csv')
+
+    token_movie_ids = [f.stem.split('_')[1] for f in token_files]
+    metadata_movie_ids = [f.stem.split('_')[1] for f in metadata_files]
+    movie_ids = sorted(set(metadata_movie_ids) & set(token_movie_ids))
+
+    random.Random(seed).shuffle(movie_ids)
+    return movie_ids[:num_movies]
+
+
+def benchmark_build_bags(args):
+    """
+    Times the row by row and the vectorized bag of words construction on a sample of movies,
+    and checks that both build the same bags (characters in the same order).
+    """
+    movie_ids = sample_movie_ids(args.input_dir, args.num_movies, args.seed)
+    print("Movies:", len(movie_ids))
+
+    timings = {"iterrows": 0.0, "vectorized": 0.0}
+    num_built = 0
+    mismatches = []
+    for movie_id in movie_ids:
+        name_parts_dict = generate_name_tuples(read_movie_character_metadata(movie_id, args.input_dir))
+        if not name_parts_dict:
+            continue
+
+        tokens_df = read_tokens(movie_id, args.input_dir)
+        name_occurrences = match_name_parts_in_tokens(tokens_df, name_parts_dict)
+        if not name_occurrences:
+            continue
+
+        token_character_map = map_tokens_to_characters(name_occurrences, read_coreferences(movie_id, args.input_dir))
+        dependencies_df = read_dependencies(movie_id, args.input_dir)
+
+        num_built += 1
+        bags = {}
+        for name, build in [("iterrows", reference_build_character_bags_of_words), ("vectorized", build_character_bags_of_words)]:
+            start = time.perf_counter()
+            bags[name] = build(token_character_map, dependencies_df, tokens_df)
+            timings[name] += time.perf_counter() - start
+
+        if bags["iterrows"] != bags["vectorized"] or list(bags["iterrows"]) != list(bags["vectorized"]):
+            mismatches.append(movie_id)
+
+    print("Movies with character mentions:", num_built)
+    for name, elapsed in timings.items():
+        print(f"{name:>10}: {elapsed:8.2f} s, {elapsed / max(num_built, 1) * 1000:8.2f} ms/movie")
+    print("Identical bags:", not mismatches, mismatches[:10])
+
+
+def reference_match_name_parts_in_tokens(tokens_df, name_parts_dict):
+    """
+    The original implementation, every window size is tried at every position.
+    """
+    sentence_tokens = {}
+    for sentence_id, group in tokens_df.groupby('sentence_id'):
+        word_list = list(group['word'])
+        token_ids = list(group['token_id'])
+        sentence_tokens[sentence_id] = {'words': word_list, 'token_ids': token_ids}
+
+    name_occurrences = []
+    max_name_length = get_max_name_length(name_parts_dict)
+    for sentence_id, data in sentence_tokens.items():
+        words = data['words']
+        token_ids = data['token_ids']
+        n = len(words)
+        matched_indices = set()
+        for window_size in range(max_name_length, 0, -1):
+            if window_size > n:
+                continue
+            for i in range(n - window_size + 1):
+                if any(idx in matched_indices for idx in range(i, i+window_size)):
+                    continue
+                token_sequence = tuple(words[i:i+window_size])
+                if token_sequence in name_parts_dict:
+                    name, freebase_id = name_parts_dict[token_sequence]
+                    name_occurrences.append({
+                        'sentence_id': sentence_id,
+                        'start_token_id': token_ids[i],
+                        'end_token_id': token_ids[i+window_size -1],
+                        'name': name,
+                        'freebase_character_id': freebase_id
+                    })
+                    matched_indices.update(range(i, i+window_size))
+
+    return name_occurrences
+
+
+def benchmark_match_names(args):
+    """
+    Times the original window scan and the trie matcher on the longest summaries of a sample of movies,
+    and checks that both find the same name occurrences.
+    """
+    movies = []
+    for movie_id in sample_movie_ids(args.input_dir, args.sample_size, args.seed):
+        name_parts_dict = generate_name_tuples(read_movie_character_metadata(movie_id, args.input_dir))
+        if name_parts_dict:
+            movies.append((movie_id, name_parts_dict, read_tokens(movie_id, args.input_dir)))
+
+    movies.sort(key=lambda movie: len(movie[2]), reverse=True)
+    movies = movies[:args.num_movies]
+    print("Movies:", len(movies), "tokens:", sum(len(tokens_df) for _, _, tokens_df in movies))
+
+    timings = {"windows": 0.0, "trie": 0.0}
+    mismatches = []
+    for movie_id, name_parts_dict, tokens_df in movies:
+        occurrences = {}
+        for name, match in [("windows", reference_match_name_parts_in_tokens), ("trie", match_name_parts_in_tokens)]:
+            start = time.perf_counter()
+            occurrences[name] = match(tokens_df, name_parts_dict)
+            timings[name] += time.perf_counter() - start
+
+        if occurrences["windows"] != occurrences["trie"]:
+            mismatches.append(movie_id)
+
+    for name, elapsed in timings.items():
+        print(f"{name:>10}: {elapsed:8.2f} s, {elapsed / max(len(movies), 1) * 1000:8.2f} ms/movie")
+    print("Identical occurrences:", not mismatches, mismatches[:10])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark preprocessing steps.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parse_xml_parser = subparsers.add_parser("parse-xml", help="Tree-based vs. streaming parsing of CoreNLP XML files")
+    parse_xml_parser.add_argument("-i", "--input-dir", type=Path, required=False, default="./data/raw/corenlp_plot_summaries/", help="Directory containing XML files")
+    parse_xml_parser.add_argument("-n", "--num-files", type=int, default=1000, help="Number of files to parse (default: 1000)")
+    parse_xml_parser.add_argument("--compressed", action="store_true", help="Specify if input files are gz compressed")
+    parse_xml_parser.set_defaults(func=benchmark_parse_xml)
+
+    split_metadata_parser = subparsers.add_parser("split-metadata", help="Original vs. single-pass splitting of character.metadata.tsv")
+    split_metadata_parser.add_argument("-i", "--input-dir", type=Path, required=False, default="./data/raw/", help="Directory containing character metadata file")
+    split_metadata_parser.add_argument("--num-threads", type=int, default=8, help="Number of threads writing the split files (default: 8)")
+    split_metadata_parser.set_defaults(func=benchmark_split_metadata)
+
+    build_bags_parser = subparsers.add_parser("build-bags", help="Row by row vs. vectorized construction of the character bags of words")
+    build_bags_parser.add_argument("-i", "--input-dir", type=Path, required=False, default="./data/interim/", help="Directory containing the CSV files created by `parse_corenlp_xml.py` and `split_char_metadata`")
+    build_bags_parser.add_argument("-n", "--num-movies", type=int, default=500, help="Number of movies to sample (default: 500)")
+    build_bags_parser.add_argument("--seed", type=int, default=0, help="Seed of the movie sample (default: 0)")
+    build_bags_parser.set_defaults(func=benchmark_build_bags)
+
+    match_names_parser = subparsers.add_parser("match-names", help="Window scan vs. trie matching of character names on long summaries")
+    match_names_parser.add_argument("-i", "--input-dir", type=Path, required=False, default="./data/interim/", help="Directory containing the CSV files created by `parse_corenlp_xml.py` and `split_char_metadata`")
+    match_names_parser.add_argument("-n", "--num-movies", type=int, default=200, help="Number of longest summaries to match (default: 200)")
+    match_names_parser.add_argument("--sample-size", type=int, default=2000, help="Number of movies to pick the longest summaries from (default: 2000)")
+    match_names_parser.add_argument("--seed", type=int, default=0, help="Seed of the movie sample (default: 0)")
+    match_names_parser.set_defaults(func=benchmark_match_names)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
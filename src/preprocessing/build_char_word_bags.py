@@ -1,34 +1,156 @@
 import argparse
+import hashlib
 import json
+import os
 import pickle
+import sqlite3
+import time
 from collections import defaultdict
 from pathlib import Path
 import multiprocessing as mp
-from functools import partial
+from functools import partial, lru_cache
 
 from tqdm import tqdm
+import numpy as np
 import pandas as pd
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 
+from split_char_metadata import (
+    read_indexed_character_metadata,
+    read_indexed_character_metadata_bytes,
+    read_metadata_index
+)
+
+
+def read_character_metadata(movie_id, input_dir, indexed_metadata=False):
+    if indexed_metadata:
+        return read_indexed_character_metadata(input_dir, movie_id, usecols=['character_name', 'freebase_character_id'])
 
-def read_character_metadata(movie_id, input_dir):
     character_metadata_file = input_dir / f'character.metadata_{movie_id}.csv'
     character_df = pd.read_csv(character_metadata_file, usecols=['character_name', 'freebase_character_id'])
     return character_df
 
 
-def read_tokens(movie_id, input_dir):
+@lru_cache(maxsize=None)
+def get_parquet_shard_index(input_dir, table):
+    """
+    Lists (min movie_id, max movie_id, shard) for each file of a Parquet dataset written by
+    `parse_corenlp_xml.py --output-format parquet`, using only the movie_id statistics in the file footers.
+    """
+    shard_index = []
+    for shard_file in sorted((input_dir / 'corenlp_plot_summaries' / table).glob('*.parquet')):
+        metadata = pq.ParquetFile(shard_file).metadata
+        statistics = [metadata.row_group(i).column(0).statistics for i in range(metadata.num_row_groups)]
+        statistics = [stats for stats in statistics if stats is not None and stats.has_min_max]
+        if statistics:
+            shard_index.append((
+                min(stats.min for stats in statistics),
+                max(stats.max for stats in statistics),
+                shard_file.name
+            ))
+    return shard_index
+
+
+@lru_cache(maxsize=3) # the current shard of each table
+def read_parquet_shard(input_dir, table, shard):
+    """
+    Reads a whole shard (e.g. 'part-00000.parquet') of a Parquet dataset.
+
+    Returns:
+        tuple: (df, movie_rows) where movie_rows maps each movie_id to its (start, stop) rows in df
+    """
+    table = pq.read_table(input_dir / 'corenlp_plot_summaries' / table / shard)
+
+    # rows of a movie are contiguous within a shard
+    movie_id_runs = pc.run_end_encode(table.column('movie_id').combine_chunks())
+    starts = [0] + movie_id_runs.run_ends.to_pylist()
+    movie_rows = {
+        movie_id: (start, stop)
+        for movie_id, start, stop in zip(movie_id_runs.values.to_pylist(), starts, starts[1:])
+    }
+
+    df = table.drop_columns(['movie_id']).to_pandas()
+    return df, movie_rows
+
+
+def read_parquet_movie(table, movie_id, input_dir):
+    """
+    Reads the rows of a single movie from a Parquet dataset. Only the shard whose movie_id range
+    contains the movie is read, and it is kept in memory for the next movies of the same shard.
+    """
+    for min_movie_id, max_movie_id, shard in get_parquet_shard_index(input_dir, table):
+        if min_movie_id <= movie_id <= max_movie_id:
+            df, movie_rows = read_parquet_shard(input_dir, table, shard)
+            if movie_id in movie_rows:
+                start, stop = movie_rows[movie_id]
+                return df.iloc[start:stop].reset_index(drop=True)
+
+    # like a CSV file with only the header
+    schema = pq.read_schema(next((input_dir / 'corenlp_plot_summaries' / table).glob('*.parquet')))
+    return schema.empty_table().to_pandas().drop(columns=['movie_id'])
+
+
+def get_parquet_movie_sizes(input_dir):
+    """
+    Returns the number of tokens of each movie in the tokens dataset, in shard order.
+    """
+    movie_sizes = {}
+    for _, _, shard in get_parquet_shard_index(input_dir, 'tokens'):
+        column = pq.read_table(input_dir / 'corenlp_plot_summaries' / 'tokens' / shard, columns=['movie_id']).column('movie_id')
+        movie_id_runs = pc.run_end_encode(column.combine_chunks())
+        starts = [0] + movie_id_runs.run_ends.to_pylist()
+        for movie_id, start, stop in zip(movie_id_runs.values.to_pylist(), starts, starts[1:]):
+            movie_sizes[movie_id] = stop - start
+    return movie_sizes
+
+
+def get_parquet_movie_ids(input_dir):
+    """
+    Returns the movie IDs of the tokens dataset in shard order.
+    """
+    return list(get_parquet_movie_sizes(input_dir))
+
+
+def get_movie_sizes(movie_ids, input_dir, input_format='csv'):
+    """
+    Estimates the amount of work for each movie: the size of its CSV files in bytes, or its number of tokens.
+    """
+    if input_format == 'parquet':
+        movie_sizes = get_parquet_movie_sizes(input_dir)
+        return {movie_id: movie_sizes.get(movie_id, 0) for movie_id in movie_ids}
+
+    return {
+        movie_id: sum(
+            (input_dir / f'corenlp_plot_summaries/{table}_{movie_id}.csv').stat().st_size
+            for table in ['tokens', 'dependencies', 'coreferences']
+        )
+        for movie_id in movie_ids
+    }
+
+
+def read_tokens(movie_id, input_dir, input_format='csv'):
+    if input_format == 'parquet':
+        return read_parquet_movie('tokens', movie_id, input_dir)
+
     tokens_file = input_dir / f'corenlp_plot_summaries/tokens_{movie_id}.csv'
     tokens_df = pd.read_csv(tokens_file)
     return tokens_df
 
 
-def read_dependencies(movie_id, input_dir):
+def read_dependencies(movie_id, input_dir, input_format='csv'):
+    if input_format == 'parquet':
+        return read_parquet_movie('dependencies', movie_id, input_dir)
+
     dependencies_file = input_dir / f'corenlp_plot_summaries/dependencies_{movie_id}.csv'
     dependencies_df = pd.read_csv(dependencies_file)
     return dependencies_df
 
 
-def read_coreferences(movie_id, input_dir):
+def read_coreferences(movie_id, input_dir, input_format='csv'):
+    if input_format == 'parquet':
+        return read_parquet_movie('coreferences', movie_id, input_dir)
+
     coref_file = input_dir / f'corenlp_plot_summaries/coreferences_{movie_id}.csv'
     coref_df = pd.read_csv(coref_file)
     return coref_df
@@ -65,44 +187,76 @@ def get_max_name_length(name_parts_dict):
     return max_length
 
 
+def build_name_trie(name_parts_dict):
+    """
+    Builds a token-level trie of the name tuples. Each node is a [children, (name, freebase_id)] pair,
+    the second item is None unless a name tuple ends at the node.
+    """
+    trie = [{}, None]
+    for name_tuple, character in name_parts_dict.items():
+        node = trie
+        for name_part in name_tuple:
+            node = node[0].setdefault(name_part, [{}, None])
+        node[1] = character
+    return trie
+
+
+def iter_sentences(tokens_df):
+    """
+    Yields (sentence_id, words, token_ids) for each sentence, ordered by sentence_id.
+    """
+    sentence_ids = tokens_df['sentence_id'].to_numpy()
+    order = np.argsort(sentence_ids, kind='stable')
+    words = tokens_df['word'].to_numpy(dtype=object)[order].tolist()
+    token_ids = tokens_df['token_id'].to_numpy()[order].tolist()
+
+    unique_sentence_ids, starts = np.unique(sentence_ids[order], return_index=True)
+    stops = list(starts[1:]) + [len(order)]
+    for sentence_id, start, stop in zip(unique_sentence_ids.tolist(), starts, stops):
+        yield sentence_id, words[start:stop], token_ids[start:stop]
+
+
 def match_name_parts_in_tokens(tokens_df, name_parts_dict):
     """
     Matches character name parts in the tokens and records occurrences.
+
+    Longer name tuples take precedence over shorter ones, and among tuples of the same length
+    the leftmost one wins.
     """
-    # map sentence_id to list of tokens
-    sentence_tokens = {}
-    for sentence_id, group in tokens_df.groupby('sentence_id'):
-        word_list = list(group['word'])
-        token_ids = list(group['token_id'])
-        sentence_tokens[sentence_id] = {'words': word_list, 'token_ids': token_ids}
-    
-    # for each sentence, try to match name parts
-    name_occurrences = []
+    trie = build_name_trie(name_parts_dict)
     max_name_length = get_max_name_length(name_parts_dict)
-    for sentence_id, data in sentence_tokens.items():
-        words = data['words']
-        token_ids = data['token_ids']
+
+    name_occurrences = []
+    for sentence_id, words, token_ids in iter_sentences(tokens_df):
         n = len(words)
-        matched_indices = set()
-        for window_size in range(max_name_length, 0, -1):
-            if window_size > n:
-                continue
-            for i in range(n - window_size + 1):
-                if any(idx in matched_indices for idx in range(i, i+window_size)):
-                    continue  # skip if tokens are already matched
-                token_sequence = tuple(words[i:i+window_size])
-                if token_sequence in name_parts_dict:
-                    name, freebase_id = name_parts_dict[token_sequence]
-                    start_token_id = token_ids[i]
-                    end_token_id = token_ids[i+window_size -1]
-                    name_occurrences.append({
-                        'sentence_id': sentence_id,
-                        'start_token_id': start_token_id,
-                        'end_token_id': end_token_id,
-                        'name': name,
-                        'freebase_character_id': freebase_id
-                    })
-                    matched_indices.update(range(i, i+window_size))
+
+        # walk the trie from each position to find every name tuple in the sentence
+        candidates = []
+        for i in range(n):
+            node = trie
+            for j in range(i, min(n, i + max_name_length)):
+                node = node[0].get(words[j])
+                if node is None:
+                    break
+                if node[1] is not None:
+                    candidates.append((-(j - i + 1), i, node[1]))
+
+        # greedily keep the longest, then leftmost, candidates that don't overlap already matched tokens.
+        # A single left-to-right longest-match pass is not equivalent, e.g. it would pick (A, B) over (B, C, D) in "A B C D"
+        candidates.sort(key=lambda candidate: candidate[:2])
+        matched = [False] * n
+        for negative_length, i, (name, freebase_id) in candidates:
+            window_size = -negative_length
+            if any(matched[i:i+window_size]):
+                continue  # skip if tokens are already matched
+            name_occurrences.append({
+                'sentence_id': sentence_id,
+                'start_token_id': token_ids[i],
+                'end_token_id': token_ids[i+window_size-1],
+                'name': name,
+                'freebase_character_id': freebase_id
+            })
+            matched[i:i+window_size] = [True] * window_size
 
     return name_occurrences
 
@@ -169,116 +323,475 @@ def get_dep_label(dep_type, governor: bool):
         return None
 
 
+DEP_LABELS = ['agent verb', 'patient verb', 'attribute']
+
+
+def pack_token_keys(sentence_ids, token_ids):
+    """
+    Packs (sentence_id, token_id) pairs into single int64 keys.
+    """
+    return (np.asarray(sentence_ids, dtype=np.int64) << 32) | np.asarray(token_ids, dtype=np.int64)
+
+
+def lookup_token_keys(sorted_keys, keys):
+    """
+    Finds keys in a sorted array of keys.
+
+    Returns:
+        tuple: (positions, found) where positions are only valid where found is True
+    """
+    positions = np.searchsorted(sorted_keys, keys)
+    positions = np.minimum(positions, len(sorted_keys) - 1)
+    found = sorted_keys[positions] == keys
+    return positions, found
+
+
+def get_dep_label_codes(dep_types, governor: bool):
+    """
+    Evaluates get_dep_label once per distinct dependency type.
+
+    Returns:
+        np.ndarray: the index of each dependency's label in DEP_LABELS, or -1 if it has no label
+    """
+    type_codes, unique_types = pd.factorize(dep_types)
+    label_codes = np.array([
+        DEP_LABELS.index(label) if (label := get_dep_label(dep_type, governor=governor)) is not None else -1
+        for dep_type in unique_types
+    ] + [-1], dtype=np.int64) # missing types have the code -1, i.e. the last entry
+    return label_codes[type_codes]
+
+
 def build_character_bags_of_words(token_character_map, dependencies_df, tokens_df):
     """
     Builds the bag of words for each character based on dependencies.
     """
-    # map (sentence_id, token_id) to lemma
-    token_lemma = {
-        (row['sentence_id'], row['token_id']): str(row['lemma']).lower()
-        for _, row in tokens_df.iterrows()
-    }
-
     character_bags = defaultdict(set)
 
-    for _, dep in dependencies_df.iterrows():
-        sentence_id = dep['sentence_id']
-        dep_type = dep['type']
-        governor_idx = dep['governor_idx']
-        dependent_idx = dep['dependent_idx']
-
-        if (sentence_id, governor_idx) in token_character_map:
-            # governor is a character
-            label = get_dep_label(dep_type, governor=True)
-            if label is not None:
-                char = token_character_map[(sentence_id, governor_idx)]
-                lemma = token_lemma.get((sentence_id, dependent_idx), '')
-                if lemma:
-                    character_bags[char].add((label, lemma))
-
-        if (sentence_id, dependent_idx) in token_character_map:
-            # dependent is a character
-            label = get_dep_label(dep_type, governor=False)
-            if label is not None:
-                char = token_character_map[(sentence_id, dependent_idx)]
-                lemma = token_lemma.get((sentence_id, governor_idx), '')
-                if lemma:
-                    character_bags[char].add((label, lemma))
+    if not token_character_map or dependencies_df.empty or tokens_df.empty:
+        return character_bags
+
+    # map (sentence_id, token_id) to lemma, the last token wins on duplicate ids like in a dict
+    token_keys = pack_token_keys(tokens_df['sentence_id'], tokens_df['token_id'])[::-1]
+    lemma_keys, last_tokens = np.unique(token_keys, return_index=True)
+    lemmas = tokens_df['lemma'].to_numpy(dtype=object)[::-1][last_tokens]
+
+    # map (sentence_id, token_id) to (character_name, freebase_character_id)
+    chars = list(token_character_map.values())
+    char_keys = pack_token_keys(*zip(*token_character_map.keys()))
+    char_order = np.argsort(char_keys)
+    char_keys = char_keys[char_order]
+
+    sentence_ids = dependencies_df['sentence_id']
+    positions = np.arange(len(dependencies_df))
+
+    matches = []
+    for governor, char_idx, lemma_idx in [(True, 'governor_idx', 'dependent_idx'), (False, 'dependent_idx', 'governor_idx')]:
+        char_positions, is_char = lookup_token_keys(char_keys, pack_token_keys(sentence_ids, dependencies_df[char_idx]))
+        lemma_positions, has_lemma = lookup_token_keys(lemma_keys, pack_token_keys(sentence_ids, dependencies_df[lemma_idx]))
+        label_codes = get_dep_label_codes(dependencies_df['type'], governor)
+
+        matched = is_char & has_lemma & (label_codes >= 0)
+        matches.append((
+            # the governor of a dependency is handled before its dependent
+            positions[matched] * 2 + (0 if governor else 1),
+            char_order[char_positions[matched]],
+            label_codes[matched],
+            lemma_positions[matched]
+        ))
+
+    order, char_indices, label_codes, lemma_positions = (np.concatenate(columns) for columns in zip(*matches))
+    sort = np.argsort(order, kind='stable')
+
+    for char_index, label_code, lemma_position in zip(char_indices[sort], label_codes[sort], lemma_positions[sort]):
+        lemma = str(lemmas[lemma_position]).lower()
+        if lemma:
+            character_bags[chars[char_index]].add((DEP_LABELS[label_code], lemma))
 
     return character_bags
 
 
-def process_movie(movie_id, input_dir):
+def process_movie(movie_id, input_dir, input_format='csv', indexed_metadata=False):
     """Builds character bags of words for a single movie
 
     Returns:
-        tuple: (character_bags, ok) where ok is a boolean indicating whether the processing was successful
+        tuple: (character_bags, dep_types, ok) where dep_types are the distinct dependency types of the movie
+            (empty if the dependencies were not needed) and ok is a boolean indicating whether the processing was successful
     """
 
 
     # Step 1: Read character metadata and generate name tuples
-    character_df = read_character_metadata(movie_id, input_dir)
+    character_df = read_character_metadata(movie_id, input_dir, indexed_metadata)
     name_parts_dict = generate_name_tuples(character_df)
 
     if not name_parts_dict:
-        return {}, False
+        return {}, [], False
     
     # Step 2: Read tokens and match name parts
-    tokens_df = read_tokens(movie_id, input_dir)
+    tokens_df = read_tokens(movie_id, input_dir, input_format)
     name_occurrences = match_name_parts_in_tokens(tokens_df, name_parts_dict)
 
     if not name_occurrences:
-        return {}, False
+        return {}, [], False
     
     # Steps 3 and 4: Read coreferences and map characters to coreference mentions
     # Build a map from (sentence_id, token_id) to (name, freebase_id)
-    coref_df = read_coreferences(movie_id, input_dir)
+    coref_df = read_coreferences(movie_id, input_dir, input_format)
     token_character_map = map_tokens_to_characters(name_occurrences, coref_df)
 
     # token_character_map is nonempty if name_occurrences was, no need to check it
     
     # Step 5: Read dependencies and build character bags of words
-    dependencies_df = read_dependencies(movie_id, input_dir)
+    dependencies_df = read_dependencies(movie_id, input_dir, input_format)
     character_bags = build_character_bags_of_words(token_character_map, dependencies_df, tokens_df)
+    dep_types = sorted(str(dep_type) for dep_type in dependencies_df['type'].dropna().unique())
 
     if not character_bags:
-        return {}, False
+        return {}, dep_types, False
+
+    return character_bags, dep_types, True
+
 
-    return character_bags, True
+def get_output_file(movie_id, output_dir, save_format):
+    extension = 'pkl' if save_format == 'pickle' else save_format
+    return output_dir / f'character_bags_{movie_id}.{extension}'
 
 
-def process_movie_pickle(movie_id, input_dir, output_dir):
-    character_bags, ok = process_movie(movie_id, input_dir)
+def process_movie_pickle(movie_id, input_dir, output_dir, input_format='csv', indexed_metadata=False):
+    character_bags, dep_types, ok = process_movie(movie_id, input_dir, input_format, indexed_metadata)
+
+    character_bags_file = get_output_file(movie_id, output_dir, 'pickle')
     if not ok:
-        return
+        # remove the bags of a previous build
+        character_bags_file.unlink(missing_ok=True)
+        return dep_types
 
-    character_bags_file = output_dir / f'character_bags_{movie_id}.pkl'
     with character_bags_file.open('wb') as f:
         pickle.dump(character_bags, f)
 
+    return dep_types
+
 
-def process_movie_json(movie_id, input_dir, output_dir):
-    character_bags, ok = process_movie(movie_id, input_dir)
+def process_movie_json(movie_id, input_dir, output_dir, input_format='csv', indexed_metadata=False):
+    character_bags, dep_types, ok = process_movie(movie_id, input_dir, input_format, indexed_metadata)
+
+    json_file = get_output_file(movie_id, output_dir, 'json')
     if not ok:
-        return
+        # remove the bags of a previous build
+        json_file.unlink(missing_ok=True)
+        return dep_types
 
     json_compatible_data = [
         {"name": name, "id": char_id, "bag": list(v)} for (name, char_id), v in character_bags.items()
     ]
 
-    json_file = output_dir / f'character_bags_{movie_id}.json'
     with json_file.open('w') as f:
         json.dump(json_compatible_data, f)
 
+    return dep_types
+
+
+BAGS_STORE_FILE = 'character_bags.sqlite'
+
+
+def process_movie_rows(movie_id, input_dir, input_format='csv', indexed_metadata=False):
+    """
+    Builds the bags of a movie as rows of the bag store. The rows are written by the main process,
+    the only writer of the store.
+
+    Returns:
+        tuple: (dep_types, rows) where rows are (movie_id, freebase_character_id, name, bag as JSON) tuples
+    """
+    character_bags, dep_types, ok = process_movie(movie_id, input_dir, input_format, indexed_metadata)
+    if not ok:
+        # no rows, so that writing them only deletes the bags of a previous build
+        return dep_types, []
+
+    rows = [
+        (movie_id, None if pd.isna(char_id) else char_id, name, json.dumps(list(v)))
+        for (name, char_id), v in character_bags.items()
+    ]
+    return dep_types, rows
+
+
+def open_bags_store(output_dir):
+    """
+    Opens the bag store, a single SQLite table of the bags of every movie indexed by
+    (movie_id, freebase_character_id). Bags are JSON lists of [label, lemma] pairs, as in the JSON files.
+    """
+    store = sqlite3.connect(output_dir / BAGS_STORE_FILE)
+    store.execute("PRAGMA journal_mode=WAL")
+    store.execute("PRAGMA synchronous=NORMAL")
+    store.execute("""
+        CREATE TABLE IF NOT EXISTS character_bags (
+            movie_id TEXT NOT NULL,
+            freebase_character_id TEXT,
+            name TEXT NOT NULL,
+            bag TEXT NOT NULL
+        )
+    """)
+    store.execute("CREATE INDEX IF NOT EXISTS ix_character_bags_movie_character ON character_bags (movie_id, freebase_character_id)")
+    return store
+
+
+def write_movie_bags(store, movie_id, rows):
+    # replaces the bags of a previous build
+    store.execute("DELETE FROM character_bags WHERE movie_id = ?", (movie_id,))
+    store.executemany("INSERT INTO character_bags VALUES (?, ?, ?, ?)", rows)
+
+
+def make_chunks(movie_ids, movie_sizes, num_workers, chunks_per_worker=4):
+    """
+    Splits the movies into chunks with a decreasing amount of work (guided scheduling). Each chunk gets
+    1 / (chunks_per_worker * num_workers) of the remaining work, so the first chunks amortize the IPC overhead
+    and the last ones are small enough to balance the load between the workers.
+    """
+    remaining = sum(movie_sizes[movie_id] for movie_id in movie_ids)
+    target = remaining / (chunks_per_worker * num_workers)
+
+    chunks = []
+    chunk, chunk_size = [], 0
+    for movie_id in movie_ids:
+        chunk.append(movie_id)
+        chunk_size += movie_sizes[movie_id]
+
+        if chunk_size >= target:
+            chunks.append(chunk)
+            remaining -= chunk_size
+            target = remaining / (chunks_per_worker * num_workers)
+            chunk, chunk_size = [], 0
+
+    if chunk:
+        chunks.append(chunk)
+
+    return chunks
+
+
+# set once in each worker by init_worker, so that it is not sent with every task
+worker_process_and_save = None
+
+
+def init_worker(process_and_save):
+    global worker_process_and_save
+    worker_process_and_save = process_and_save
+
+
+def process_chunk(movie_ids):
+    """
+    Processes a chunk of movies in a worker.
+
+    Returns:
+        tuple: (pid, results) where results is a list of (movie_id, seconds, output of worker_process_and_save)
+    """
+    results = []
+    for movie_id in movie_ids:
+        start = time.perf_counter()
+        output = worker_process_and_save(movie_id)
+        results.append((movie_id, time.perf_counter() - start, output))
+
+    return os.getpid(), results
+
+
+def report_worker_stats(worker_timings, wall_time):
+    """
+    Prints the throughput of each worker and the tail latency of the movies.
+    """
+    print(f"{'worker':>8} {'movies':>8} {'busy (s)':>10} {'movies/s':>10}")
+    for pid, timings in sorted(worker_timings.items()):
+        busy = sum(elapsed for _, elapsed in timings)
+        print(f"{pid:>8} {len(timings):>8} {busy:>10.1f} {len(timings) / max(busy, 1e-9):>10.1f}")
+
+    timings = [timing for timings in worker_timings.values() for timing in timings]
+    if not timings:
+        return
+
+    latencies = np.array([elapsed for _, elapsed in timings]) * 1000
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+    print(f"Wall time {wall_time:.1f} s, {len(timings) / wall_time:.1f} movies/s")
+    print(f"Latency per movie (ms): p50 {p50:.1f}, p90 {p90:.1f}, p99 {p99:.1f}, max {latencies.max():.1f}")
+
+    slowest = sorted(timings, key=lambda timing: timing[1], reverse=True)[:5]
+    print("Slowest movies:", ", ".join(f"{movie_id} ({elapsed * 1000:.0f} ms)" for movie_id, elapsed in slowest))
+
+
+def process_movies(movie_ids, input_dir, output_dir, save_format, input_format='csv', indexed_metadata=False):
+    """
+    Builds the bags of words of the movies in parallel.
+
+    Returns:
+        dict: the distinct dependency types of each movie
+    """
+    if not movie_ids:
+        return {}
 
-def process_movies(movie_ids, input_dir, output_dir, save_format):
     if save_format == 'json':
-        process_and_save = partial(process_movie_json, input_dir=input_dir, output_dir=output_dir)
+        process_and_save = partial(process_movie_json, input_dir=input_dir, output_dir=output_dir, input_format=input_format, indexed_metadata=indexed_metadata)
     elif save_format == 'pickle':
-        process_and_save = partial(process_movie_pickle, input_dir=input_dir, output_dir=output_dir)
+        process_and_save = partial(process_movie_pickle, input_dir=input_dir, output_dir=output_dir, input_format=input_format, indexed_metadata=indexed_metadata)
+    elif save_format == 'sqlite':
+        process_and_save = partial(process_movie_rows, input_dir=input_dir, input_format=input_format, indexed_metadata=indexed_metadata)
+
+    num_workers = mp.cpu_count()
+    movie_sizes = get_movie_sizes(movie_ids, input_dir, input_format)
+
+    if input_format == 'parquet':
+        # keep the movies of a shard together, so each worker reads a shard only once
+        movie_ids = sorted(movie_ids)
+    else:
+        # largest movies first, so that no worker is left with a large movie at the end
+        movie_ids = sorted(movie_ids, key=lambda movie_id: movie_sizes[movie_id], reverse=True)
+
+    chunks = make_chunks(movie_ids, movie_sizes, num_workers)
+
+    store = open_bags_store(output_dir) if save_format == 'sqlite' else None
+
+    worker_timings = defaultdict(list)
+    movie_dep_types = {}
+    start = time.perf_counter()
+    with mp.Pool(num_workers, initializer=init_worker, initargs=(process_and_save,)) as pool, \
+         tqdm(total=len(movie_ids)) as progress:
+        for pid, results in pool.imap_unordered(process_chunk, chunks):
+            for movie_id, elapsed, output in results:
+                worker_timings[pid].append((movie_id, elapsed))
+                if store is None:
+                    movie_dep_types[movie_id] = output
+                else:
+                    movie_dep_types[movie_id], rows = output
+                    write_movie_bags(store, movie_id, rows)
+            if store is not None:
+                # one transaction per chunk
+                store.commit()
+            progress.update(len(results))
+
+    if store is not None:
+        store.close()
+
+    report_worker_stats(worker_timings, time.perf_counter() - start)
 
-    with mp.Pool(mp.cpu_count()) as pool:
-        list(tqdm(pool.imap_unordered(process_and_save, movie_ids), total=len(movie_ids)))
+    return movie_dep_types
+
+
+MANIFEST_FILE = '.character_bags_manifest'  # not *.json, bag loaders read every JSON file of the directory
+# bump when the bag construction changes in a way the manifest can't detect, to rebuild every movie
+BAGS_VERSION = 1
+
+
+def load_manifest(output_dir, save_format):
+    """
+    Loads the manifest of the previous builds in output_dir:
+        files: {path: [size, mtime_ns, sha1]} of the input files, to hash only the files that changed
+        movies: {movie_id: {inputs, dep_types, dep_labels, output}} of each built movie
+    """
+    manifest = {'version': BAGS_VERSION, 'save_format': save_format, 'files': {}, 'movies': {}}
+
+    manifest_file = output_dir / MANIFEST_FILE
+    if manifest_file.exists():
+        with manifest_file.open() as f:
+            previous_manifest = json.load(f)
+        if previous_manifest.get('version') == BAGS_VERSION and previous_manifest.get('save_format') == save_format:
+            manifest = previous_manifest
+
+    return manifest
+
+
+def save_manifest(manifest, output_dir):
+    tmp_file = output_dir / f'{MANIFEST_FILE}.tmp'
+    with tmp_file.open('w') as f:
+        json.dump(manifest, f)
+    tmp_file.replace(output_dir / MANIFEST_FILE)
+
+
+def hash_file(path, files):
+    """
+    Hashes the content of a file. The hash of the previous build is reused if the size and mtime didn't change,
+    so rewriting a file with the same content (e.g. rerunning parse_corenlp_xml.py) doesn't trigger a rebuild.
+    """
+    stat = path.stat()
+    key = str(path)
+
+    previous = files.get(key)
+    if previous and previous[0] == stat.st_size and previous[1] == stat.st_mtime_ns:
+        return previous[2]
+
+    with path.open('rb') as f:
+        digest = hashlib.file_digest(f, 'sha1').hexdigest()
+    files[key] = [stat.st_size, stat.st_mtime_ns, digest]
+    return digest
+
+
+def get_input_files(movie_id, input_dir, input_format='csv', indexed_metadata=False):
+    """
+    Lists the files read by `process_movie`. For Parquet input these are the shards containing the movie,
+    the character metadata of `--indexed-metadata` is hashed separately.
+    """
+    if input_format == 'parquet':
+        input_files = [
+            input_dir / 'corenlp_plot_summaries' / table / shard
+            for table in ['tokens', 'dependencies', 'coreferences']
+            for min_movie_id, max_movie_id, shard in get_parquet_shard_index(input_dir, table)
+            if min_movie_id <= movie_id <= max_movie_id
+        ]
+    else:
+        input_files = [
+            input_dir / f'corenlp_plot_summaries/{table}_{movie_id}.csv'
+            for table in ['tokens', 'dependencies', 'coreferences']
+        ]
+
+    if not indexed_metadata:
+        input_files.append(input_dir / f'character.metadata_{movie_id}.csv')
+
+    return input_files
+
+
+def fingerprint_inputs(movie_id, input_dir, files, input_format='csv', indexed_metadata=False):
+    digest = hashlib.sha1()
+    for input_file in get_input_files(movie_id, input_dir, input_format, indexed_metadata):
+        digest.update(hash_file(input_file, files).encode())
+
+    if indexed_metadata:
+        digest.update(hashlib.sha1(read_indexed_character_metadata_bytes(input_dir, movie_id)).digest())
+
+    return digest.hexdigest()
+
+
+def fingerprint_dep_labels(dep_types):
+    """
+    Hashes the labels `get_dep_label` gives to the dependency types of a movie, so that changing the rules
+    only rebuilds the movies whose labels change.
+    """
+    labels = [[dep_type, get_dep_label(dep_type, governor=True), get_dep_label(dep_type, governor=False)] for dep_type in dep_types]
+    return hashlib.sha1(json.dumps(labels).encode()).hexdigest()
+
+
+def get_output_states(movie_ids, output_dir, save_format):
+    """
+    Returns the state of the output of each movie: the [size, mtime] of its file, or its [number of characters]
+    in the bag store. Movies without bags are missing.
+    """
+    if save_format == 'sqlite':
+        if not (output_dir / BAGS_STORE_FILE).exists():
+            return {}
+        store = open_bags_store(output_dir)
+        counts = store.execute("SELECT movie_id, COUNT(*) FROM character_bags GROUP BY movie_id").fetchall()
+        store.close()
+        return {movie_id: [count] for movie_id, count in counts}
+
+    output_states = {}
+    for movie_id in movie_ids:
+        output_file = get_output_file(movie_id, output_dir, save_format)
+        if output_file.exists():
+            stat = output_file.stat()
+            output_states[movie_id] = [stat.st_size, stat.st_mtime_ns]
+    return output_states
+
+
+def is_up_to_date(movie_entry, inputs_fingerprint, output_state):
+    return (
+        movie_entry is not None
+        and movie_entry['inputs'] == inputs_fingerprint
+        and movie_entry['dep_labels'] == fingerprint_dep_labels(movie_entry['dep_types'])
+        # the output was not deleted or modified since
+        and movie_entry['output'] == output_state
+    )
 
 
 def main():
@@ -286,16 +799,22 @@ def main():
     parser.add_argument("-i", "--input-dir", type=Path, required=False, default="./data/interim/", 
                         help="Directory containing CSV files created by `parse_corenlp_xml.py` and `split_char_metadata` (default: ./data/interim/)")
     parser.add_argument("-o", "--output-dir", type=Path, required=False, default="./data/processed/", help="Directory to save character bags of words files (default: ./data/processed/)")
-    parser.add_argument("--save-format", type=str, default='json', choices=['json', 'pickle'], help="Format to save character bags of words (default: json)")
+    parser.add_argument("--save-format", type=str, default='json', choices=['json', 'pickle', 'sqlite'], help=f"Format to save character bags of words: a file per movie, or a single {BAGS_STORE_FILE} store (default: json)")
+    parser.add_argument("--input-format", type=str, default='csv', choices=['csv', 'parquet'], help="Format of the files created by `parse_corenlp_xml.py` (default: csv)")
+    parser.add_argument("--indexed-metadata", action="store_true", help="Read character metadata from the single indexed file created by `split_char_metadata.py --indexed`")
     parser.add_argument("-n", "--num-files", type=int, default=None, help="Number of files to process")
     parser.add_argument("--movie-ids", required=False, nargs='*', help="List of movie IDs to process")
+    parser.add_argument("-f", "--force", action="store_true", help=f"Rebuild all movies, even if their inputs didn't change since the last build (see {MANIFEST_FILE})")
     
     args = parser.parse_args()
     input_dir = args.input_dir
     output_dir = args.output_dir
     save_format = args.save_format
+    input_format = args.input_format
+    indexed_metadata = args.indexed_metadata
     num_files = args.num_files
     movie_ids = args.movie_ids
+    force = args.force
 
 
     if movie_ids:
@@ -305,11 +824,17 @@ def main():
         # and not all movie IDs in the plot summaries are present in the character.metadata files
         # so we need to take the intersection of the movie IDs in the plot summaries and the character.metadata files
 
-        token_files = input_dir.glob('corenlp_plot_summaries/tokens_*.csv') # token, depencency, and coreference files have the same movie IDs
-        metadata_files = input_dir.glob('character.metadata_*.csv')
-
-        token_movie_ids = [f.stem.split('_')[1] for f in token_files]
-        metadata_movie_ids = [f.stem.split('_')[1] for f in metadata_files]
+        if input_format == 'parquet':
+            token_movie_ids = get_parquet_movie_ids(input_dir)
+        else:
+            token_files = input_dir.glob('corenlp_plot_summaries/tokens_*.csv') # token, depencency, and coreference files have the same movie IDs
+            token_movie_ids = [f.stem.split('_')[1] for f in token_files]
+
+        if indexed_metadata:
+            metadata_movie_ids = list(read_metadata_index(input_dir))
+        else:
+            metadata_files = input_dir.glob('character.metadata_*.csv')
+            metadata_movie_ids = [f.stem.split('_')[1] for f in metadata_files]
         movie_ids = list(set(metadata_movie_ids) & set(token_movie_ids))
 
         if num_files:
@@ -319,13 +844,36 @@ def main():
 
     output_dir.mkdir(parents=True, exist_ok=True)
 
-    process_movies(movie_ids, input_dir, output_dir, save_format)
+    # only rebuild the movies whose inputs, dependency labels or output changed since the last build
+    manifest = load_manifest(output_dir, save_format)
+    inputs_fingerprints = {
+        movie_id: fingerprint_inputs(movie_id, input_dir, manifest['files'], input_format, indexed_metadata)
+        for movie_id in tqdm(movie_ids, desc="Fingerprinting inputs")
+    }
+    output_states = get_output_states(movie_ids, output_dir, save_format)
+    rebuild_movie_ids = [
+        movie_id for movie_id in movie_ids
+        if force or not is_up_to_date(
+            manifest['movies'].get(movie_id),
+            inputs_fingerprints[movie_id],
+            output_states.get(movie_id)
+        )
+    ]
+    print(f"Rebuilding {len(rebuild_movie_ids)} movies, skipping {len(movie_ids) - len(rebuild_movie_ids)} unchanged movies")
 
-    processed_movie_ids = set()
-    for movie_id in movie_ids:
-        character_bags_file = output_dir / f'character_bags_{movie_id}.{save_format}'
-        if character_bags_file.exists():
-            processed_movie_ids.add(movie_id)
+    movie_dep_types = process_movies(rebuild_movie_ids, input_dir, output_dir, save_format, input_format, indexed_metadata)
+
+    output_states = get_output_states(movie_ids, output_dir, save_format)
+    for movie_id, dep_types in movie_dep_types.items():
+        manifest['movies'][movie_id] = {
+            'inputs': inputs_fingerprints[movie_id],
+            'dep_types': dep_types,
+            'dep_labels': fingerprint_dep_labels(dep_types),
+            'output': output_states.get(movie_id)
+        }
+    save_manifest(manifest, output_dir)
+
+    processed_movie_ids = set(movie_ids) & set(output_states)
 
     print(f"Successfully built character bags of words for {len(processed_movie_ids)}/{len(movie_ids)} movies")
 
@@ -1,11 +1,17 @@
 import argparse
-from pathlib import Path
+from collections import deque
+from pathlib import Path, PurePosixPath
 from lxml import etree
 import multiprocessing as mp
 from functools import partial
 from tqdm import tqdm
 import csv
 import gzip
+import io
+import tarfile
+
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 SENTENCE_XPATH = etree.XPath(".//sentence")
 TOKEN_XPATH = etree.XPath("./tokens/token")
@@ -13,105 +19,339 @@ DEPENDENCY_XPATH = etree.XPath(f"./collapsed-ccprocessed-dependencies/dep")
 COREFERENCE_XPATH = etree.XPath(".//coreference")
 
 
-def parse_xml_to_csv(file_path, output_dir, compressed=False):
-    open_func = gzip.open if compressed else open
-    with open_func(file_path, "rb") as file:
-        tree = etree.parse(file)
-    root = tree.getroot()
-    
+TOKENS_HEADER = [
+    "sentence_id", "token_id", "word", "lemma",
+    "CharacterOffsetBegin", "CharacterOffsetEnd",
+    "POS", "NER"
+]
+DEPENDENCIES_HEADER = [
+    "sentence_id", "type",
+    "governor", "governor_idx",
+    "dependent", "dependent_idx"
+]
+COREFERENCES_HEADER = [
+    "representative", "sentence_id",
+    "start", "end", "head"
+]
+
+# POS, NER and dependency types have few distinct values, they are dictionary encoded
+CATEGORY = pa.dictionary(pa.int32(), pa.string())
+PARQUET_SCHEMAS = {
+    "tokens": pa.schema([
+        ("movie_id", pa.string()),
+        ("sentence_id", pa.int32()), ("token_id", pa.int32()),
+        ("word", pa.string()), ("lemma", pa.string()),
+        ("CharacterOffsetBegin", pa.int32()), ("CharacterOffsetEnd", pa.int32()),
+        ("POS", CATEGORY), ("NER", CATEGORY)
+    ]),
+    "dependencies": pa.schema([
+        ("movie_id", pa.string()),
+        ("sentence_id", pa.int32()), ("type", CATEGORY),
+        ("governor", pa.string()), ("governor_idx", pa.int32()),
+        ("dependent", pa.string()), ("dependent_idx", pa.int32())
+    ]),
+    "coreferences": pa.schema([
+        ("movie_id", pa.string()),
+        ("representative", pa.bool_()), ("sentence_id", pa.int32()),
+        ("start", pa.int32()), ("end", pa.int32()), ("head", pa.int32())
+    ]),
+}
+# a few hundred movies per row group, so that readers filtering on movie_id can skip most of a shard
+PARQUET_ROW_GROUP_SIZE = 100_000
+
+
+def get_base_name(file_path, compressed=False):
     base_name = file_path.stem
 
     if compressed:
         base_name = base_name.split(".")[0]
-    
+
+    return base_name
+
+
+def write_sentence_rows(sentence, tokens_writer, dependencies_writer):
+    sentence_id = sentence.get("id")
+
+    for token in TOKEN_XPATH(sentence):
+        tokens_writer.writerow([
+            sentence_id,
+            token.get("id"),
+            token.findtext("word"),
+            token.findtext("lemma"),
+            token.findtext("CharacterOffsetBegin"),
+            token.findtext("CharacterOffsetEnd"),
+            token.findtext("POS"),
+            token.findtext("NER")
+        ])
+
+    for dep in DEPENDENCY_XPATH(sentence):
+        dependencies_writer.writerow([
+            sentence_id,
+            dep.get("type"),
+            dep.findtext("governor"),
+            dep.find("governor").get("idx"),
+            dep.findtext("dependent"),
+            dep.find("dependent").get("idx")
+        ])
+
+
+def write_coreference_rows(coreference, coreferences_writer):
+    for mention in coreference.xpath("mention"):
+        representative = mention.get("representative") == "true"
+        coreferences_writer.writerow([
+            representative,
+            mention.findtext("sentence"),
+            mention.findtext("start"),
+            mention.findtext("end"),
+            mention.findtext("head")
+        ])
+
+
+def iter_closed_elements(file):
+    """
+    Yields each <sentence> and <coreference> element once it has been fully parsed,
+    and frees it (and its already processed siblings) after the caller is done with it.
+
+    <sentence> tags nested inside coreference mentions are skipped, they are read by their mention.
+    """
+    for _, element in etree.iterparse(file, events=("end",), tag=("sentence", "coreference")):
+        parent = element.getparent()
+        if element.tag == "sentence" and parent.tag == "mention":
+            continue
+
+        yield element
+
+        element.clear()
+        while element.getprevious() is not None:
+            del parent[0]
+
+
+def open_xml(source, compressed=False):
+    """
+    Opens a file path or a (member_name, member_bytes) pair read from the CoreNLP tarball.
+    Gzipped tarball members are told apart by their extension and decompressed in memory.
+
+    Returns:
+        tuple: (file, base_name)
+    """
+    if isinstance(source, tuple):
+        member_name, data = source
+        member_path = PurePosixPath(member_name)
+        compressed = member_path.suffix == ".gz"
+
+        file = io.BytesIO(data)
+        if compressed:
+            file = gzip.GzipFile(fileobj=file)
+
+        return file, get_base_name(member_path, compressed=compressed)
+
+    open_func = gzip.open if compressed else open
+    return open_func(source, "rb"), get_base_name(source, compressed=compressed)
+
+
+def parse_xml(file, tokens_writer, dependencies_writer, coreferences_writer, streaming=False):
+    if streaming:
+        # rows are written as soon as each element closes, so only one sentence is kept in memory.
+        # Sentences always precede the coreference section, so the row order matches the tree-based path
+        for element in iter_closed_elements(file):
+            if element.tag == "sentence":
+                write_sentence_rows(element, tokens_writer, dependencies_writer)
+            else:
+                write_coreference_rows(element, coreferences_writer)
+        return
+
+    root = etree.parse(file).getroot()
+
+    for sentence in SENTENCE_XPATH(root):
+        write_sentence_rows(sentence, tokens_writer, dependencies_writer)
+
+    for coreference in COREFERENCE_XPATH(root):
+        write_coreference_rows(coreference, coreferences_writer)
+
+
+def parse_xml_to_csv(source, output_dir, compressed=False, streaming=False):
+    """
+    Parses a file path or a tarball member (see `open_xml`) into three CSV files.
+    """
+    file, base_name = open_xml(source, compressed=compressed)
+
     tokens_file = output_dir / f"tokens_{base_name}.csv"
     dependencies_file = output_dir / f"dependencies_{base_name}.csv"
     coreferences_file = output_dir / f"coreferences_{base_name}.csv"
-    
-    with open(tokens_file, mode="w", newline="", encoding="utf-8") as tf, \
+
+    with file, \
+         open(tokens_file, mode="w", newline="", encoding="utf-8") as tf, \
          open(dependencies_file, mode="w", newline="", encoding="utf-8") as df, \
          open(coreferences_file, mode="w", newline="", encoding="utf-8") as cf:
-        
+
         tokens_writer = csv.writer(tf)
         dependencies_writer = csv.writer(df)
         coreferences_writer = csv.writer(cf)
-        
-        tokens_writer.writerow([
-            "sentence_id", "token_id", "word", "lemma",
-            "CharacterOffsetBegin", "CharacterOffsetEnd",
-            "POS", "NER"
-        ])
 
-        dependencies_writer.writerow([
-            "sentence_id", "type",
-            "governor", "governor_idx",
-            "dependent", "dependent_idx"
-        ])
+        tokens_writer.writerow(TOKENS_HEADER)
+        dependencies_writer.writerow(DEPENDENCIES_HEADER)
+        coreferences_writer.writerow(COREFERENCES_HEADER)
 
-        coreferences_writer.writerow([
-            "representative", "sentence_id",
-            "start", "end", "head"
-        ])
+        parse_xml(file, tokens_writer, dependencies_writer, coreferences_writer, streaming=streaming)
+
+
+class RowCollector:
+    """
+    Stands in for a csv.writer and collects the rows of many movies, prefixed with the current movie_id.
+    """
+    def __init__(self):
+        self.movie_id = None
+        self.rows = []
+
+    def writerow(self, row):
+        self.rows.append([self.movie_id, *row])
+
+    def to_table(self, schema):
+        columns = list(zip(*self.rows)) or [[] for _ in schema]
+        table = pa.table([pa.array(column, type=pa.string() if field.type != pa.bool_() else pa.bool_())
+                          for column, field in zip(columns, schema)], names=schema.names)
+        return table.cast(schema)
+
+
+def parse_xml_shard_to_parquet(shard, output_dir, compressed=False, streaming=False):
+    """
+    Parses a shard of files or tarball members into one Parquet file per table.
+    The shard is sorted by movie_id, so each file covers a contiguous range of movies
+    and the row group statistics can be used to skip everything but the requested movie.
+    """
+    shard_index, sources = shard
+    collectors = {table: RowCollector() for table in PARQUET_SCHEMAS}
+
+    for source in sources:
+        file, base_name = open_xml(source, compressed=compressed)
+
+        for collector in collectors.values():
+            collector.movie_id = base_name
+
+        with file:
+            parse_xml(file, collectors["tokens"], collectors["dependencies"], collectors["coreferences"], streaming=streaming)
+
+    for table, collector in collectors.items():
+        pq.write_table(
+            collector.to_table(PARQUET_SCHEMAS[table]),
+            output_dir / table / f"part-{shard_index:05d}.parquet",
+            row_group_size=PARQUET_ROW_GROUP_SIZE,
+            compression="zstd"
+        )
 
-        for sentence in SENTENCE_XPATH(root):
-            sentence_id = sentence.get("id")
-
-            for token in TOKEN_XPATH(sentence):
-                tokens_writer.writerow([
-                    sentence_id,
-                    token.get("id"),
-                    token.findtext("word"),
-                    token.findtext("lemma"),
-                    token.findtext("CharacterOffsetBegin"),
-                    token.findtext("CharacterOffsetEnd"),
-                    token.findtext("POS"),
-                    token.findtext("NER")
-                ])
-
-            for dep in DEPENDENCY_XPATH(sentence):
-                dependencies_writer.writerow([
-                    sentence_id,
-                    dep.get("type"),
-                    dep.findtext("governor"),
-                    dep.find("governor").get("idx"),
-                    dep.findtext("dependent"),
-                    dep.find("dependent").get("idx")
-                ])
-
-        for coreference in COREFERENCE_XPATH(root):
-            for mention in coreference.xpath("mention"):
-                representative = mention.get("representative") == "true"
-                coreferences_writer.writerow([
-                    representative,
-                    mention.findtext("sentence"),
-                    mention.findtext("start"),
-                    mention.findtext("end"),
-                    mention.findtext("head")
-                ])
-
-
-def process_files(file_paths, output_dir, compressed=False):
-    process_and_save = partial(parse_xml_to_csv, output_dir=output_dir, compressed=compressed)
-
-    with mp.Pool(mp.cpu_count()) as pool:
-        list(tqdm(pool.imap_unordered(process_and_save, file_paths), total=len(file_paths)))
+
+def get_tar_members(tar):
+    """
+    Lists the XML members (plain or gzipped) of the CoreNLP tarball in archive order.
+    Only the member headers are read, the data is skipped over.
+    """
+    return [
+        member for member in tar.getmembers()
+        if member.isfile() and member.name.endswith((".xml", ".xml.gz"))
+    ]
+
+
+def read_tar_members(tar, members):
+    for member in members:
+        yield member.name, tar.extractfile(member).read()
+
+
+def make_shards(sources, shard_size):
+    shard = []
+    for source in sources:
+        shard.append(source)
+        if len(shard) == shard_size:
+            yield shard
+            shard = []
+    if shard:
+        yield shard
+
+
+def imap_bounded(pool, func, tasks, max_in_flight):
+    """
+    Like pool.imap, but submits the next task only once fewer than `max_in_flight` are waiting or running.
+    A worker exception is raised in the calling process.
+    """
+    pending = deque()
+    for task in tasks:
+        if len(pending) == max_in_flight:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(func, (task,)))
+    while pending:
+        yield pending.popleft().get()
+
+
+def process_files(file_paths, output_dir, compressed=False, streaming=False, tar=None, output_format="csv", shard_size=1000):
+    """
+    Parses the files in parallel. If `tar` is given, `file_paths` are the members of the tarball to parse,
+    their contents are read by the main process and sent to the workers without being written to disk.
+    """
+    num_workers = mp.cpu_count()
+    tasks = file_paths if tar is None else read_tar_members(tar, file_paths)
+
+    if output_format == "parquet":
+        process_and_save = partial(parse_xml_shard_to_parquet, output_dir=output_dir, compressed=compressed, streaming=streaming)
+        tasks = enumerate(make_shards(tasks, shard_size))
+        num_tasks = -(-len(file_paths) // shard_size)
+        max_in_flight = num_workers * 2
+
+        for table in PARQUET_SCHEMAS:
+            (output_dir / table).mkdir(parents=True, exist_ok=True)
+    else:
+        process_and_save = partial(parse_xml_to_csv, output_dir=output_dir, compressed=compressed, streaming=streaming)
+        num_tasks = len(file_paths)
+        max_in_flight = num_workers * 16
+
+    with mp.Pool(num_workers) as pool:
+        if tar is None:
+            results = pool.imap_unordered(process_and_save, tasks)
+        else:
+            # bound the number of member contents held in memory by the pool's task queue
+            results = imap_bounded(pool, process_and_save, tasks, max_in_flight)
+        for _ in tqdm(results, total=num_tasks):
+            pass
 
 
 def main():
     parser = argparse.ArgumentParser(description="Parse XML files and save results to CSV.")
     parser.add_argument("-i", "--input-dir", type=Path, required=False, default="./data/raw/corenlp_plot_summaries/", help="Directory containing XML files")
+    parser.add_argument("-t", "--input-tar", type=Path, required=False, default=None, help="Read the XML files directly from corenlp_plot_summaries.tar instead of --input-dir")
     parser.add_argument("-o", "--output-dir", type=Path, required=False, default="./data/interim/corenlp_plot_summaries/", help="Directory to save CSV files")
     parser.add_argument("-n", "--num-files", type=int, default=None, help="Number of files to process")
     parser.add_argument("--compressed", action="store_true", help="Specify if input files are gz compressed")
+    parser.add_argument("--streaming", action="store_true", help="Parse incrementally with iterparse instead of building the whole tree (lower memory per worker)")
+    parser.add_argument("--output-format", type=str, default="csv", choices=["csv", "parquet"],
+                        help="Save three CSV files per movie, or three Parquet datasets (tokens/, dependencies/, coreferences/) sharded by movie_id (default: csv)")
+    parser.add_argument("--shard-size", type=int, default=1000, help="Number of movies per Parquet file (default: 1000)")
     
     args = parser.parse_args()
     input_dir = args.input_dir
+    input_tar = args.input_tar
     output_dir = args.output_dir
     num_files = args.num_files
     compressed = args.compressed
+    streaming = args.streaming
+    output_format = args.output_format
+    shard_size = args.shard_size
 
     output_dir.mkdir(parents=True, exist_ok=True)
 
+    if input_tar:
+        # gzipped and plain members are told apart by their extension, --compressed is not needed
+        with tarfile.open(input_tar) as tar:
+            members = get_tar_members(tar)
+
+            if num_files:
+                members = members[:num_files]
+
+            if output_format == "parquet":
+                members.sort(key=lambda member: get_base_name(PurePosixPath(member.name), compressed=member.name.endswith(".gz")))
+
+            print("Plot summaries:", len(members))
+
+            process_files(members, output_dir, streaming=streaming, tar=tar, output_format=output_format, shard_size=shard_size)
+        return
+
     if compressed:
         file_paths = list(input_dir.glob("*.xml.gz"))
     else:
@@ -120,9 +360,12 @@ def main():
     if num_files:
         file_paths = file_paths[:num_files]
 
+    if output_format == "parquet":
+        file_paths.sort(key=lambda file_path: get_base_name(file_path, compressed=compressed))
+
     print("Plot summaries:", len(file_paths))
 
-    process_files(file_paths, output_dir, compressed=compressed)
+    process_files(file_paths, output_dir, compressed=compressed, streaming=streaming, output_format=output_format, shard_size=shard_size)
 
 
 if __name__ == "__main__":
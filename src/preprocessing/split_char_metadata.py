@@ -1,9 +1,18 @@
 import pandas as pd
 import argparse
+import io
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 
 
-def split_character_metadata(input_dir, output_dir):
+INDEXED_METADATA_FILE = 'character.metadata.csv'
+METADATA_INDEX_FILE = 'character.metadata.index.json'
+
+
+def read_character_metadata(input_dir):
     metadata_file = input_dir / 'character.metadata.tsv'
 
     characters_metadata_df = pd.read_csv(metadata_file, sep='\t', header=None)
@@ -24,29 +33,144 @@ def split_character_metadata(input_dir, output_dir):
         'freebase_actor_id'
     ]
 
+    return characters_metadata_df
+
+
+def iter_movie_rows(characters_metadata_df):
+    """
+    Splits the metadata by movie_id in a single sort + groupby pass.
+    The sort is stable, so the characters of a movie keep their original order.
+
+    Yields:
+        tuple: (movie_id, rows) where rows are the movie's CSV lines without the movie_id column and header
+    """
+    characters_metadata_df = characters_metadata_df.sort_values('movie_id', kind='stable')
+    movie_sizes = characters_metadata_df.groupby('movie_id', sort=False).size()
+    df = characters_metadata_df.drop(columns=['movie_id'])
+
+    # render all rows at once, formatting the rows of each movie separately is the bottleneck
+    lines = df.to_csv(index=False, header=False).split('\n')[:-1]
+
+    if len(lines) != len(df):
+        # a quoted field contains a line break, fall back to formatting each movie on its own
+        start = 0
+        for movie_id, size in movie_sizes.items():
+            yield movie_id, df.iloc[start:start + size].to_csv(index=False, header=False)
+            start += size
+        return
+
+    start = 0
+    for movie_id, size in movie_sizes.items():
+        yield movie_id, '\n'.join(lines[start:start + size]) + '\n'
+        start += size
+
+
+def get_header(characters_metadata_df):
+    return characters_metadata_df.drop(columns=['movie_id']).head(0).to_csv(index=False)
+
+
+def split_character_metadata(input_dir, output_dir, num_threads=8):
+    characters_metadata_df = read_character_metadata(input_dir)
+    header = get_header(characters_metadata_df)
+
+    # bound the number of movies waiting to be written
+    in_flight = threading.BoundedSemaphore(num_threads * 4)
+
+    def save(movie_id, rows):
+        try:
+            output_file = output_dir / f'character.metadata_{movie_id}.csv'
+            with open(output_file, 'w', newline='', encoding='utf-8') as f:
+                f.write(header)
+                f.write(rows)
+        finally:
+            in_flight.release()
+
     # split by movie_id and save to separate csv files
-    for movie_id in characters_metadata_df['movie_id'].unique():
-        df = characters_metadata_df[characters_metadata_df['movie_id'] == movie_id]
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        futures = []
+        for movie_id, rows in iter_movie_rows(characters_metadata_df):
+            in_flight.acquire()
+            futures.append(executor.submit(save, movie_id, rows))
+
+        for future in futures:
+            future.result()
+
+
+def write_indexed_character_metadata(input_dir, output_dir):
+    """
+    Writes all movies into a single CSV file sorted by movie_id, and a JSON index mapping
+    each movie_id to the (offset, length) in bytes of its rows. The header is stored once at offset 0.
+    """
+    characters_metadata_df = read_character_metadata(input_dir)
+
+    index = {}
+    with open(output_dir / INDEXED_METADATA_FILE, 'wb') as f:
+        f.write(get_header(characters_metadata_df).encode('utf-8'))
+
+        for movie_id, rows in iter_movie_rows(characters_metadata_df):
+            rows = rows.encode('utf-8')
+            index[str(movie_id)] = (f.tell(), len(rows))
+            f.write(rows)
+
+    with open(output_dir / METADATA_INDEX_FILE, 'w') as f:
+        json.dump(index, f)
+
+
+@lru_cache(maxsize=None)
+def read_metadata_index(input_dir):
+    with open(input_dir / METADATA_INDEX_FILE) as f:
+        return json.load(f)
+
+
+def read_indexed_character_metadata_bytes(input_dir, movie_id):
+    """
+    Reads the header and the rows of a single movie from the file written by `write_indexed_character_metadata`,
+    the same bytes as `character.metadata_{movie_id}.csv`.
+
+    Raises:
+        KeyError: if the movie has no character metadata
+    """
+    offset, length = read_metadata_index(input_dir)[str(movie_id)]
+
+    with open(input_dir / INDEXED_METADATA_FILE, 'rb') as f:
+        header = f.readline()
+        f.seek(offset)
+        rows = f.read(length)
+
+    return header + rows
 
-        df = df.drop(columns=['movie_id'])
 
-        output_file = output_dir / f'character.metadata_{movie_id}.csv'
+def read_indexed_character_metadata(input_dir, movie_id, usecols=None):
+    """
+    Reads the metadata of a single movie from the file written by `write_indexed_character_metadata`,
+    equivalent to reading `character.metadata_{movie_id}.csv`.
 
-        df.to_csv(output_file, index=False)
+    Raises:
+        KeyError: if the movie has no character metadata
+    """
+    return pd.read_csv(io.BytesIO(read_indexed_character_metadata_bytes(input_dir, movie_id)), usecols=usecols)
 
 
 def main():
     parser = argparse.ArgumentParser(description="Split character metadata by movie ID.")
     parser.add_argument("-i", "--input-dir", type=Path, required=False, default="./data/raw/", help="Directory containing character metadata file")
     parser.add_argument("-o", "--output-dir", type=Path, required=False, default="./data/interim/", help="Directory to save split character metadata files")
+    parser.add_argument("--num-threads", type=int, default=8, help="Number of threads writing the split files (default: 8)")
+    parser.add_argument("--indexed", action="store_true",
+                        help=f"Write a single {INDEXED_METADATA_FILE} sorted by movie ID and a byte-offset index {METADATA_INDEX_FILE} instead of one file per movie")
 
     args = parser.parse_args()
     input_dir = args.input_dir
     output_dir = args.output_dir
+    num_threads = args.num_threads
+    indexed = args.indexed
 
     output_dir.mkdir(parents=True, exist_ok=True)
 
-    split_character_metadata(input_dir, output_dir)
+    if indexed:
+        write_indexed_character_metadata(input_dir, output_dir)
+    else:
+        split_character_metadata(input_dir, output_dir, num_threads=num_threads)
 
 if __name__ == '__main__':
     main()
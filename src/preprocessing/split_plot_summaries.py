@@ -1,7 +1,12 @@
 import argparse
+import json
+import os
 from pathlib import Path
 
 
+PLOT_SUMMARY_INDEX_FILE = 'plot_summaries.index.json'
+
+
 def split_plot_summaries(input_dir, output_dir):
     summary_file = input_dir / 'plot_summaries.txt'
 
@@ -14,18 +19,49 @@ def split_plot_summaries(input_dir, output_dir):
                 output.write(summary)
 
 
+def index_plot_summaries(input_dir, output_dir):
+    """
+    Records the (offset, length) in bytes of each movie's summary in the original plot_summaries.txt,
+    so that summaries can be read directly from it instead of from one file per movie.
+    The path of plot_summaries.txt is stored relative to the index.
+    """
+    summary_file = input_dir / 'plot_summaries.txt'
+
+    offsets = {}
+    with open(summary_file, 'rb') as file:
+        offset = 0
+        for line in file:
+            movie_id, summary = line.split(b'\t', 1)
+            summary_offset = offset + len(movie_id) + 1
+            offsets[movie_id.decode('utf-8')] = (summary_offset, len(summary.rstrip(b'\r\n')))
+            offset += len(line)
+
+    index = {
+        'summary_file': os.path.relpath(summary_file, output_dir),
+        'offsets': offsets
+    }
+
+    with open(output_dir / PLOT_SUMMARY_INDEX_FILE, 'w', encoding='utf-8') as f:
+        json.dump(index, f)
+
+
 def main():
     parser = argparse.ArgumentParser(description="Split plot summaries by movie ID.")
     parser.add_argument("-i", "--input-dir", type=Path, required=False, default="./data/raw/", help="Directory containing plot summary file")
     parser.add_argument("-o", "--output-dir", type=Path, required=False, default="./data/interim/", help="Directory to save split plot summary files")
+    parser.add_argument("--index", action="store_true", help=f"Only write an offset index {PLOT_SUMMARY_INDEX_FILE} into plot_summaries.txt instead of one file per movie")
 
     args = parser.parse_args()
     input_dir = args.input_dir
     output_dir = args.output_dir
+    index = args.index
 
     output_dir.mkdir(parents=True, exist_ok=True)
 
-    split_plot_summaries(input_dir, output_dir)
+    if index:
+        index_plot_summaries(input_dir, output_dir)
+    else:
+        split_plot_summaries(input_dir, output_dir)
 
 if __name__ == '__main__':
     main()
@@ -1,5 +1,6 @@
 import os
 import json
+import sqlite3
 from sklearn.feature_extraction.text import CountVectorizer
 from scipy.sparse import hstack
 
@@ -17,6 +18,35 @@ def load_character_bags(json_folder):
                     
                     character_bags[name] = bag_words
     return character_bags
+
+def load_character_bags_store(store_file, movie_ids=None):
+    """
+    Loads the bags from the store written by `build_char_word_bags.py --save-format sqlite`,
+    in the same format as load_character_bags. Pass movie_ids to only load the bags of these movies.
+    """
+    # read-only, memory-mapped
+    store = sqlite3.connect(f"file:{store_file}?mode=ro", uri=True)
+    store.execute("PRAGMA mmap_size=1073741824")
+
+    if movie_ids is None:
+        rows = store.execute("SELECT name, bag FROM character_bags ORDER BY rowid")
+    else:
+        store.execute("CREATE TEMP TABLE selected_movies (movie_id TEXT PRIMARY KEY)")
+        store.executemany("INSERT OR IGNORE INTO selected_movies VALUES (?)", [(str(movie_id),) for movie_id in movie_ids])
+        rows = store.execute(
+            "SELECT name, bag FROM character_bags WHERE movie_id IN (SELECT movie_id FROM selected_movies) ORDER BY rowid"
+        )
+
+    character_bags = {}
+    for name, bag in rows:
+        bag_words = { "agent verb": [], "patient verb": [], "attribute": []}
+        for label, lemma in json.loads(bag):
+            bag_words[label].append(lemma)
+
+        character_bags[name] = bag_words
+
+    store.close()
+    return character_bags
     
 def load_tropes(tropes_file):
     trope_dict = {}